@@ -1,11 +1,31 @@
-from flask import Flask, render_template, jsonify, request, send_file
+from flask import Flask, Response, g, has_request_context, render_template, jsonify, request, stream_with_context
+import bisect
+import contextlib
 import datetime
-import io
+import hashlib
+import hmac
 import os
+import tempfile
 import re
-import unicodedata
 import sqlite3
 import json
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+
+try:
+    import brotli  # Optional: 'br' responses when installed, gzip otherwise
+except ImportError:
+    brotli = None
+
+from deploy_target import DeployError, apply_changeset, get_applied_seq, install_snapshot, read_changeset
+from keyword_index import (
+    AMABRE_KEYWORD, find_keyword_spans, get_lista_normalizada, highlights_available, keyword_index_available,
+    remover_acentos,
+)
+from protocol_fields import fields_available
 
 app = Flask(__name__)
 
@@ -15,187 +35,780 @@ with open('config.json', 'r', encoding='utf-8') as f:
 
 # --- Configuration ---
 DB_NAME = config.get('database_name', 'protocols.db')
-REMOVIDOS_FILE = 'removidos.txt'
+REMOVIDOS_FILE = 'removidos.txt'  # Legacy list, imported once into REMOVIDOS_DB
+# Kept apart from the protocols database so a deploy that replaces protocols.db keeps the removals.
+REMOVIDOS_DB = config.get('removidos_database', 'removidos.db')
 LISTA_ORIGINAL = sorted(config.get('lista_original', []))
 FAMILIAS = config.get('familias', {})
+LISTA_NORMALIZADA = get_lista_normalizada(LISTA_ORIGINAL, FAMILIAS)
+PAGE_SIZE = config.get('page_size', 200)
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 400  # (year, number) pairs per IN list: 800 parameters, under SQLite's old 999 limit
+RESULT_CACHE_SIZE = config.get('result_cache_size', 256)
+SQLITE_MMAP_SIZE = config.get('sqlite_mmap_size', 256 * 1024 * 1024)
+SQLITE_CACHE_KB = config.get('sqlite_cache_kb', 32768)
+# Token of the /admin/deploy endpoints; without one they are disabled.
+DEPLOY_TOKEN = os.environ.get('DEPLOY_TOKEN') or config.get('deploy_token')
+# Request/SQL instrumentation and the /metrics endpoint; off unless enabled here or with APP_METRICS=1.
+METRICS_ENABLED = os.environ.get('APP_METRICS', str(config.get('metrics_enabled', False))).lower() in ('1', 'true', 'yes')
+SLOW_QUERY_SECONDS = config.get('slow_query_ms', 100) / 1000
+SLOW_QUERY_SAMPLES = config.get('metrics_slow_samples', 50)
+# JSON bodies at least this big are sent gzip/brotli-encoded to clients that accept it.
+COMPRESS_MIN_BYTES = config.get('compress_min_bytes', 1024)
+# Part of every ETag: the settings that change what the routes return (keyword list,
+# families, page size). Secrets such as the deploy token must stay out of it.
+ETAG_SEED = json.dumps({'version': 1, 'lista_original': LISTA_ORIGINAL, 'familias': FAMILIAS,
+                        'page_size': PAGE_SIZE}, sort_keys=True)
 
 
 # --- Helper Functions ---
 
-def remover_acentos(txt):
-    if not txt:
-        return ""
-    return ''.join(c for c in unicodedata.normalize('NFD', txt) if unicodedata.category(c) != 'Mn')
-
-def get_lista_normalizada():
-    mapa_familias = {}
-    for key, variantes in FAMILIAS.items():
-        for v in variantes:
-            mapa_familias[remover_acentos(v).lower()] = set(remover_acentos(va).lower() for va in variantes)
-
-    lista_normalizada = set()
-    for nome in LISTA_ORIGINAL:
-        nome_sem_acento = remover_acentos(nome).lower()
-        if nome_sem_acento in mapa_familias:
-            lista_normalizada.update(mapa_familias[nome_sem_acento])
-        else:
-            lista_normalizada.add(nome_sem_acento)
-    return list(lista_normalizada)
+def parse_protocol_id(pid):
+    """Splits "2024/00123" into (2024, 123); raises ValueError on anything else."""
+    year, number = pid.split('/')
+    return int(year), int(number)
 
-LISTA_NORMALIZADA = get_lista_normalizada()
+def init_removidos():
+    """
+    Creates the removals table. The first time it is created, the entries of the
+    old removidos.txt are imported in the same transaction.
+    """
+    conn = sqlite3.connect(REMOVIDOS_DB, timeout=30, isolation_level=None)
+    try:
+        # IMMEDIATE so that several workers starting together import only once.
+        conn.execute("BEGIN IMMEDIATE")
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'removidos'"
+        ).fetchone()
+        if not exists:
+            conn.execute("""
+                CREATE TABLE removidos (
+                    year INTEGER NOT NULL,
+                    number INTEGER NOT NULL,
+                    removed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (year, number)
+                ) WITHOUT ROWID
+            """)
+            if os.path.exists(REMOVIDOS_FILE):
+                rows = []
+                with open(REMOVIDOS_FILE, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            rows.append(parse_protocol_id(line.strip()))
+                        except ValueError:
+                            continue
+                conn.executemany("INSERT OR IGNORE INTO removidos (year, number) VALUES (?, ?)", rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
 
-def get_removidos():
-    if not os.path.exists(REMOVIDOS_FILE):
-        return set()
-    with open(REMOVIDOS_FILE, 'r', encoding='utf-8') as f:
-        return set(line.strip() for line in f if line.strip())
+def add_removido(year, number):
+    conn = sqlite3.connect(REMOVIDOS_DB, timeout=30)
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO removidos (year, number) VALUES (?, ?)", (year, number))
+    finally:
+        conn.close()
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+init_removidos()
+
+class ResultCache:
+    """
+    Bounded LRU cache for /api/protocols pages. Entries are tagged with the
+    database version they were computed from; a new version (the daily deploy
+    replacing the DB, a removal) drops everything on the next lookup.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+            }
+
+result_cache = ResultCache(RESULT_CACHE_SIZE)
+
+# --- Instrumentation ---
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus layout (seconds)."""
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def sql_fingerprint(sql):
+    """Collapses whitespace and repeated placeholder lists so one statement shape is one label."""
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))+', '(?, ...)', sql)
+    return re.sub(r'\?(?:, \?)+', '?, ...', sql)
+
+class Metrics:
+    """
+    Per-route, per-phase and per-statement latency histograms plus the most
+    recent slow statements with their parameters. Only used when
+    METRICS_ENABLED; otherwise nothing is registered and the connections are
+    plain sqlite3 ones.
+    """
+    def __init__(self, slow_seconds, slow_samples):
+        self.slow_seconds = slow_seconds
+        self.routes = {}
+        self.phases = {}
+        self.queries = {}
+        self.statuses = {}
+        self.slow = deque(maxlen=slow_samples)
+        self.lock = threading.Lock()
+
+    def _observe(self, table, key, seconds):
+        with self.lock:
+            histogram = table.get(key)
+            if histogram is None:
+                histogram = table[key] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_request(self, route, method, status, seconds):
+        self._observe(self.routes, (route, method), seconds)
+        with self.lock:
+            self.statuses[(route, method, status)] = self.statuses.get((route, method, status), 0) + 1
+
+    def observe_phase(self, phase, seconds):
+        self._observe(self.phases, phase, seconds)
+
+    def observe_query(self, sql, params, seconds):
+        fingerprint = sql_fingerprint(sql)
+        self._observe(self.queries, fingerprint, seconds)
+        if seconds >= self.slow_seconds:
+            with self.lock:
+                self.slow.append({
+                    'at': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'route': request.path if has_request_context() else None,
+                    'seconds': round(seconds, 6),
+                    'sql': fingerprint,
+                    'params': [p if isinstance(p, (int, float, str)) or p is None else repr(p) for p in params],
+                })
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += ['# HELP app_request_duration_seconds Time spent handling a request, including streamed bodies.',
+                      '# TYPE app_request_duration_seconds histogram']
+            for (route, method), histogram in sorted(self.routes.items()):
+                lines += histogram.render('app_request_duration_seconds', f'route="{_label(route)}",method="{method}"')
+            lines += ['# HELP app_requests_total Requests handled, by status code.',
+                      '# TYPE app_requests_total counter']
+            for (route, method, status), count in sorted(self.statuses.items()):
+                lines.append(f'app_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {count}')
+            lines += ['# HELP app_phase_duration_seconds Time spent in each step of a route (queries, serialization).',
+                      '# TYPE app_phase_duration_seconds histogram']
+            for phase, histogram in sorted(self.phases.items()):
+                lines += histogram.render('app_phase_duration_seconds', f'phase="{_label(phase)}"')
+            lines += ['# HELP app_sql_duration_seconds Time to execute a SQL statement (up to its first row).',
+                      '# TYPE app_sql_duration_seconds histogram']
+            for sql, histogram in sorted(self.queries.items()):
+                lines += histogram.render('app_sql_duration_seconds', f'sql="{_label(sql)}"')
+        return '\n'.join(lines) + '\n'
+
+    def slow_queries(self):
+        with self.lock:
+            return list(self.slow)
+
+metrics = Metrics(SLOW_QUERY_SECONDS, SLOW_QUERY_SAMPLES) if METRICS_ENABLED else None
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe_query(sql, parameters, time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including the ones behind conn.execute) time every statement."""
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+_NOT_TIMED = contextlib.nullcontext()
+
+def timed(phase):
+    """Times a block as `phase` when instrumentation is on; a shared no-op context otherwise."""
+    if metrics is None:
+        return _NOT_TIMED
+    return _timed_phase(phase)
+
+@contextlib.contextmanager
+def _timed_phase(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe_phase(phase, time.perf_counter() - started)
+
+if metrics is not None:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.get('request_started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else '<unmatched>'
+            method, status = request.method, response.status_code
+            # Observed when the body has been sent, so streamed responses count in full.
+            response.call_on_close(
+                lambda: metrics.observe_request(route, method, status, time.perf_counter() - started)
+            )
+        return response
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def get_db_version():
+    """
+    Identifies the current contents of the database. The file is replaced or
+    rewritten by the scraper/deploy, so its inode, mtime and size (plus the WAL
+    file, if a writer is active) change whenever the data does.
+    """
+    return (_file_signature(DB_NAME), _file_signature(DB_NAME + '-wal'), _file_signature(REMOVIDOS_DB))
+
+def db_validators(version=None):
+    """
+    ETag and Last-Modified for responses built from the database. Both come from
+    the file signatures in get_db_version(), so they change exactly when a
+    deploy, the scraper or a removal changes what the routes would return.
+    """
+    version = version or get_db_version()
+    etag = hashlib.blake2b(repr((version, ETAG_SEED)).encode(), digest_size=12).hexdigest()
+    mtimes = [signature[1] for signature in version if signature]
+    last_modified = None
+    if mtimes:
+        last_modified = datetime.datetime.fromtimestamp(max(mtimes) // 10**9, tz=datetime.timezone.utc)
+    return etag, last_modified
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Cached copies may be reused, but only after revalidating (a cheap 304).
+    response.cache_control.no_cache = True
+    return response
+
+def not_modified(etag, last_modified):
+    """Returns a 304 response if the client's copy is current, before any query runs; otherwise None."""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+    return with_validators(Response(status=304), etag, last_modified) if fresh else None
+
+def choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] and accepted['br'] >= accepted['gzip']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    """Compresses large buffered JSON responses with the best encoding the client accepts."""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    elif encoding == 'gzip':
+        response.set_data(zlib.compress(data, 6, wbits=31))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+_local = threading.local()
+
+def _open_db_connection():
+    # Read-only: the app never writes to protocols.db (removals go to REMOVIDOS_DB).
+    conn = sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True, cached_statements=256,
+                           factory=InstrumentedConnection if metrics is not None else sqlite3.Connection)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+    conn.execute(f"PRAGMA cache_size = -{int(SQLITE_CACHE_KB)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("ATTACH DATABASE ? AS rm", (f"file:{REMOVIDOS_DB}?mode=ro",))
     return conn
 
+def get_db_connection():
+    """
+    Returns this thread's read-only connection, keeping its page cache and
+    prepared statements warm between requests. The connection is reopened when
+    the database file changes on disk (the deploy replaces it), so it never
+    keeps reading an unlinked file. Callers must not close it.
+    """
+    signature = _file_signature(DB_NAME)
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.signature == signature and _local.path == DB_NAME:
+        return conn
+    if conn is not None:
+        conn.close()
+    _local.conn = _open_db_connection()
+    _local.signature = signature
+    _local.path = DB_NAME
+    return _local.conn
+
 def get_single_protocol_details(pid):
     try:
-        year, number = pid.split('/')
+        year, number = parse_protocol_id(pid)
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT content, Arquivado, Last_update FROM protocols WHERE year = ? AND number = ?", (int(year), int(number)))
-        row = cursor.fetchone()
-        conn.close()
-        return row
+        if highlights_available(conn):
+            cursor.execute("""
+                SELECT p.content, p.Arquivado, p.Last_update, h.spans
+                FROM protocols p LEFT JOIN protocol_highlights h ON h.year = p.year AND h.number = p.number
+                WHERE p.year = ? AND p.number = ?
+            """, (year, number))
+        else:
+            cursor.execute("SELECT content, Arquivado, Last_update, NULL AS spans FROM protocols WHERE year = ? AND number = ?", (year, number))
+        return cursor.fetchone()
     except (ValueError, IndexError):
         return None
 
-def highlight(text, keywords):
-    normalized_keywords = {k.strip().lower() for k in keywords if k.strip()}
-    if not normalized_keywords or not text:
+def parse_search_terms(search):
+    """
+    Turns an FTS query into the terms to highlight: quoted phrases stay whole,
+    AND/OR/NOT are dropped and a trailing '*' keeps its prefix meaning.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', search):
+        if not phrase and word in ('AND', 'OR', 'NOT'):
+            continue
+        term = phrase or word
+        prefix = term.endswith('*')
+        term = ' '.join(re.sub(r'[^\w\s]', ' ', remover_acentos(term).lower()).split())
+        if term:
+            terms.append(term + '*' if prefix else term)
+    return terms
+
+def highlight(text, spans):
+    """Wraps the given (start, end) ranges of text in highlight spans, merging overlaps."""
+    if not spans or not text:
         return text
 
-    # Tokenize the text into words and non-words (punctuation, spaces)
-    tokens = re.findall(r'\w+|[^\w\s]|\s+', text)
-    
     output = []
-    for token in tokens:
-        # We only want to check actual words for highlighting
-        is_word = token.isalnum()
-        normalized_token = remover_acentos(token).lower()
-        
-        if is_word and normalized_token in normalized_keywords:
-            output.append(f'<span class="highlight">{token}</span>')
-        else:
-            output.append(token)
-            
+    pos = 0
+    current_start = current_end = None
+    for start, end in sorted(spans) + [(len(text) + 1, len(text) + 1)]:
+        if current_end is not None and start <= current_end:
+            current_end = max(current_end, end)
+            continue
+        if current_end is not None:
+            output.append(text[pos:current_start])
+            output.append(f'<span class="highlight">{text[current_start:current_end]}</span>')
+            pos = current_end
+        current_start, current_end = start, end
+    output.append(text[pos:])
     return "".join(output)
 
-# --- Flask Routes ---
-
-@app.route('/')
-def index():
-    return render_template('index_full.html')
+def parse_iso_date(value):
+    """Returns a valid yyyy-mm-dd date string, or None."""
+    try:
+        return datetime.date.fromisoformat(value).isoformat() if value else None
+    except ValueError:
+        return None
 
-@app.route('/api/protocols')
-def api_protocols():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def parse_protocol_filters(args):
+    """Normalizes the /api/protocols query string into the filter set the queries are built from."""
+    sort_order = args.get('sort_order', 'asc').lower()
+    status = args.get('status')
+    return {
+        'search': ' '.join(args.get('search', '').split()),
+        'sort_order': sort_order if sort_order in ['asc', 'desc'] else 'asc',
+        'sort_by': 'date' if args.get('sort_by') == 'date' else 'number',
+        'status': status if status in ['arch', 'notarch'] else None,
+        'amabre': args.get('amabre') == 'true',
+        'keywords': args.get('filter_keywords') == 'true',
+        'departamento': args.get('departamento', '').strip() or None,
+        'assunto': args.get('assunto', '').strip() or None,
+        'date_from': parse_iso_date(args.get('date_from')),
+        'date_to': parse_iso_date(args.get('date_to')),
+    }
+
+def parse_cursor(value, sort_by='number'):
+    """
+    Parses an 'after' cursor into the sort key of the last row sent: (year, number)
+    for "2024/00123", or (last_update, year, number) for "2024-05-01|2024/00123"
+    when sorting by date. A cursor that does not match sort_by is ignored.
+    """
+    if not value:
+        return None
+    date = None
+    if sort_by == 'date':
+        if '|' not in value:
+            return None
+        date, value = value.split('|', 1)
+    try:
+        year, number = value.split('/')
+        key = (int(year), int(number))
+    except ValueError:
+        return None
+    return key if sort_by == 'number' else (date,) + key
 
-    search_term = request.args.get('search', '').strip()
-    sort_order = request.args.get('sort_order', 'asc').lower()
-    if sort_order not in ['asc', 'desc']:
-        sort_order = 'asc'
+def make_cursor(row, sort_by='number'):
+    cursor = f"{row['year']}/{str(row['number']).zfill(5)}"
+    return f"{row['sort_date']}|{cursor}" if sort_by == 'date' else cursor
 
+def build_protocol_query(conn, filters):
+    """Builds the FROM/WHERE pieces shared by the totals, page and stream queries."""
     # --- Base Query ---
     from_clause = "FROM protocols p"
-    where_clauses = []
+    # Removed protocols are dropped by an anti-join, so totals never count them.
+    where_clauses = ["NOT EXISTS (SELECT 1 FROM rm.removidos r WHERE r.year = p.year AND r.number = p.number)"]
     params = []
-    order_by_clause = f"ORDER BY p.year {sort_order}, p.number {sort_order}"
 
-    if search_term:
+    if filters['search']:
         from_clause = "FROM protocols_fts fts JOIN protocols p ON fts.rowid = p.rowid"
         where_clauses.append("fts.content MATCH ?")
-        params.append(search_term)
+        params.append(filters['search'])
+
+    # Keyword and AMABRE matches are precomputed at ingest (keyword_index.py);
+    # older databases without the index fall back to substring scans.
+    use_keyword_index = keyword_index_available(conn)
+    amabre_sql = (
+        "(p.year, p.number) IN (SELECT year, number FROM protocol_keywords WHERE keyword = ?)"
+        if use_keyword_index else "p.content LIKE ?"
+    )
+    amabre_param = AMABRE_KEYWORD if use_keyword_index else f"%{AMABRE_KEYWORD}%"
 
     # --- Keyword Filter ---
-    if request.args.get('filter_keywords') == 'true':
-        keyword_clauses_list = [f"p.content LIKE ?" for _ in LISTA_NORMALIZADA]
-        where_clauses.append("(" + " OR ".join(keyword_clauses_list) + ")")
-        params.extend([f"%{kw}%" for kw in LISTA_NORMALIZADA])
+    if filters['keywords']:
+        if use_keyword_index:
+            placeholders = ", ".join("?" for _ in LISTA_NORMALIZADA)
+            where_clauses.append(
+                f"(p.year, p.number) IN (SELECT year, number FROM protocol_keywords WHERE keyword IN ({placeholders}))"
+            )
+            params.extend(LISTA_NORMALIZADA)
+        else:
+            keyword_clauses_list = [f"p.content LIKE ?" for _ in LISTA_NORMALIZADA]
+            where_clauses.append("(" + " OR ".join(keyword_clauses_list) + ")")
+            params.extend([f"%{kw}%" for kw in LISTA_NORMALIZADA])
 
     # --- Status Filter ---
-    status = request.args.get('status')
-    if status == 'arch':
+    if filters['status'] == 'arch':
         where_clauses.append("p.Arquivado = 'yes'")
-    elif status == 'notarch':
+    elif filters['status'] == 'notarch':
         where_clauses.append("p.Arquivado = 'no'")
 
     # --- Amabre Filter ---
-    if request.args.get('amabre') == 'true':
-        where_clauses.append("p.content LIKE '%amabre%'")
-
-    # --- Build Final Query ---
-    where_sql = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
-    
-    # --- Get Total Counts ---
+    if filters['amabre']:
+        where_clauses.append(amabre_sql)
+        params.append(amabre_param)
+
+    # --- Department / Subject / Date Range Filters ---
+    # Answered from the tables protocol_fields.py fills at ingest: the date range
+    # matches protocols routed (to the department, if one is given) within it.
+    # Databases without those tables fall back to scanning the text and Last_update.
+    use_fields = fields_available(conn)
+    has_range = filters['date_from'] or filters['date_to']
+    date_range = (filters['date_from'] or '0000-00-00', filters['date_to'] or '9999-12-31')
+    if use_fields and (filters['departamento'] or has_range):
+        step_clauses, step_params = [], []
+        if filters['departamento']:
+            step_clauses.append("departamento = ?")
+            step_params.append(filters['departamento'])
+        if has_range:
+            step_clauses.append("data BETWEEN ? AND ?")
+            step_params.extend(date_range)
+        where_clauses.append(
+            f"(p.year, p.number) IN (SELECT year, number FROM protocol_steps WHERE {' AND '.join(step_clauses)})"
+        )
+        params.extend(step_params)
+    elif filters['departamento'] or has_range:
+        if filters['departamento']:
+            where_clauses.append("p.content LIKE ?")
+            params.append(f"%{filters['departamento']} em %")
+        if has_range:
+            where_clauses.append("IFNULL(p.Last_update, '') BETWEEN ? AND ?")
+            params.extend(date_range)
+
+    if filters['assunto']:
+        if use_fields:
+            where_clauses.append("(p.year, p.number) IN (SELECT year, number FROM protocol_fields WHERE assunto = ?)")
+            params.append(filters['assunto'])
+        else:
+            where_clauses.append("p.content LIKE ?")
+            params.append(f"%Assunto: {filters['assunto']}%")
+
+    return {
+        'from_clause': from_clause,
+        'where_clauses': where_clauses,
+        'params': params,
+        'amabre_sql': amabre_sql,
+        'amabre_param': amabre_param,
+    }
+
+def query_totals(conn, query):
+    where_sql = "WHERE " + " AND ".join(query['where_clauses']) if query['where_clauses'] else ""
     # We need to get the totals from the same query to respect all filters
     totals_sql = f"""
         SELECT 
             COUNT(p.rowid) as todos,
             SUM(CASE WHEN p.Arquivado = 'yes' THEN 1 ELSE 0 END) as arch,
-            SUM(CASE WHEN p.content LIKE '%amabre%' THEN 1 ELSE 0 END) as amabre
-        {from_clause}
+            SUM(CASE WHEN {query['amabre_sql']} THEN 1 ELSE 0 END) as amabre
+        {query['from_clause']}
         {where_sql}
     """
-    
-    # We need a separate query for totals because the main query might have a LIMIT/OFFSET later
-    total_cursor = conn.cursor()
-    total_cursor.execute(totals_sql, params)
-    totals_row = total_cursor.fetchone()
-    total_cursor.close()
+    totals_row = conn.execute(totals_sql, [query['amabre_param']] + query['params']).fetchone()
 
     total_todos = totals_row['todos'] or 0
     total_arch = totals_row['arch'] or 0
-    total_amabre = totals_row['amabre'] or 0
-    total_notarch = total_todos - total_arch
-    
-    # --- Get Results ---
-    results_sql = f"SELECT p.year, p.number, p.Arquivado {from_clause} {where_sql} {order_by_clause}"
-    
-    cursor.execute(results_sql, params)
-    rows = cursor.fetchall()
-    conn.close()
-
-    # --- Process and Return ---
-    removidos = get_removidos()
-    protocolos = []
-    for row in rows:
-        pid = f"{row['year']}/{str(row['number']).zfill(5)}"
-        if pid in removidos:
-            continue
-        protocolos.append({
-            'id': pid,
-            'ano': row['year'],
-            'numero': str(row['number']).zfill(5),
-            'has_archivado': row['Arquivado'] == 'yes',
-        })
-
-    return jsonify({
-        'protocols': protocolos,
-        'totals': {
-            'todos': total_todos,
-            'arch': total_arch,
-            'notarch': total_notarch,
-            'amabre': total_amabre
-        }
-    })
+    return {
+        'todos': total_todos,
+        'arch': total_arch,
+        'notarch': total_todos - total_arch,
+        'amabre': totals_row['amabre'] or 0
+    }
+
+def iter_protocol_rows(conn, query, sort_order, after=None, limit=None, sort_by='number'):
+    """
+    Yields matching rows in (year, number) order, or by Last_update first when
+    sort_by is 'date'. Pagination is keyset-based: `after` is the sort key of
+    the last row already sent, so each page is an index range scan instead of
+    an OFFSET over everything before it.
+    """
+    where_clauses = list(query['where_clauses'])
+    params = list(query['params'])
+    # Same expression as idx_protocols_last_update, so the date order is read from the index.
+    sort_columns = ["IFNULL(p.Last_update, '')", "p.year", "p.number"] if sort_by == 'date' else ["p.year", "p.number"]
+    if after:
+        placeholders = ", ".join("?" for _ in sort_columns)
+        where_clauses.append(f"({', '.join(sort_columns)}) {'>' if sort_order == 'asc' else '<'} ({placeholders})")
+        params.extend(after)
+
+    where_sql = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+    order_by_clause = "ORDER BY " + ", ".join(f"{column} {sort_order}" for column in sort_columns)
+    limit_sql = "LIMIT ?" if limit else ""
+    if limit:
+        params.append(limit)
+
+    results_sql = (
+        f"SELECT p.year, p.number, p.Arquivado, IFNULL(p.Last_update, '') AS sort_date "
+        f"{query['from_clause']} {where_sql} {order_by_clause} {limit_sql}"
+    )
+    yield from conn.execute(results_sql, params)
+
+def protocol_to_json(row):
+    pid = f"{row['year']}/{str(row['number']).zfill(5)}"
+    return {
+        'id': pid,
+        'ano': row['year'],
+        'numero': str(row['number']).zfill(5),
+        'has_archivado': row['Arquivado'] == 'yes',
+    }
+
+# --- Flask Routes ---
+
+@app.route('/')
+def index():
+    return render_template('index_full.html')
+
+@app.route('/api/protocols')
+def api_protocols():
+    """
+    Returns one page of protocols plus `next_cursor` for the next one.
+    Totals are only computed for the first page (no `after`).
+    With format=ndjson every matching protocol is streamed, one JSON object per line.
+    """
+    filters = parse_protocol_filters(request.args)
+    after = parse_cursor(request.args.get('after'), filters['sort_by'])
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+
+    version = get_db_version()
+    etag, last_modified = db_validators(version)
+    unchanged = not_modified(etag, last_modified)
+    if unchanged is not None:
+        return unchanged
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            conn = get_db_connection()
+            query = build_protocol_query(conn, filters)
+            for row in iter_protocol_rows(conn, query, filters['sort_order'], after, sort_by=filters['sort_by']):
+                yield (json.dumps(protocol_to_json(row)) + '\n').encode('utf-8')
+        body = generate()
+        headers = {'Vary': 'Accept-Encoding'}
+        if request.accept_encodings['gzip']:
+            body = gzip_stream(body)
+            headers['Content-Encoding'] = 'gzip'
+        response = Response(stream_with_context(body), mimetype='application/x-ndjson', headers=headers)
+        return with_validators(response, etag, last_modified)
+
+    cache_key = (tuple(sorted(filters.items())), after, limit)
+    cached = result_cache.get(cache_key, version)
+    if cached is not None:
+        return with_validators(jsonify(cached), etag, last_modified)
+
+    conn = get_db_connection()
+    query = build_protocol_query(conn, filters)
+    with timed('api_protocols.totals'):
+        totals = None if after else query_totals(conn, query)
+
+    # One extra row tells us whether there is a next page.
+    with timed('api_protocols.rows'):
+        rows = list(iter_protocol_rows(conn, query, filters['sort_order'], after, limit + 1, filters['sort_by']))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = make_cursor(rows[-1], filters['sort_by'])
+
+    payload = {
+        'protocols': [protocol_to_json(row) for row in rows],
+        'totals': totals,
+        'next_cursor': next_cursor,
+    }
+    result_cache.put(cache_key, version, payload)
+    with timed('api_protocols.serialize'):
+        return with_validators(jsonify(payload), etag, last_modified)
+
+@app.route('/api/facets')
+def api_facets():
+    """
+    Departments (with their number of routing steps) and subjects (with their
+    number of protocols) for the filter lists. Both are read straight off the
+    covering indexes; counting distinct protocols per department would need a
+    temporary B-tree over every step. Empty when the database has no
+    structured fields yet (see protocol_fields.py).
+    """
+    version = get_db_version()
+    etag, last_modified = db_validators(version)
+    unchanged = not_modified(etag, last_modified)
+    if unchanged is not None:
+        return unchanged
+
+    cached = result_cache.get(('facets',), version)
+    if cached is None:
+        conn = get_db_connection()
+        cached = {'departamentos': [], 'assuntos': []}
+        if fields_available(conn):
+            cached['departamentos'] = [list(row) for row in conn.execute(
+                "SELECT departamento, COUNT(*) FROM protocol_steps GROUP BY departamento ORDER BY departamento"
+            )]
+            cached['assuntos'] = [list(row) for row in conn.execute(
+                "SELECT assunto, COUNT(*) FROM protocol_fields WHERE assunto IS NOT NULL GROUP BY assunto ORDER BY assunto"
+            )]
+        result_cache.put(('facets',), version, cached)
+    return with_validators(jsonify(cached), etag, last_modified)
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Latency histograms in the Prometheus text format (404 unless instrumentation is enabled)."""
+    if metrics is None:
+        return '', 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/slow')
+def metrics_slow():
+    """
+    The most recent statements slower than slow_query_ms, with their parameters.
+    Those carry search terms and protocol ids, so this needs the deploy token.
+    """
+    if metrics is None or not deploy_authorized():
+        return '', 404
+    return jsonify(metrics.slow_queries())
 
 @app.route('/protocolo')
 def protocolo_detail():
     pid = request.args.get('id')
     search = request.args.get('search', '').strip()
+    etag, last_modified = db_validators()
+    unchanged = not_modified(etag, last_modified)
+    if unchanged is not None:
+        return unchanged
     details = get_single_protocol_details(pid)
 
     if not details:
-        return jsonify({'html': '<em>Protocolo não encontrado.</em>'})
+        return with_validators(jsonify({'html': '<em>Protocolo não encontrado.</em>'}), etag, last_modified)
 
     content = details['content']
     arquivado = details['Arquivado']
@@ -209,47 +822,184 @@ def protocolo_detail():
         except (ValueError, TypeError):
             last_update = "Data inválida"
 
-    # Highlight search term and the main keyword list
-    palavras_destaque = LISTA_NORMALIZADA.copy()
+    # Highlight the main keyword list (offsets stored at ingest) and the search terms
+    if details['spans'] is not None:
+        stored = json.loads(details['spans'])
+        spans = [tuple(span) for kw in LISTA_NORMALIZADA for span in stored.get(kw, ())]
+    else:
+        spans = [(start, end) for _, start, end in find_keyword_spans(content, LISTA_NORMALIZADA)]
     if search:
-        palavras_destaque.append(remover_acentos(search).lower())
-        
-    html = highlight(content, palavras_destaque)
-    return jsonify({
+        spans.extend((start, end) for _, start, end in find_keyword_spans(content, parse_search_terms(search)))
+
+    html = highlight(content, spans)
+    return with_validators(jsonify({
         'html': html,
         'arquivado': arquivado,
         'last_update': last_update
-    })
+    }), etag, last_modified)
 
 @app.route('/remover', methods=['POST'])
 def remover():
     pid = request.get_json().get('id')
-    if not pid:
+    try:
+        year, number = parse_protocol_id(pid or '')
+    except ValueError:
         return jsonify({'success': False})
-    with open(REMOVIDOS_FILE, 'a', encoding='utf-8') as f:
-        f.write(pid + '\n')
+    add_removido(year, number)
+    result_cache.clear()
     return jsonify({'success': True})
 
+def iter_export_blocks(ids):
+    """
+    Yields the export text for the given (year, number) pairs in order, fetching
+    them a chunk at a time so memory does not grow with the size of the export.
+    """
+    conn = get_db_connection()
+    first = True
+    for i in range(0, len(ids), EXPORT_CHUNK_SIZE):
+        chunk = ids[i:i + EXPORT_CHUNK_SIZE]
+        values = ", ".join("(?, ?)" for _ in chunk)
+        rows = conn.execute(
+            f"SELECT year, number, content FROM protocols WHERE (year, number) IN (VALUES {values}) ORDER BY year, number",
+            [value for pair in chunk for value in pair]
+        )
+        for row in rows:
+            if not row['content']:
+                continue
+            pid = f"{row['year']}/{str(row['number']).zfill(5)}"
+            yield ('' if first else '\n\n') + f"---\"{pid}\"---{row['content']}"
+            first = False
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class _ZipSink:
+    """Write-only file object for ZipFile; the bytes written are collected and handed out by drain()."""
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+def zip_stream(chunks, member_name):
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(member_name, 'w', force_zip64=True) as member:
+            for chunk in chunks:
+                member.write(chunk)
+                data = sink.drain()
+                if data:
+                    yield data
+    yield sink.drain()
+
 @app.route('/exportar', methods=['POST'])
 def exportar():
-    ids = set(request.get_json().get('ids', []))
+    """
+    Streams the selected protocols as a text file. `compress` may be 'gzip' or
+    'zip' (in the JSON body or the query string) to get a compressed download.
+    """
+    data = request.get_json()
+    ids = set()
+    for pid in data.get('ids', []):
+        try:
+            ids.add(parse_protocol_id(pid))
+        except (ValueError, AttributeError):
+            continue
     if not ids:
         return '', 400
 
-    blocos = []
-    for pid in sorted(list(ids)):
-        details = get_single_protocol_details(pid)
-        if details and details['content']:
-            blocos.append(f"---\"{pid}\"---{details['content']}")
-            
-    file_content = '\n\n'.join(blocos)
+    compress = data.get('compress') or request.args.get('compress')
     now = datetime.datetime.now()
     filename = f"Exportados {now.strftime('%d-%m-%Y %H-%M')}.txt"
-    
-    buf = io.BytesIO(file_content.encode('utf-8'))
-    buf.seek(0)
-    
-    return send_file(buf, as_attachment=True, download_name=filename, mimetype='text/plain')
+    chunks = (block.encode('utf-8') for block in iter_export_blocks(sorted(ids)))
+
+    if compress == 'gzip':
+        body, mimetype, filename = gzip_stream(chunks), 'application/gzip', filename + '.gz'
+    elif compress == 'zip':
+        body, mimetype = zip_stream(chunks, filename), 'application/zip'
+        filename = filename[:-len('.txt')] + '.zip'
+    else:
+        body, mimetype = chunks, 'text/plain; charset=utf-8'
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+def deploy_authorized():
+    token = request.headers.get('X-Deploy-Token', '')
+    # Compared as bytes: compare_digest refuses str with non-ASCII characters.
+    return bool(DEPLOY_TOKEN) and hmac.compare_digest(token.encode('utf-8'), DEPLOY_TOKEN.encode('utf-8'))
+
+@app.route('/admin/deploy')
+def deploy_status():
+    if not deploy_authorized():
+        return '', 404
+    return jsonify({'applied_seq': get_applied_seq(DB_NAME)})
+
+@app.route('/admin/deploy/changeset', methods=['POST'])
+def deploy_changeset():
+    """Applies an incremental changeset built by deploy_db.py to the live database."""
+    if not deploy_authorized():
+        return '', 404
+    try:
+        summary = apply_changeset(DB_NAME, read_changeset(request.get_data()))
+    except DeployError as e:
+        return jsonify({'error': str(e)}), 409
+    result_cache.clear()
+    return jsonify(summary)
+
+@app.route('/admin/deploy/snapshot', methods=['POST'])
+def deploy_snapshot():
+    """
+    Receives a full database snapshot (gzip'd, with its manifest in the
+    X-Snapshot-Manifest header), verifies it and swaps it in for the live one.
+    """
+    if not deploy_authorized():
+        return '', 404
+    # Checked before the body is read, so a bad header does not cost the whole upload.
+    manifest = request.headers.get('X-Snapshot-Manifest')
+    try:
+        manifest = json.loads(manifest) if manifest else None
+    except ValueError:
+        return jsonify({'error': 'X-Snapshot-Manifest is not valid JSON.'}), 400
+    if manifest is not None and not isinstance(manifest, dict):
+        return jsonify({'error': 'X-Snapshot-Manifest must be a JSON object.'}), 400
+    fd, upload_path = tempfile.mkstemp(prefix='.upload-', dir=os.path.dirname(os.path.abspath(DB_NAME)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = request.stream.read(1024 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+        summary = install_snapshot(DB_NAME, upload_path, manifest)
+    except DeployError as e:
+        return jsonify({'error': str(e)}), 409
+    finally:
+        os.remove(upload_path)
+    result_cache.clear()
+    return jsonify(summary)
 
 @app.route('/api/db_last_update')
 def db_last_update():
@@ -1,6 +1,21 @@
+import json
 import sqlite3
+import sys
+import time
 import unicodedata
 
+from db_meta import ensure_meta
+
+# --- Configuração ---
+CONFIG_FILE = 'config.json'
+WATERMARK_KEY = 'archive_protocols.watermark'
+RULE_PHRASE = "conforme andamento arquiva-se o protocolo"
+# Consulta FTS equivalente à frase da regra (o tokenizer separa "arquiva-se" em duas palavras).
+RULE_FTS_QUERY = '"conforme andamento arquiva se o protocolo"'
+PROGRESS_EVERY = 5000
+# Espera pelo lock de escrita em vez de falhar na hora quando outra conexão está gravando.
+BUSY_TIMEOUT = 30
+
 def normalize_text(text):
     """
     Normaliza o texto: minúsculas, remove acentos, vírgulas e pontos.
@@ -14,69 +29,115 @@ def normalize_text(text):
     normalized = text_sem_acentos.lower().replace(',', '').replace('.', '')
     return normalized
 
-def archive_protocols():
+def get_db_name():
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get('database_name', 'protocols.db')
+    except FileNotFoundError:
+        return 'protocols.db'
+
+def get_watermark(conn):
+    ensure_meta(conn)
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (WATERMARK_KEY,)).fetchone()
+    return row[0] if row else None
+
+def fts_available(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'protocols_fts'").fetchone() is not None
+
+def archive_protocols(db_name=None, full=False, use_fts=False):
     """
-    Lê o banco de dados 'protocols.db', verifica o conteúdo de cada protocolo
+    Verifica os protocolos ainda não arquivados que mudaram desde a última execução
     e atualiza o campo 'Arquivado' se a regra for atendida.
+
+    A marca d'água é o maior 'retrieved_at' já verificado (guardado na tabela meta);
+    com full=True todos os protocolos não arquivados são verificados de novo. Com
+    use_fts=True o índice FTS seleciona os candidatos e o texto só é normalizado
+    para confirmar a regra. Retorna o número de protocolos atualizados; erros do
+    banco são mostrados e repassados para quem chamou.
     """
-    db_name = 'protocols.db'
+    db_name = db_name or get_db_name()
     updated_count = 0
-    
+
     print(f"Conectando ao banco de dados '{db_name}'...")
     try:
-        conn = sqlite3.connect(db_name)
+        conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT)
         # Usar row_factory para acessar colunas pelo nome
         conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
 
-        print("Lendo todos os protocolos...")
-        cursor.execute("SELECT rowid, content, Arquivado FROM protocols")
-        
-        rows = cursor.fetchall()
-        total_rows = len(rows)
-        print(f"Total de {total_rows} protocolos encontrados.")
+        watermark = None if full else get_watermark(conn)
+        # Teto fixado no início: o que for gravado durante a execução fica para a próxima.
+        new_watermark = conn.execute("SELECT MAX(retrieved_at) FROM protocols").fetchone()[0]
 
-        protocols_to_update = []
+        where = ["p.Arquivado = 'no'"]
+        params = []
+        if watermark is not None:
+            where.append("p.retrieved_at > ?")
+            params.append(watermark)
+        if new_watermark is not None:
+            where.append("(p.retrieved_at <= ? OR p.retrieved_at IS NULL)")
+            params.append(new_watermark)
 
-        for row in rows:
-            content = row['content']
-            
-            # Pula se o conteúdo for nulo ou vazio
-            if not content:
-                continue
-
-            # Normaliza o conteúdo para a verificação
-            normalized_content = normalize_text(content)
-            
-            # Condição para arquivamento
-            rule_phrase = "conforme andamento arquiva-se o protocolo"
-            
-            # O campo 'Arquivado' já está como 'yes'?
-            is_already_archived = row['Arquivado'] == 'yes'
-
-            # Se a regra for encontrada e o protocolo ainda não estiver arquivado
-            if rule_phrase in normalized_content and not is_already_archived:
+        from_clause = "FROM protocols p"
+        if use_fts:
+            if fts_available(conn):
+                from_clause = "FROM protocols_fts f JOIN protocols p ON p.rowid = f.rowid"
+                where.append("protocols_fts MATCH ?")
+                params.append(RULE_FTS_QUERY)
+            else:
+                print("Índice FTS não encontrado; verificando o texto de todos os candidatos.")
+
+        since = f"alterados desde {watermark}" if watermark else "todos"
+        print(f"Verificando protocolos não arquivados ({since})...")
+
+        protocols_to_update = []
+        checked = 0
+        start = time.monotonic()
+        # O cursor é percorrido aos poucos: só os protocolos a atualizar ficam em memória.
+        for row in conn.execute(f"SELECT p.rowid, p.content {from_clause} WHERE {' AND '.join(where)}", params):
+            checked += 1
+            if row['content'] and RULE_PHRASE in normalize_text(row['content']):
                 protocols_to_update.append((row['rowid'],))
-                print(f"  - Protocolo (rowid: {row['rowid']}) marcado para arquivamento.")
-        
+            if checked % PROGRESS_EVERY == 0:
+                elapsed = time.monotonic() - start
+                print(f"  {checked} protocolos verificados ({checked / elapsed:.0f}/s), {len(protocols_to_update)} a arquivar...")
+
+        elapsed = time.monotonic() - start
+        rate = checked / elapsed if elapsed > 0 else 0
+        print(f"{checked} protocolos verificados em {elapsed:.1f}s ({rate:.0f}/s).")
+
+        with conn:
+            if protocols_to_update:
+                print(f"\nAtualizando {len(protocols_to_update)} protocolos no banco de dados...")
+                update_query = "UPDATE protocols SET Arquivado = 'yes' WHERE rowid = ?"
+                updated_count = conn.executemany(update_query, protocols_to_update).rowcount
+            if new_watermark is not None:
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (WATERMARK_KEY, new_watermark))
+
         if not protocols_to_update:
             print("\nNenhum protocolo precisou ser atualizado.")
         else:
-            print(f"\nAtualizando {len(protocols_to_update)} protocolos no banco de dados...")
-            
-            update_query = "UPDATE protocols SET Arquivado = 'yes' WHERE rowid = ?"
-            cursor.executemany(update_query, protocols_to_update)
-            
-            conn.commit()
-            updated_count = cursor.rowcount
             print(f"Concluído! {updated_count} protocolos foram atualizados para 'Arquivado = yes'.")
 
     except sqlite3.Error as e:
         print(f"Erro ao acessar o banco de dados: {e}")
+        raise
     finally:
         if 'conn' in locals() and conn:
             conn.close()
             print("Conexão com o banco de dados fechada.")
+    return updated_count
 
 if __name__ == "__main__":
-    archive_protocols()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Marca como arquivados os protocolos que atendem à regra de arquivamento.")
+    parser.add_argument('--db', help="Banco de dados (padrão: database_name do config.json).")
+    parser.add_argument('--full', action='store_true', help="Ignora a marca d'água e verifica todos os não arquivados.")
+    parser.add_argument('--fts', action='store_true', help="Usa o índice FTS para encontrar os candidatos.")
+    args = parser.parse_args()
+
+    try:
+        archive_protocols(args.db, full=args.full, use_fts=args.fts)
+    except sqlite3.Error:
+        # Código de saída diferente de zero para o update_and_deploy.py registrar a falha.
+        sys.exit(1)
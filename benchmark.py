@@ -0,0 +1,387 @@
+"""
+Benchmarks the web app and the text helpers against synthetic databases:
+
+    python benchmark.py --sizes 10000 100000 --out benchmark_results.json
+    python benchmark.py --sizes 1000000 --workdir /tmp/bench --compare benchmark_results.json
+
+For every size a protocols.db is generated (once; it is reused while the
+generator version matches) from templates shaped like the portal's protocol
+text, through the scraper's own ingest path (keyword index, highlights) and
+with the FTS index built by setup_fts.py. Every route and helper is then run
+through Flask's test client with several filter combinations, and p50/p95
+latency, rows per second and peak Python memory are written to a JSON file
+that later runs can be compared against.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GENERATOR_VERSION = 2
+GENERATOR_KEY = 'benchmark.generator'
+INSERT_BATCH = 5000
+REMOVED_FRACTION = 0.01
+
+DEPARTMENTS = [
+    'SEMMAS - Diretoria Geral', 'SEMMAS - Bem Estar Animal', 'SEPLAN - SRU - Gerência de Regulação Urbana',
+    'SEPLAN - SRU - Instrução de Processo', 'SEDECI - Diretoria de Defesa Civil',
+    'SEDECI - Gerência de Operações e Fiscalização de Áreas de Risco', 'SEMOB - Diretoria Geral',
+    'SEMOB - Fiscalização de Trânsito', 'SEOB - Manutenção de Vias', 'SAMAE - Atendimento', 'Ouvidoria',
+]
+SUBJECTS = [
+    'Atendimento urgência e emergência', 'Alvará de construção', 'Manutenção de via', 'Iluminação pública',
+    'Poda de árvore', 'Estacionamento irregular', 'Perturbação do sossego', 'Limpeza de terreno',
+    'Falta de água', 'Sinalização viária',
+]
+OTHER_STREETS = [
+    'Rua XV de Novembro', 'Rua São Paulo', 'Rua Amazonas', 'Rua Itajaí', 'Rua Bahia', 'Rua Antônio da Veiga',
+    'Rua Dois de Setembro', 'Rua Almirante Barroso', 'Rua João Pessoa', 'Rua Pastor Oswaldo Hesse',
+]
+NEIGHBOURHOODS = ['BOM RETIRO', 'CENTRO', 'VELHA', 'ITOUPAVA NORTE', 'GARCIA', 'VILA NOVA', 'PONTA AGUDA']
+REQUESTS = [
+    'Solicita reparo no pavimento, há buracos grandes na pista.',
+    'Relata que a lâmpada do poste está queimada há semanas.',
+    'Pede vistoria em árvore com risco de queda sobre a calçada.',
+    'Denuncia veículos estacionados sobre a calçada todos os dias.',
+    'Informa vazamento de água na calçada em frente ao número indicado.',
+    'Relata som alto durante a madrugada em estabelecimento comercial.',
+]
+DISPATCHES = [
+    'Encaminha-se ao setor responsável para providências.',
+    'Demanda registrada na programação de serviços.',
+    'Vistoria realizada, aguardando equipe de manutenção.',
+    'Solicitamos esclarecimentos ao requerente.',
+]
+ARCHIVE_DISPATCH = 'Conforme andamento arquiva-se o protocolo.'
+
+
+def protocol_text(rng, year, number, streets):
+    """One protocol in the portal's layout: header, situation, subject, synthesis and routing history."""
+    received = date(year, 1, 1) + timedelta(days=rng.randrange(330))
+    archived = rng.random() < 0.45
+    street = rng.choice(streets)
+    lines = [f"Processo: Ouvidoria {year}/{number} Vol. 1", ""]
+    if archived:
+        lines.append(f"Situação Arquivo em {received:%d/%m/%Y}, recebido em {received:%d/%m/%Y} por Departamento Ouvidoria")
+        lines.append(f"Despacho em {received:%d/%m/%Y}")
+        lines.append(ARCHIVE_DISPATCH)
+    else:
+        lines.append(f"Situação Em andamento, recebido em {received:%d/%m/%Y} por Departamento Ouvidoria")
+    lines.append(f"Assunto: {rng.choice(SUBJECTS)}")
+    lines.append(f"Síntese: {rng.choice(SUBJECTS)} na {street}, {rng.randrange(1, 3000)} "
+                 f"[{rng.choice(NEIGHBOURHOODS)}]. {' '.join(rng.sample(REQUESTS, 2))}")
+    if rng.random() < 0.03:
+        lines.append("Encaminhar cópia à AMABRE - Associação de Moradores do Bom Retiro.")
+    if archived:
+        lines.append(f"Despacho: {ARCHIVE_DISPATCH}")
+    lines += ["", "Encaminhamentos"]
+    day = received
+    for step in range(1, rng.randrange(2, 8)):
+        day += timedelta(days=rng.randrange(0, 20))
+        entry = f"{step} {rng.choice(DEPARTMENTS)} em {day:%d/%m/%Y};"
+        if rng.random() < 0.6:
+            entry += f" Despacho: {rng.choice(DISPATCHES)}"
+        lines.append(entry)
+    if archived:
+        lines.append(f"{step + 1} Ouvidoria em {day:%d/%m/%Y}; Despacho: {ARCHIVE_DISPATCH}")
+    return "\n".join(lines)
+
+def generate_db(path, size, seed=1):
+    """Builds a database of `size` protocols spread over five years, with the keyword index and FTS."""
+    import setup_fts
+    from enhanced_protocol_scraper import DatabaseManager, classify_content
+    from keyword_index import get_indexed_keywords
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    keywords = get_indexed_keywords(config.get('lista_original', []), config.get('familias', {}))
+    # Keyword streets show up in about a third of the protocols, like in the real data.
+    streets = OTHER_STREETS * 2 + [f"Rua {name}" for name in config.get('lista_original', []) if name != 'AMABRE']
+    rng = random.Random(seed)
+
+    if os.path.exists(path):
+        os.remove(path)
+    started = time.perf_counter()
+    with DatabaseManager(path, keywords=keywords) as db:
+        db.init_db()
+        per_year = math.ceil(size / 5)
+        batch = []
+        for i in range(size):
+            year, number = 2021 + i // per_year, i % per_year + 1
+            content = protocol_text(rng, year, number, streets)
+            batch.append((year, number, content) + classify_content(content))
+            if len(batch) >= INSERT_BATCH:
+                db.insert_protocols(batch)
+                batch = []
+        if batch:
+            db.insert_protocols(batch)
+        # The change log is for deploys; a freshly generated corpus has nothing to ship.
+        db.conn.execute("DELETE FROM protocol_changes")
+        db.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                        (GENERATOR_KEY, json.dumps({'version': GENERATOR_VERSION, 'size': size, 'seed': seed})))
+        db.conn.commit()
+    ingest_seconds = time.perf_counter() - started
+
+    setup_fts.DB_NAME = path
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        setup_fts.setup_fts()
+    return {'ingest_seconds': round(ingest_seconds, 2), 'ingest_rows_per_s': round(size / ingest_seconds),
+            'fts_build_seconds': round(time.perf_counter() - started, 2)}
+
+def existing_generator(path):
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (GENERATOR_KEY,)).fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+def mark_removed(removidos_db, protocols_db, seed=1):
+    """Hides REMOVED_FRACTION of the protocols, so the removals anti-join has work to do."""
+    source = sqlite3.connect(protocols_db)
+    keys = source.execute("SELECT year, number FROM protocols").fetchall()
+    source.close()
+    removed = random.Random(seed).sample(keys, int(len(keys) * REMOVED_FRACTION))
+    conn = sqlite3.connect(removidos_db)
+    with conn:
+        conn.execute("DELETE FROM removidos")
+        conn.executemany("INSERT OR IGNORE INTO removidos (year, number) VALUES (?, ?)", removed)
+    conn.close()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def measure(run, iterations, before=None):
+    """
+    Calls run() `iterations` times (before() runs untimed ahead of each call) and
+    reports latency percentiles, rows per second and, from one more call under
+    tracemalloc, the peak Python allocation. run() returns the rows it produced.
+    """
+    latencies, rows = [], 0
+    for _ in range(iterations):
+        if before:
+            before()
+        started = time.perf_counter()
+        rows += run()
+        latencies.append(time.perf_counter() - started)
+    if before:
+        before()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'iterations': iterations,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'rows': rows // iterations,
+        'rows_per_s': round(rows / total) if total else None,
+        'peak_mem_kb': round(peak / 1024),
+    }
+
+def run_cases(app_module, protocols_db, iterations):
+    import archive_protocols
+    from keyword_index import find_keyword_spans
+
+    client = app_module.app.test_client()
+    cold = app_module.result_cache.clear
+
+    def api(query):
+        def run():
+            response = client.get('/api/protocols?' + query)
+            assert response.status_code == 200, response.status_code
+            return len(response.get_json()['protocols'])
+        return run
+
+    def ndjson(query):
+        def run():
+            return client.get('/api/protocols?format=ndjson&' + query).get_data().count(b'\n')
+        return run
+
+    conn = sqlite3.connect(protocols_db)
+    rng = random.Random(7)
+    keys = conn.execute("SELECT year, number FROM protocols").fetchall()
+    keyword_keys = conn.execute("SELECT DISTINCT year, number FROM protocol_keywords LIMIT 2000").fetchall()
+    sample_contents = [row[0] for row in conn.execute("SELECT content FROM protocols ORDER BY random() LIMIT 200")]
+    conn.close()
+    detail_ids = [f"{y}/{str(n).zfill(5)}" for y, n in rng.sample(keyword_keys or keys, min(50, len(keyword_keys or keys)))]
+    export_ids = [f"{y}/{str(n).zfill(5)}" for y, n in rng.sample(keys, min(200, len(keys)))]
+
+    first_page = client.get('/api/protocols?filter_keywords=true').get_json()
+    cursor = first_page['next_cursor'] or ''
+
+    detail_iter = iter(detail_ids * (iterations + 2))
+    def detail(search=''):
+        def run():
+            response = client.get('/protocolo', query_string={'id': next(detail_iter), 'search': search})
+            return 1 if response.status_code == 200 else 0
+        return run
+
+    def export(compress=None):
+        def run():
+            response = client.post('/exportar', json={'ids': export_ids, 'compress': compress})
+            response.get_data()
+            return len(export_ids)
+        return run
+
+    spans = [[(start, end) for _, start, end in find_keyword_spans(text, app_module.LISTA_NORMALIZADA)]
+             for text in sample_contents]
+
+    def highlight():
+        for text, text_spans in zip(sample_contents, spans):
+            app_module.highlight(text, text_spans)
+        return len(sample_contents)
+
+    def keyword_spans():
+        for text in sample_contents:
+            find_keyword_spans(text, app_module.LISTA_NORMALIZADA)
+        return len(sample_contents)
+
+    def archive(use_fts):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                archive_protocols.archive_protocols(protocols_db, full=True, use_fts=use_fts)
+            return len(keys)
+        return run
+
+    def facets():
+        data = client.get('/api/facets').get_json()
+        return len(data['departamentos']) + len(data['assuntos'])
+
+    slow = max(1, iterations // 5)
+    cases = {
+        'api_protocols.default': (api(''), iterations, cold),
+        'api_protocols.default.cached': (api(''), iterations, None),
+        'api_protocols.notarch.desc': (api('status=notarch&sort_order=desc'), iterations, cold),
+        'api_protocols.keywords': (api('filter_keywords=true'), iterations, cold),
+        'api_protocols.keywords.page2': (api('filter_keywords=true&after=' + cursor), iterations, cold),
+        'api_protocols.amabre': (api('amabre=true'), iterations, cold),
+        'api_protocols.search_word': (api('search=hering'), iterations, cold),
+        'api_protocols.search_phrase': (api('search=%22bom+retiro%22'), iterations, cold),
+        'api_protocols.search_prefix': (api('search=emmend*'), iterations, cold),
+        'api_protocols.search_arch_keywords': (api('search=calçada&status=arch&filter_keywords=true'), iterations, cold),
+        'api_protocols.departamento_range': (api('departamento=Ouvidoria&date_from=2023-01-01&date_to=2023-06-30'), iterations, cold),
+        'api_protocols.assunto': (api('assunto=Falta+de+%C3%A1gua'), iterations, cold),
+        'api_protocols.sort_date.desc': (api('sort_by=date&sort_order=desc'), iterations, cold),
+        'api_facets': (facets, iterations, cold),
+        'api_protocols.ndjson.keywords': (ndjson('filter_keywords=true'), slow, None),
+        'api_protocols.ndjson.all': (ndjson(''), slow, None),
+        'protocolo': (detail(), iterations, None),
+        'protocolo.search': (detail('"bom retiro" OR calçada'), iterations, None),
+        'exportar.text': (export(), iterations, None),
+        'exportar.gzip': (export('gzip'), iterations, None),
+        'exportar.zip': (export('zip'), iterations, None),
+        'highlight': (highlight, iterations, None),
+        'find_keyword_spans': (keyword_spans, iterations, None),
+        'archive_protocols.full': (archive(False), slow, None),
+        'archive_protocols.full_fts': (archive(True), slow, None),
+    }
+
+    results = {}
+    for name, (run, count, before) in cases.items():
+        results[name] = measure(run, count, before)
+        print(f"  {name:<40} p50 {results[name]['p50_ms']:>10.2f} ms  p95 {results[name]['p95_ms']:>10.2f} ms  "
+              f"{results[name]['rows_per_s'] or 0:>10} rows/s  {results[name]['peak_mem_kb']:>8} KB")
+    return results
+
+def max_rss_kb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def compare(previous, current):
+    """Prints the p50 change of every case present in both result files."""
+    print("\nComparison with the previous results (p50):")
+    for size, data in current['sizes'].items():
+        old_cases = previous.get('sizes', {}).get(size, {}).get('cases', {})
+        for name, result in data['cases'].items():
+            old = old_cases.get(name)
+            if old and old['p50_ms']:
+                print(f"  {size:>8} {name:<40} {old['p50_ms']:>10.2f} -> {result['p50_ms']:>10.2f} ms "
+                      f"({(result['p50_ms'] / old['p50_ms'] - 1) * 100:+.0f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks app.py and the text helpers on synthetic databases.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='Corpus sizes (protocols).')
+    parser.add_argument('--workdir', default=os.path.join(REPO_DIR, 'benchmark_data'),
+                        help='Where the generated databases are kept between runs.')
+    parser.add_argument('--iterations', type=int, default=20, help='Timed calls per case.')
+    parser.add_argument('--out', default='benchmark_results.json', help='Machine-readable results.')
+    parser.add_argument('--compare', help='Previous results file to compare against.')
+    parser.add_argument('--regenerate', action='store_true', help='Rebuild the databases even if they are current.')
+    args = parser.parse_args()
+
+    out_path = os.path.abspath(args.out)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    os.makedirs(args.workdir, exist_ok=True)
+    with open(os.path.join(REPO_DIR, 'config.json'), 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    # The modules read config.json from the working directory at import time, so
+    # they are imported from the work directory with a config pointing at it.
+    removidos_db = os.path.join(os.path.abspath(args.workdir), 'removidos.db')
+    config.update(database_name=os.path.join(os.path.abspath(args.workdir), f'protocols_{args.sizes[0]}.db'),
+                  removidos_database=removidos_db)
+    os.chdir(args.workdir)
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+
+    results = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'iterations': args.iterations,
+        'sizes': {},
+    }
+    for size in args.sizes:
+        path = os.path.abspath(f'protocols_{size}.db')
+        build = None
+        if args.regenerate or existing_generator(path) != {'version': GENERATOR_VERSION, 'size': size, 'seed': 1}:
+            print(f"Generating {size} protocols in {path}...")
+            build = generate_db(path, size)
+            print(f"  ingest {build['ingest_seconds']}s ({build['ingest_rows_per_s']} rows/s), FTS {build['fts_build_seconds']}s")
+        mark_removed(removidos_db, path)
+
+        app_module.DB_NAME = path
+        app_module.result_cache.clear()
+        print(f"Benchmarking {size} protocols...")
+        results['sizes'][str(size)] = {
+            'db_bytes': os.path.getsize(path),
+            'build': build,
+            'cases': run_cases(app_module, path, args.iterations),
+            'max_rss_kb': max_rss_kb(),
+        }
+
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {out_path}")
+
+    if compare_path:
+        with open(compare_path, 'r', encoding='utf-8') as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import gzip
+import json
+import sqlite3
+
+from db_meta import ensure_meta, table_exists
+
+# --- Configuração ---
+# Tabelas com uma linha (ou várias) por protocolo, todas com as colunas year e number.
+# Uma alteração em qualquer uma delas faz o protocolo entrar no próximo deploy incremental.
+TRACKED_TABLES = ['protocols', 'protocol_keywords', 'protocol_highlights', 'protocol_fields', 'protocol_steps']
+LOG_START_KEY = 'deploy.log_start'
+CHANGESET_FORMAT = 1
+CHUNK_SIZE = 400
+
+
+def init_change_log(conn):
+    """
+    Cria a tabela protocol_changes e os triggers que anotam nela cada linha
+    inserida, alterada ou apagada nas tabelas de TRACKED_TABLES que existirem.
+    O log só é completo a partir do momento em que os triggers foram criados;
+    esse ponto fica em meta (LOG_START_KEY).
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS protocol_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            year INTEGER NOT NULL,
+            number INTEGER NOT NULL
+        );
+    """)
+    ensure_meta(conn)
+    for table in TRACKED_TABLES:
+        if not table_exists(conn, table):
+            continue
+        conn.executescript(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_log_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO protocol_changes (year, number) VALUES (new.year, new.number);
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_log_au AFTER UPDATE ON {table} BEGIN
+                INSERT INTO protocol_changes (year, number) VALUES (new.year, new.number);
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_log_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO protocol_changes (year, number) VALUES (old.year, old.number);
+            END;
+        """)
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (LOG_START_KEY, str(current_seq(conn))))
+
+def current_seq(conn):
+    """Último número de sequência usado no log (não volta atrás quando o log é podado)."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'protocol_changes'").fetchone()
+    return row[0] if row else 0
+
+def log_start(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (LOG_START_KEY,)).fetchone()
+    return int(row[0]) if row else None
+
+def can_build_delta(conn, since_seq):
+    """O log cobre tudo o que mudou depois de since_seq?"""
+    start = log_start(conn)
+    return since_seq is not None and start is not None and start <= since_seq <= current_seq(conn)
+
+def build_changeset(conn, since_seq):
+    """
+    Monta o changeset com o estado atual, em todas as tabelas rastreadas, dos
+    protocolos alterados depois de since_seq. Protocolos apagados aparecem em
+    'keys' sem linhas, e o apply os apaga no destino.
+    """
+    to_seq = current_seq(conn)
+    keys = [list(key) for key in conn.execute(
+        "SELECT DISTINCT year, number FROM protocol_changes WHERE seq > ? ORDER BY year, number", (since_seq,)
+    )]
+    tables = {}
+    for table in TRACKED_TABLES:
+        if not table_exists(conn, table):
+            continue
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        rows = []
+        for i in range(0, len(keys), CHUNK_SIZE):
+            chunk = keys[i:i + CHUNK_SIZE]
+            values = ", ".join("(?, ?)" for _ in chunk)
+            rows.extend(list(row) for row in conn.execute(
+                f"SELECT {', '.join(columns)} FROM {table} WHERE (year, number) IN (VALUES {values})",
+                [value for key in chunk for value in key]
+            ))
+        tables[table] = {'columns': columns, 'rows': rows}
+    return {
+        'format': CHANGESET_FORMAT,
+        'base_seq': since_seq,
+        'to_seq': to_seq,
+        'keys': keys,
+        'tables': tables,
+    }
+
+def encode_changeset(changeset):
+    return gzip.compress(json.dumps(changeset, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+def mark_deployed(conn, seq):
+    """Depois de um deploy bem-sucedido até seq, poda o log e avança o seu início."""
+    with conn:
+        conn.execute("DELETE FROM protocol_changes WHERE seq <= ?", (seq,))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (LOG_START_KEY, str(seq)))
+
+
+if __name__ == '__main__':
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    conn = sqlite3.connect(config.get('database_name', 'protocols.db'))
+    try:
+        init_change_log(conn)
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT year, number FROM protocol_changes WHERE seq > ?)", (log_start(conn),)
+        ).fetchone()[0]
+        print(f"Log de alterações ativo (início em {log_start(conn)}, último {current_seq(conn)}): {pending} protocolos alterados.")
+    finally:
+        conn.close()
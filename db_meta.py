@@ -0,0 +1,15 @@
+"""
+Helpers comuns do banco: checagem de tabelas e a tabela 'meta' (chave/valor)
+onde os scripts guardam versões e marcas d'água. Usado também no servidor
+(app.py e deploy_target.py), então precisa ir junto com eles.
+"""
+
+
+def table_exists(conn, name):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+def ensure_meta(conn):
+    """Cria a tabela 'meta' se ainda não existir (bancos antigos ou recém-criados)."""
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
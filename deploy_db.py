@@ -2,9 +2,21 @@ import requests
 import os
 import json
 import glob
+import gzip
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from change_log import build_changeset, can_build_delta, current_seq, encode_changeset, init_change_log, mark_deployed
+from deploy_target import (
+    APPLIED_SEQ_KEY, SNAPSHOT_FORMAT, DeployError, apply_changeset, file_sha256, get_applied_seq, install_snapshot,
+    read_changeset,
+)
 
 CONFIG_FILE = 'deploy_config.json'
 LOCAL_DB_NAME = 'protocols.db'
+DEFAULT_DELTA_MAX_PROTOCOLS = 20000
 
 
 def split_file(file_path, chunk_size_mb=99):
@@ -81,11 +93,21 @@ def run_upload():
         print(f"Erro: O arquivo de banco de dados não foi encontrado em '{local_db_path}'")
         return
 
-    # 1. Dividir o arquivo localmente
-    db_parts = split_file(local_db_path)
-    if not db_parts:
-        print("Nenhuma parte foi criada. Verifique se o arquivo original não está vazio.")
-        return
+    # 1. Gerar o snapshot compactado (com manifest) e dividi-lo localmente
+    print("Gerando snapshot compactado...")
+    conn = sqlite3.connect(local_db_path, timeout=30)
+    try:
+        init_change_log(conn)
+        snapshot_seq = current_seq(conn)
+        snapshot_path, manifest = create_snapshot(conn, snapshot_seq)
+    finally:
+        conn.close()
+    print(f"Snapshot: {manifest['size'] / (1024 * 1024):.1f} MB (banco original: {os.path.getsize(local_db_path) / (1024 * 1024):.1f} MB).")
+    manifest_path = os.path.join(os.path.dirname(snapshot_path), 'protocols-snapshot.json')
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    db_parts = split_file(snapshot_path) + [manifest_path]
 
     # Diretório de destino no PythonAnywhere
     pa_directory = os.path.dirname(pa_path)
@@ -136,23 +158,34 @@ def run_upload():
             print(f" -> Removido: {os.path.basename(part_path)}")
         except OSError as e:
             print(f"Erro ao remover {part_path}: {e}")
+    remove_snapshot(snapshot_path)
     print("Limpeza concluída.")
 
     # 4. Instruções finais se tudo deu certo
     if all_uploads_succeeded:
+        # O snapshot já contém tudo até snapshot_seq: poda o log para ele não crescer sem fim.
+        conn = sqlite3.connect(local_db_path, timeout=30)
+        try:
+            mark_deployed(conn, snapshot_seq)
+        finally:
+            conn.close()
+
         print("\n\n--- AÇÃO NECESSÁRIA ---")
         print("Todos os arquivos foram enviados com sucesso!")
         print("Agora, você precisa juntar os arquivos no PythonAnywhere.")
         print("1. Abra um console Bash no PythonAnywhere.")
         print(f"2. Navegue até o diretório: cd {pa_directory}")
         
-        part_names_for_cat = " ".join([os.path.basename(p) for p in db_parts])
+        part_names_for_cat = " ".join([os.path.basename(p) for p in db_parts[:-1]])
+        snapshot_name = os.path.basename(snapshot_path)
         db_filename = os.path.basename(pa_path)
         
-        print(f"3. Execute o comando abaixo para juntar os arquivos:")
-        print(f"   cat {part_names_for_cat} > {db_filename}")
-        print(f"4. (Opcional) Após juntar, você pode remover as partes do servidor com:")
-        print(f"   rm {part_names_for_cat}")
+        print(f"3. Execute os comandos abaixo para juntar as partes e instalar o snapshot")
+        print(f"   (o deploy_target.py confere os checksums e troca o banco de forma atômica):")
+        print(f"   cat {part_names_for_cat} > {snapshot_name}")
+        print(f"   python deploy_target.py install {snapshot_name} --manifest {os.path.basename(manifest_path)} --db {db_filename}")
+        print(f"4. (Opcional) Depois, você pode remover as partes do servidor com:")
+        print(f"   rm {part_names_for_cat} {snapshot_name}")
         
         # Recarrega a aplicação web
         reload_webapp(username, api_token, webapp_domain)
@@ -160,6 +193,183 @@ def run_upload():
         print("\nO deploy falhou porque um ou mais arquivos não puderam ser enviados.")
 
 
+class LocalTarget:
+    """Diretório local fazendo papel de servidor (testes, ou um servidor com o disco montado)."""
+    def __init__(self, directory):
+        self.db_path = os.path.join(directory, os.path.basename(LOCAL_DB_NAME))
+
+    def __str__(self):
+        return self.db_path
+
+    def status(self):
+        return get_applied_seq(self.db_path)
+
+    def apply(self, changeset_bytes):
+        return apply_changeset(self.db_path, read_changeset(changeset_bytes))
+
+    def install(self, snapshot_path, manifest):
+        return install_snapshot(self.db_path, snapshot_path, manifest)
+
+
+class HttpTarget:
+    """Endpoint /admin/deploy do app.py no servidor (precisa do mesmo deploy_token dos dois lados)."""
+    def __init__(self, url, token):
+        self.url = url.rstrip('/') + '/admin/deploy'
+        self.headers = {'X-Deploy-Token': token}
+
+    def __str__(self):
+        return self.url
+
+    def _check(self, response):
+        if response.status_code == 409:
+            raise DeployError(response.json().get('error', response.text))
+        response.raise_for_status()
+        return response.json()
+
+    def status(self):
+        return self._check(requests.get(self.url, headers=self.headers, timeout=60)).get('applied_seq')
+
+    def apply(self, changeset_bytes):
+        headers = dict(self.headers, **{'Content-Type': 'application/gzip'})
+        return self._check(requests.post(f"{self.url}/changeset", data=changeset_bytes, headers=headers, timeout=300))
+
+    def install(self, snapshot_path, manifest):
+        headers = dict(self.headers, **{'Content-Type': 'application/gzip', 'X-Snapshot-Manifest': json.dumps(manifest)})
+        with open(snapshot_path, 'rb') as f:
+            return self._check(requests.post(f"{self.url}/snapshot", data=f, headers=headers, timeout=1800))
+
+
+def get_deploy_target(config):
+    if config.get('deploy_target_dir'):
+        return LocalTarget(config['deploy_target_dir'])
+    if config.get('deploy_target_url'):
+        return HttpTarget(config['deploy_target_url'], config.get('deploy_token', ''))
+    return None
+
+def create_snapshot(conn, seq, compresslevel=6):
+    """
+    Gera o artefato de um deploy completo e retorna (caminho do .db.gz, manifest):
+    1. VACUUM INTO: cópia consistente e sem páginas livres;
+    2. na cópia: marca até onde ela está atualizada (seq), limpa o log de alterações
+       e junta os segmentos do índice FTS ('optimize'), depois compacta de novo;
+    3. gzip, com o SHA-256 do arquivo compactado e do banco no manifest.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='protocols-snapshot-')
+    db_path = os.path.join(tmp_dir, 'protocols-snapshot.db')
+    gz_path = db_path + '.gz'
+
+    conn.execute("VACUUM INTO ?", (db_path,))
+    snapshot = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        snapshot.execute("BEGIN")
+        snapshot.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (APPLIED_SEQ_KEY, str(seq)))
+        snapshot.execute("DELETE FROM protocol_changes")
+        if snapshot.execute("SELECT 1 FROM sqlite_master WHERE name = 'protocols_fts'").fetchone():
+            snapshot.execute("INSERT INTO protocols_fts(protocols_fts) VALUES('optimize')")
+        snapshot.execute("COMMIT")
+        snapshot.execute("VACUUM")
+    finally:
+        snapshot.close()
+
+    with open(db_path, 'rb') as src, gzip.open(gz_path, 'wb', compresslevel=compresslevel) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'file': os.path.basename(gz_path),
+        'size': os.path.getsize(gz_path),
+        'sha256': file_sha256(gz_path),
+        'db_size': os.path.getsize(db_path),
+        'db_sha256': file_sha256(db_path),
+        'applied_seq': seq,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    os.remove(db_path)
+    return gz_path, manifest
+
+def remove_snapshot(snapshot_path):
+    os.remove(snapshot_path)
+    os.rmdir(os.path.dirname(snapshot_path))
+
+def run_deploy(target, full=False, delta_max_protocols=DEFAULT_DELTA_MAX_PROTOCOLS):
+    """
+    Envia ao destino só os protocolos alterados desde o último deploy. Cai para um
+    snapshot completo quando o destino não está num ponto coberto pelo log (primeiro
+    deploy, banco substituído à mão), quando o changeset ficaria grande demais ou
+    quando o destino o recusa.
+    """
+    start = time.monotonic()
+    conn = sqlite3.connect(LOCAL_DB_NAME, timeout=30)
+    try:
+        init_change_log(conn)
+        to_seq = current_seq(conn)
+
+        target_seq = None if full else target.status()
+        if full:
+            print(f"Destino: {target} (snapshot completo forçado; origem em {to_seq}).")
+        else:
+            print(f"Destino: {target} (atualizado até {target_seq}; origem em {to_seq}).")
+
+        if not full and target_seq == to_seq:
+            print("Nenhuma alteração desde o último deploy.")
+            return True
+
+        if not full and can_build_delta(conn, target_seq):
+            changeset = build_changeset(conn, target_seq)
+            if len(changeset['keys']) > delta_max_protocols:
+                print(f"{len(changeset['keys'])} protocolos alterados; um snapshot completo sai mais barato.")
+            else:
+                payload = encode_changeset(changeset)
+                print(f"Enviando changeset: {len(changeset['keys'])} protocolos, {len(payload) / 1024:.1f} KB...")
+                try:
+                    summary = target.apply(payload)
+                    mark_deployed(conn, changeset['to_seq'])
+                    print(f"Changeset aplicado ({summary['rows']} linhas) em {time.monotonic() - start:.1f}s.")
+                    return True
+                except DeployError as e:
+                    print(f"O destino recusou o changeset ({e}); enviando snapshot completo.")
+
+        print("Gerando snapshot compactado...")
+        snapshot_path, manifest = create_snapshot(conn, to_seq)
+        try:
+            print(f"Enviando snapshot completo: {manifest['size'] / (1024 * 1024):.1f} MB "
+                  f"(banco de {manifest['db_size'] / (1024 * 1024):.1f} MB, original {os.path.getsize(LOCAL_DB_NAME) / (1024 * 1024):.1f} MB)...")
+            target.install(snapshot_path, manifest)
+        finally:
+            remove_snapshot(snapshot_path)
+        mark_deployed(conn, to_seq)
+        print(f"Snapshot instalado em {time.monotonic() - start:.1f}s.")
+        return True
+    finally:
+        conn.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Envia o banco de dados para o servidor.")
+    parser.add_argument('--full', action='store_true', help='Força um snapshot completo em vez do deploy incremental.')
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+
+    target = get_deploy_target(config)
+    if target is None:
+        # Sem destino configurado: upload em partes pela API de arquivos do PythonAnywhere.
+        run_upload()
+        return
+
+    try:
+        run_deploy(target, full=args.full,
+                   delta_max_protocols=config.get('delta_max_protocols', DEFAULT_DELTA_MAX_PROTOCOLS))
+    except (DeployError, requests.exceptions.RequestException, OSError) as e:
+        print(f"O deploy falhou: {e}")
+        raise SystemExit(1)
+
+
 if __name__ == "__main__":
     try:
         import requests
@@ -170,4 +380,4 @@ if __name__ == "__main__":
         import subprocess
         subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'requests'])
         import requests
-    run_upload()
+    main()
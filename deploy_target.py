@@ -0,0 +1,188 @@
+"""
+Lado do servidor do deploy: aplica um changeset (deploy incremental) ou instala
+um snapshot completo no banco em uso. Roda pela linha de comando (console do
+PythonAnywhere, ou um diretório local fazendo papel de servidor) ou pelo
+endpoint /admin/deploy do app.py.
+
+    python deploy_target.py status --db protocols.db
+    python deploy_target.py apply changeset.json.gz --db protocols.db
+    python deploy_target.py install protocols-snapshot.db.gz --manifest protocols-snapshot.json --db protocols.db
+"""
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import zlib
+
+from db_meta import ensure_meta, table_exists
+
+APPLIED_SEQ_KEY = 'deploy.applied_seq'
+CHANGESET_FORMAT = 1
+SNAPSHOT_FORMAT = 1
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class DeployError(Exception):
+    pass
+
+
+def _read_applied_seq(conn):
+    if not table_exists(conn, 'meta'):
+        return None
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (APPLIED_SEQ_KEY,)).fetchone()
+    return int(row[0]) if row else None
+
+def get_applied_seq(db_path):
+    """Até que ponto do log de alterações da origem este banco está atualizado (None se desconhecido)."""
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return _read_applied_seq(conn)
+    finally:
+        conn.close()
+
+def read_changeset(data):
+    """Decodifica um changeset (JSON compactado com gzip)."""
+    changeset = json.loads(gzip.decompress(data).decode('utf-8'))
+    if changeset.get('format') != CHANGESET_FORMAT:
+        raise DeployError(f"Formato de changeset não suportado: {changeset.get('format')}")
+    return changeset
+
+def apply_changeset(db_path, changeset):
+    """
+    Aplica o changeset numa única transação: para cada protocolo de 'keys', as
+    linhas de cada tabela são trocadas pelas enviadas. Os triggers do FTS mantêm
+    o índice de busca em dia. Recusa o changeset se o banco não estiver exatamente
+    no ponto de partida dele (base_seq); nesse caso é preciso um snapshot completo.
+    Retorna um resumo com o número de protocolos e linhas aplicados.
+    """
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            applied_seq = _read_applied_seq(conn)
+            if applied_seq != changeset['base_seq']:
+                raise DeployError(
+                    f"O destino está em {applied_seq}, mas o changeset parte de {changeset['base_seq']}."
+                )
+
+            keys = [tuple(key) for key in changeset['keys']]
+            rows_applied = 0
+            for table, data in changeset['tables'].items():
+                if not table_exists(conn, table):
+                    continue
+                target_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                indexes = [i for i, column in enumerate(data['columns']) if column in target_columns]
+                columns = [data['columns'][i] for i in indexes]
+                conn.executemany(f"DELETE FROM {table} WHERE year = ? AND number = ?", keys)
+                conn.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                    [[row[i] for i in indexes] for row in data['rows']]
+                )
+                rows_applied += len(data['rows'])
+
+            ensure_meta(conn)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (APPLIED_SEQ_KEY, str(changeset['to_seq'])))
+            # O banco do servidor veio de um snapshot e herdou os triggers do log de
+            # alterações; o que o apply registrou ali não interessa a ninguém.
+            if table_exists(conn, 'protocol_changes'):
+                conn.execute("DELETE FROM protocol_changes")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return {'protocols': len(keys), 'rows': rows_applied, 'applied_seq': changeset['to_seq']}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def install_snapshot(db_path, snapshot_path, manifest=None):
+    """
+    Troca o banco em uso pelo snapshot (compactado com gzip ou não). Com o manifest,
+    confere o checksum do arquivo recebido e o do banco descompactado. O banco é
+    descompactado e verificado no mesmo diretório do destino antes do os.replace,
+    então a troca é atômica: quem já está lendo continua no arquivo antigo e as
+    conexões novas abrem o novo.
+    """
+    if manifest is not None:
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            raise DeployError(f"Formato de snapshot não suportado: {manifest.get('format')}")
+        if file_sha256(snapshot_path) != manifest['sha256']:
+            raise DeployError("Checksum do snapshot não confere; o arquivo chegou incompleto ou corrompido.")
+
+    with open(snapshot_path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+
+    target_dir = os.path.dirname(os.path.abspath(db_path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', suffix='.db', dir=target_dir)
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as tmp, (gzip.open if compressed else open)(snapshot_path, 'rb') as src:
+            try:
+                for block in iter(lambda: src.read(1024 * 1024), b''):
+                    digest.update(block)
+                    tmp.write(block)
+            except (gzip.BadGzipFile, EOFError, zlib.error) as e:
+                raise DeployError(f"Não foi possível descompactar o snapshot: {e}")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        if manifest is not None and digest.hexdigest() != manifest['db_sha256']:
+            raise DeployError("Checksum do banco descompactado não confere.")
+
+        conn = sqlite3.connect(tmp_path)
+        try:
+            result = conn.execute("PRAGMA quick_check").fetchone()[0]
+            applied_seq = _read_applied_seq(conn)
+        finally:
+            conn.close()
+        if result != 'ok':
+            raise DeployError(f"Snapshot corrompido: {result}")
+        # mkstemp cria o arquivo com permissão 0600; mantém a do banco atual.
+        os.chmod(tmp_path, os.stat(db_path).st_mode & 0o777 if os.path.exists(db_path) else 0o644)
+        os.replace(tmp_path, db_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {'applied_seq': applied_seq}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    parser = argparse.ArgumentParser(description="Aplica deploys no banco do servidor.")
+    parser.add_argument('action', choices=['status', 'apply', 'install'])
+    parser.add_argument('file', nargs='?', help='Changeset (apply) ou snapshot (install).')
+    parser.add_argument('--manifest', help='Manifest (JSON) do snapshot, para conferir os checksums.')
+    parser.add_argument('--db', default=config.get('database_name', 'protocols.db'))
+    args = parser.parse_args()
+
+    try:
+        if args.action == 'status':
+            print(f"Banco '{args.db}' atualizado até a alteração {get_applied_seq(args.db)}.")
+        elif args.action == 'apply':
+            with open(args.file, 'rb') as f:
+                summary = apply_changeset(args.db, read_changeset(f.read()))
+            print(f"Changeset aplicado: {summary['protocols']} protocolos, {summary['rows']} linhas (até {summary['applied_seq']}).")
+        else:
+            manifest = None
+            if args.manifest:
+                with open(args.manifest, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            summary = install_snapshot(args.db, args.file, manifest)
+            print(f"Snapshot instalado (atualizado até {summary['applied_seq']}).")
+    except DeployError as e:
+        print(f"Erro: {e}")
+        raise SystemExit(1)
@@ -1,50 +1,42 @@
 import argparse
 import asyncio
+from abc import ABC, abstractmethod
 import json
 import logging
 import os
+import queue
 import re
 import sqlite3
-import unicodedata
+import shutil
+import signal
+import tempfile
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+import aiohttp
 
 from selenium import webdriver
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.support.ui import Select, WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from tqdm.asyncio import tqdm as asyncio_tqdm
-from tqdm import tqdm
-
-# --- Helper Functions for Filtering ---
-def remover_acentos(txt):
-    if not txt:
-        return ""
-    return ''.join(c for c in unicodedata.normalize('NFD', txt) if unicodedata.category(c) != 'Mn')
-
-def get_lista_normalizada(lista_original, familias):
-    mapa_familias = {}
-    for key, variantes in familias.items():
-        for v in variantes:
-            mapa_familias[remover_acentos(v).lower()] = set(remover_acentos(va).lower() for va in variantes)
-
-    lista_normalizada = set()
-    for nome in lista_original:
-        nome_sem_acento = remover_acentos(nome).lower()
-        if nome_sem_acento in mapa_familias:
-            lista_normalizada.update(mapa_familias[nome_sem_acento])
-        else:
-            lista_normalizada.add(nome_sem_acento)
-    return list(lista_normalizada)
 
-def contains_any_keyword(block, keywords):
-    if not block:
-        return False
-    block_norm = remover_acentos(block).lower()
-    return any(word in block_norm for word in keywords)
+from change_log import init_change_log
+from keyword_index import (
+    get_indexed_keywords, get_lista_normalizada, index_protocols, init_keyword_index,
+    match_keywords, sync_keyword_index,
+)
+from protocol_fields import index_fields, init_protocol_fields, latest_date, parse_protocol, sync_protocol_fields
 
+# --- Helper Functions for Filtering ---
 def find_and_format_dates(content):
     """Finds all dd/mm/yyyy dates in a string and returns the latest one in yyyy-mm-dd format."""
     if not content:
@@ -70,6 +62,23 @@ def find_and_format_dates(content):
     
     return None
 
+SCRAPE_ERROR_PREFIXES = ("SCRAPE_ERROR:", "Timeout:", "An unexpected error occurred", "Default error content.")
+
+def is_scrape_error(content):
+    """True for the placeholder texts the engines return when a lookup failed."""
+    return not content or content.startswith(SCRAPE_ERROR_PREFIXES)
+
+def classify_content(content):
+    """
+    Derives the (arquivado, last_update) pair from a protocol's scraped text.
+    last_update is the latest Situação/Despacho/Encaminhamentos date; texts
+    without those parts fall back to the latest date found anywhere.
+    """
+    # Normalize content for robust matching
+    normalized_content = content.lower().replace(',', '').replace('.', '')
+    arquivado = "yes" if "conforme andamento arquiva-se o protocolo" in normalized_content else "no"
+    return arquivado, latest_date(parse_protocol(content)) or find_and_format_dates(content)
+
 # --- Configuration and Logging Setup ---
 
 def setup_logging(log_file):
@@ -92,17 +101,40 @@ class Config:
 
 # --- Database Management ---
 
+# Queue priorities: higher is leased first.
+PRIORITY_NORMAL = 0
+PRIORITY_GAP = 1          # numbers missing from the stored sequence
+PRIORITY_ERROR_ROW = 2    # stored rows whose content is a scrape error, shown to users as if it were data
+
 class DatabaseManager:
-    def __init__(self, db_name):
+    def __init__(self, db_name, keywords=None, retry_backoff=60, retry_backoff_max=86400):
         self.db_name = db_name
+        # Keywords matched at ingest into protocol_keywords (see keyword_index.py).
+        self.keywords = keywords
+        # A failed lookup is retried after retry_backoff * 2**attempts seconds, capped at retry_backoff_max.
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
         self.conn = None
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self.db_name)
+        self.conn = sqlite3.connect(self.db_name, timeout=30)
+        # WAL lets readers carry on while batches are written; NORMAL sync is
+        # durable at each WAL checkpoint and avoids an fsync per transaction.
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA cache_size = -65536")  # 64 MB
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn:
+            try:
+                # Fold the WAL back in so protocols.db stays a single self-contained
+                # file for deploy_db.py and the web app.
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.conn.execute("PRAGMA journal_mode = DELETE")
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Could not leave WAL mode (another connection is open?): {e}")
             self.conn.close()
 
     def execute(self, query, params=()):
@@ -129,12 +161,174 @@ class DatabaseManager:
                 PRIMARY KEY (year, number)
             )
         ''')
+        self.init_queue()
+        init_keyword_index(self.conn)
+        init_protocol_fields(self.conn)
+        # Row-level change log read by deploy_db.py for incremental deploys.
+        init_change_log(self.conn)
         logging.info("Database initialized.")
 
+    def init_queue(self):
+        # Durable work queue: what a run still has to scrape survives the process
+        # being killed, so time-boxed runs add up to a full backfill.
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS scrape_queue (
+                year INTEGER,
+                number INTEGER,
+                state TEXT NOT NULL DEFAULT 'pending',  -- pending, leased, done, error
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (year, number)
+            );
+            CREATE INDEX IF NOT EXISTS idx_scrape_queue_state ON scrape_queue (year, state, number);
+        ''')
+        # Columns added after the queue was introduced; older databases get them here.
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(scrape_queue)")}
+        if 'priority' not in columns:
+            self.conn.execute("ALTER TABLE scrape_queue ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if 'next_attempt_at' not in columns:
+            self.conn.execute("ALTER TABLE scrape_queue ADD COLUMN next_attempt_at REAL")  # unix time
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_scrape_queue_priority ON scrape_queue (year, priority DESC, number)")
+        self.conn.commit()
+
+    # Rows a run may lease: pending, or failed with attempts left and the backoff elapsed.
+    LEASABLE_SQL = '''
+        year = ? AND priority >= ? AND (
+            state = 'pending'
+            OR (state = 'error' AND attempts < ? AND (next_attempt_at IS NULL OR next_attempt_at <= ?))
+        )
+    '''
+
+    def enqueue_protocols(self, year, numbers, requeue_before):
+        """
+        Adds numbers to the queue as pending. Numbers already done (or given up
+        on) are only queued again if they were last handled before `requeue_before`,
+        so a resumed run does not redo work an earlier run of the same cycle finished.
+        """
+        with self.conn:
+            self.conn.executemany(
+                '''
+                INSERT INTO scrape_queue (year, number, state, updated_at) VALUES (?, ?, 'pending', ?)
+                ON CONFLICT(year, number) DO UPDATE SET state = 'pending', attempts = 0, updated_at = excluded.updated_at
+                WHERE scrape_queue.state IN ('done', 'error') AND scrape_queue.updated_at < ?
+                ''',
+                [(year, number, datetime.now(), requeue_before) for number in numbers]
+            )
+
+    def release_stale_leases(self):
+        """Returns rows leased by a run that never finished to the pending state."""
+        with self.conn:
+            cursor = self.conn.execute("UPDATE scrape_queue SET state = 'pending' WHERE state = 'leased'")
+        if cursor.rowcount:
+            logging.info(f"Resuming {cursor.rowcount} protocols left leased by an interrupted run.")
+
+    def enqueue_retries(self, year, numbers, priority, requeue_before):
+        """
+        Queues numbers found by the gap / error-row checks with a raised priority.
+        Failed rows keep their attempt count and backoff; rows marked done in an
+        earlier cycle are queued again.
+        """
+        with self.conn:
+            self.conn.executemany(
+                '''
+                INSERT INTO scrape_queue (year, number, state, priority, updated_at) VALUES (?, ?, 'pending', ?, ?)
+                ON CONFLICT(year, number) DO UPDATE SET
+                    priority = MAX(scrape_queue.priority, excluded.priority),
+                    state = CASE
+                        WHEN scrape_queue.state = 'done' AND scrape_queue.updated_at < ? THEN 'pending'
+                        ELSE scrape_queue.state
+                    END
+                ''',
+                [(year, number, priority, datetime.now(), requeue_before) for number in numbers]
+            )
+
+    def count_queued(self, year, max_attempts, min_priority=PRIORITY_NORMAL):
+        rows = self.fetchall(
+            f"SELECT COUNT(*) FROM scrape_queue WHERE {self.LEASABLE_SQL}",
+            (year, min_priority, max_attempts, time.time())
+        )
+        return rows[0][0]
+
+    def lease_protocols(self, year, limit, max_attempts, min_priority=PRIORITY_NORMAL):
+        """
+        Marks up to `limit` leasable numbers of the year as leased and returns them,
+        highest priority first.
+        """
+        with self.conn:
+            rows = self.conn.execute(
+                f'''
+                SELECT number FROM scrape_queue
+                WHERE {self.LEASABLE_SQL}
+                ORDER BY priority DESC, number LIMIT ?
+                ''',
+                (year, min_priority, max_attempts, time.time(), limit)
+            ).fetchall()
+            numbers = [row[0] for row in rows]
+            self.conn.executemany(
+                "UPDATE scrape_queue SET state = 'leased', updated_at = ? WHERE year = ? AND number = ?",
+                [(datetime.now(), year, number) for number in numbers]
+            )
+        return numbers
+
+    def get_queue_summary(self, year):
+        rows = self.fetchall("SELECT state, COUNT(*) FROM scrape_queue WHERE year = ? GROUP BY state", (year,))
+        return dict(rows)
+
+    def count_exhausted(self, year, max_attempts):
+        rows = self.fetchall(
+            "SELECT COUNT(*) FROM scrape_queue WHERE year = ? AND state = 'error' AND attempts >= ?",
+            (year, max_attempts)
+        )
+        return rows[0][0]
+
+    def find_sequence_gaps(self, year, upto=None):
+        """
+        Returns (first, last) ranges of numbers missing from the stored sequence,
+        starting at 1 and, if `upto` is given, running to that number.
+        """
+        gaps = self.fetchall(
+            '''
+            SELECT prev + 1, number - 1 FROM (
+                SELECT number, LAG(number, 1, 0) OVER (ORDER BY number) AS prev
+                FROM protocols WHERE year = ?
+            )
+            WHERE number - prev > 1
+            ''',
+            (year,)
+        )
+        if upto:
+            last = self.fetchall("SELECT COALESCE(MAX(number), 0) FROM protocols WHERE year = ?", (year,))[0][0]
+            if last < upto:
+                gaps.append((last + 1, upto))
+        return gaps
+
+    def find_error_rows(self, year):
+        """
+        Numbers whose stored content is a scrape error rather than the protocol text,
+        by the same rule as is_scrape_error: empty content or one of the prefixes,
+        compared exactly (LIKE would ignore case and treat '_' as a wildcard).
+        """
+        conditions = " OR ".join("substr(content, 1, length(?)) = ?" for _ in SCRAPE_ERROR_PREFIXES)
+        rows = self.fetchall(
+            f"""SELECT number FROM protocols
+                WHERE year = ? AND (content IS NULL OR content = '' OR {conditions}) ORDER BY number""",
+            (year, *[value for prefix in SCRAPE_ERROR_PREFIXES for value in (prefix, prefix)])
+        )
+        return [row[0] for row in rows]
+
     def get_existing_protocols(self, year):
         rows = self.fetchall('SELECT number FROM protocols WHERE year = ?', (year,))
         return {row[0] for row in rows}
 
+    def get_latest_protocol_number(self, year):
+        """Highest protocol number already stored for the year; a safe starting point for the search."""
+        rows = self.fetchall(
+            "SELECT MAX(number) FROM protocols WHERE year = ? AND content NOT LIKE 'Protocolo não localizado%'",
+            (year,)
+        )
+        return rows[0][0] or 0
+
     def get_protocols_to_update(self, year, days=90):
         ninety_days_ago = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
         rows = self.fetchall(
@@ -144,10 +338,245 @@ class DatabaseManager:
         return {row[0] for row in rows}
 
     def insert_protocol(self, year, number, content, arquivado, last_update):
-        self.execute(
-            'INSERT OR REPLACE INTO protocols (year, number, content, Arquivado, Last_update, retrieved_at) VALUES (?, ?, ?, ?, ?, ?)',
-            (year, number, content, arquivado, last_update, datetime.now())
-        )
+        self.insert_protocols([(year, number, content, arquivado, last_update)])
+
+    def get_stored_contents(self, keys, chunk_size=400):
+        """Returns {(year, number): content} for the given keys that are already stored."""
+        stored = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            values = ", ".join("(?, ?)" for _ in chunk)
+            stored.update(((year, number), content) for year, number, content in self.conn.execute(
+                f"SELECT year, number, content FROM protocols WHERE (year, number) IN (VALUES {values})",
+                [value for key in chunk for value in key]
+            ))
+        return stored
+
+    def insert_protocols(self, rows, failures=()):
+        """
+        Writes (year, number, content, arquivado, last_update) rows and records
+        (year, number, error) failures in the work queue, in a single transaction.
+
+        Rows whose content equals the stored one are only marked done in the
+        queue: they are not rewritten, so the FTS index, the keyword index and
+        the change log see no churn. Changed rows are also parsed into the
+        protocol_fields/protocol_steps tables. Returns the changed rows as
+        (year, number, content, matched_keywords) tuples, matched against
+        `self.keywords` once and reused for the keyword index.
+        """
+        retrieved_at = datetime.now()
+        stored = self.get_stored_contents([(row[0], row[1]) for row in rows])
+        changed_rows = [row for row in rows if stored.get((row[0], row[1])) != row[2]]
+        matches = [match_keywords(row[2], self.keywords or ()) for row in changed_rows]
+        # An upsert keeps the rowid stable and fires the FTS update trigger once,
+        # where INSERT OR REPLACE would delete and re-insert the row.
+        with self.conn:
+            self.conn.executemany(
+                '''
+                INSERT INTO protocols (year, number, content, Arquivado, Last_update, retrieved_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(year, number) DO UPDATE SET
+                    content = excluded.content,
+                    Arquivado = excluded.Arquivado,
+                    Last_update = excluded.Last_update,
+                    retrieved_at = excluded.retrieved_at
+                ''',
+                [row + (retrieved_at,) for row in changed_rows]
+            )
+            self.conn.executemany(
+                '''
+                UPDATE scrape_queue SET state = 'done', last_error = NULL, updated_at = ?, priority = 0, next_attempt_at = NULL
+                WHERE year = ? AND number = ?
+                ''',
+                [(retrieved_at, row[0], row[1]) for row in rows]
+            )
+            # Exponential backoff: the SET expressions see the attempt count before the increment.
+            now = time.time()
+            self.conn.executemany(
+                '''
+                UPDATE scrape_queue SET state = 'error', attempts = attempts + 1, last_error = ?, updated_at = ?,
+                    next_attempt_at = ? + MIN(?, ? * (1 << MIN(attempts, 30)))
+                WHERE year = ? AND number = ?
+                ''',
+                [(error, retrieved_at, now, self.retry_backoff_max, self.retry_backoff, year, number)
+                 for year, number, error in failures]
+            )
+            if self.keywords:
+                index_protocols(self.conn, [(row[0], row[1], row[2]) for row in changed_rows], self.keywords, matches)
+            index_fields(self.conn, [(row[0], row[1], row[2]) for row in changed_rows])
+        return [(row[0], row[1], row[2], found) for row, found in zip(changed_rows, matches)]
+
+class ProtocolWriter:
+    """
+    Single writer for scrape results. Rows are buffered and written with one
+    executemany per transaction once `batch_size` rows are pending or
+    `flush_interval` seconds have passed; leaving the context flushes the rest,
+    including when the run is cancelled.
+
+    Failed lookups are not written over the stored protocol; they are recorded
+    as errors in the work queue so a later run retries them. Protocols whose
+    content changed are handed to `summary` (an UpdateSummaryWriter) as they
+    are written.
+    """
+    def __init__(self, db, batch_size=200, flush_interval=5.0, summary=None):
+        self.db = db
+        self.summary = summary
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.failures = []
+        self.written = 0
+        self.changed = 0
+        self.failed = 0
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, year, number, content, arquivado, last_update):
+        if is_scrape_error(content):
+            self.failures.append((year, number, content))
+        else:
+            self.pending.append((year, number, content, arquivado, last_update))
+        buffered = len(self.pending) + len(self.failures)
+        if buffered >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending or self.failures:
+            changed = self.db.insert_protocols(self.pending, self.failures)
+            if self.summary is not None:
+                for year, number, content, matched in changed:
+                    self.summary.add(year, number, content, matched)
+            self.written += len(self.pending)
+            self.changed += len(changed)
+            self.failed += len(self.failures)
+            self.pending = []
+            self.failures = []
+        self._last_flush = time.monotonic()
+
+class UpdateSummaryWriter:
+    """
+    Builds Update.txt while the scrape runs. Each changed protocol that matches
+    one of `keywords` is appended to a temporary body file as soon as it is
+    written, so the report needs no second pass over the database. `close()`
+    writes the header (which carries the final count) followed by the body to
+    a temporary file next to `path` and swaps it in with os.replace.
+    """
+    def __init__(self, path, keywords):
+        self.path = path
+        self.keywords = frozenset(keywords)
+        self.count = 0
+        self._body = tempfile.TemporaryFile('w+', encoding='utf-8')
+
+    def add(self, year, number, content, matched):
+        if not matched & self.keywords:
+            return
+        self._body.write(f"--- {year}/{str(number).zfill(5)} ---\n")
+        self._body.write(f"{content}\n\n")
+        self.count += 1
+
+    def close(self):
+        now = datetime.now().strftime('%d-%m-%Y %H:%M:%S')
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.update-', suffix='.txt', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                if self.count:
+                    f.write(f"Update de {now}\n\n")
+                    f.write(f"Foram encontrados {self.count} novos protocolos de interesse:\n\n")
+                    self._body.seek(0)
+                    shutil.copyfileobj(self._body, f)
+                else:
+                    f.write(f"Sem update. {now}")
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            self._body.close()
+
+# --- Concurrency Control ---
+
+class AdaptiveConcurrency:
+    """
+    AIMD limiter for in-flight scrapes. After every `window` results the limit
+    grows by one if the portal looks healthy and is multiplied by
+    `decrease_factor` when there were timeouts, the error rate went above
+    `max_error_rate`, or the median latency rose past `latency_tolerance` times
+    the best median seen so far. The limit always stays within [minimum, maximum].
+    """
+    def __init__(self, initial, minimum, maximum, window=20, max_error_rate=0.1,
+                 latency_tolerance=2.0, decrease_factor=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._baseline_latency = None
+        self._latencies = []
+        self._errors = 0
+        self._timeouts = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, latency, content):
+        """Feeds one finished lookup (its duration and resulting content) into the controller."""
+        self._latencies.append(latency)
+        if content and content.startswith("Timeout:"):
+            self._timeouts += 1
+        elif is_scrape_error(content):
+            self._errors += 1
+        if len(self._latencies) >= self.window:
+            self._adjust()
+
+    def _adjust(self):
+        samples = sorted(self._latencies)
+        median = samples[len(samples) // 2]
+        error_rate = (self._errors + self._timeouts) / len(samples)
+        if self._baseline_latency is None or median < self._baseline_latency:
+            self._baseline_latency = median
+
+        if self._timeouts:
+            reason = f"{self._timeouts} timeouts"
+        elif error_rate > self.max_error_rate:
+            reason = f"error rate {error_rate:.0%}"
+        elif median > self._baseline_latency * self.latency_tolerance:
+            reason = f"median latency {median:.2f}s vs baseline {self._baseline_latency:.2f}s"
+        else:
+            reason = None
+
+        old_limit = self.limit
+        if reason:
+            self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+
+        if self.limit != old_limit:
+            logging.info(
+                f"Concurrency {old_limit} -> {self.limit} "
+                f"({reason or 'healthy'}; median {median:.2f}s, errors {error_rate:.0%} over {len(samples)} lookups)"
+            )
+        self._latencies = []
+        self._errors = 0
+        self._timeouts = 0
 
 # --- Web Scraping ---
 
@@ -162,10 +591,181 @@ class Locators:
     RESULTADO_FIELDSET = (By.XPATH, "//span[@id='form:resultadoSituacaoNumero']/fieldset")
     RESULTADO_FIELDSET_ERRO = (By.XPATH, "//span[@id='form:resultadoSituacaoNumero']")
 
-class ProtocolScraper:
-    def __init__(self, base_url, headless=True):
+class DriverPool:
+    """
+    A bounded pool of long-lived Chrome sessions shared by the scraping threads.
+
+    Drivers are created lazily up to `size`, health-checked every time they are
+    leased and recycled after `max_uses` leases or as soon as they crash.
+    """
+    def __init__(self, factory, size, max_uses=200):
+        self._factory = factory
+        self._max_uses = max_uses
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._uses = {}
+        self._discarded = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @contextmanager
+    def lease(self):
+        self._slots.acquire()
+        driver = None
+        try:
+            driver = self._checkout()
+            yield driver
+        except Exception:
+            if driver is not None:
+                self.discard(driver)
+            raise
+        finally:
+            if driver is not None:
+                self._checkin(driver)
+            self._slots.release()
+
+    def discard(self, driver):
+        """Marks a leased driver as broken so it is quit instead of being reused."""
+        with self._lock:
+            self._discarded.add(id(driver))
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _checkout(self):
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if self._is_healthy(driver):
+                return driver
+            logging.warning("Discarding an unresponsive WebDriver session.")
+            self._quit(driver)
+
+        driver = self._factory()
+        with self._lock:
+            self._uses[id(driver)] = 0
+        return driver
+
+    def _checkin(self, driver):
+        with self._lock:
+            self._uses[id(driver)] += 1
+            recycle = (
+                self._closed
+                or id(driver) in self._discarded
+                or self._uses[id(driver)] >= self._max_uses
+            )
+        if recycle:
+            self._quit(driver)
+        else:
+            self._idle.put(driver)
+
+    def _quit(self, driver):
+        with self._lock:
+            self._uses.pop(id(driver), None)
+            self._discarded.discard(id(driver))
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    @staticmethod
+    def _is_healthy(driver):
+        try:
+            driver.execute_script("return 1")
+            return True
+        except WebDriverException:
+            return False
+
+class BaseProtocolScraper(ABC):
+    """Engine-independent scraper logic. Subclasses provide the actual portal lookups."""
+
+    @abstractmethod
+    async def scrape_protocol(self, session, year, number):
+        """Returns (year, number, content, arquivado, last_update); failures come back as error text."""
+
+    @abstractmethod
+    async def check_protocol_exists(self, year, number):
+        """True if the portal has a protocol year/number."""
+
+    async def close(self):
+        pass
+
+    async def _probe_window(self, year, start, width):
+        """
+        Returns the first existing protocol in start..start+width-1, or None.
+        Looking a few numbers ahead keeps a single "não localizado" hole from
+        being mistaken for the end of the sequence.
+        """
+        for number in range(start, start + width):
+            if await self.check_protocol_exists(year, number):
+                return number
+        return None
+
+    async def find_latest_protocol_number(self, year, start=0, parallel_probes=8, hole_tolerance=3, upper_bound=30000):
+        """
+        Finds the latest protocol of `year`. Starting from `start` (a number known to
+        exist, e.g. the highest one already stored), it gallops upward in doubling
+        steps until a probe overshoots and then narrows the gap with a k-ary search.
+        Each round probes `parallel_probes` candidates concurrently.
+        """
+        logging.info(f"Starting galloping search for the latest protocol in {year} from {start}.")
+        latest = start
+        beyond = None  # Smallest candidate above `latest` whose whole window was not found.
+        step = 1
+        rounds = 0
+
+        while True:
+            if beyond is None:
+                if latest >= upper_bound:
+                    break
+                # Gallop: latest+step, +2*step, +4*step, ...
+                candidates = sorted({min(latest + step * 2 ** i, upper_bound) for i in range(parallel_probes)})
+                step *= 2 ** parallel_probes
+                width = hole_tolerance
+            elif beyond - latest <= 1:
+                break
+            elif beyond - latest - 1 <= parallel_probes:
+                # Few enough left to check each number on its own.
+                candidates = list(range(latest + 1, beyond))
+                width = 1
+            else:
+                gap = beyond - latest
+                candidates = sorted({latest + gap * i // (parallel_probes + 1) for i in range(1, parallel_probes + 1)})
+                width = hole_tolerance
+
+            results = await asyncio.gather(*(self._probe_window(year, c, width) for c in candidates))
+            rounds += 1
+            latest = max([latest] + [found for found in results if found is not None])
+            # Misses below `latest` are just holes in the sequence.
+            misses = [c for c, found in zip(candidates, results) if found is None]
+            if beyond is not None:
+                misses.append(beyond)
+            misses = [c for c in misses if c > latest]
+            beyond = min(misses) if misses else None
+
+        logging.info(f"Found latest protocol for {year}: {latest} ({rounds} probe rounds).")
+        return latest
+
+class ProtocolScraper(BaseProtocolScraper):
+    def __init__(self, base_url, headless=True, pool_size=10, driver_max_uses=200):
         self.base_url = base_url
         self.headless = headless
+        self.pool = DriverPool(self._init_driver, pool_size, driver_max_uses)
+        # One worker per pooled session: the loop's default executor (min(32, cpu + 4)
+        # threads) would cap the sessions in use and count queueing as portal latency.
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='selenium')
+
+    async def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
 
     def _init_driver(self):
         service = Service(log_path=os.devnull)
@@ -180,69 +780,67 @@ class ProtocolScraper:
         loop = asyncio.get_event_loop()
         try:
             content, arquivado, last_update = await loop.run_in_executor(
-                None, self._perform_scrape, year, number
+                self.executor, self._perform_scrape, year, number
             )
             return year, number, content, arquivado, last_update
         except Exception as e:
             logging.error(f"Error scraping {year}/{number}: {e}")
             return year, number, f"SCRAPE_ERROR: {e}", "no", None
 
-    def _perform_scrape(self, year, number):
-        driver = self._init_driver()
-        wait = WebDriverWait(driver, 10)
+    def _submit_form(self, driver, wait, year, number):
+        """Resets a leased driver to a fresh form and submits the query for year/number."""
         driver.get(self.base_url)
+
+        wait.until(EC.presence_of_element_located(Locators.IFRAME))
+        driver.switch_to.frame(driver.find_element(*Locators.IFRAME))
+
+        wait.until(EC.presence_of_element_located(Locators.EXERCICIO_INPUT)).send_keys(str(year))
+        wait.until(EC.presence_of_element_located(Locators.NUMERO_INPUT)).send_keys(str(number))
+        wait.until(EC.presence_of_element_located(Locators.VOLUME_INPUT)).send_keys(str(1))
+        Select(wait.until(EC.presence_of_element_located(Locators.TIPO_PROTOCOLO_DROPDOWN))).select_by_index(10)
+
+        wait.until(EC.invisibility_of_element_located(Locators.OVERLAY_CARREGANDO))
+        wait.until(EC.element_to_be_clickable(Locators.BOTAO_LOCALIZAR)).click()
+
+    def _perform_scrape(self, year, number):
         content = "Default error content."
         arquivado = "no"
         last_update = None
-        try:
-            wait.until(EC.presence_of_element_located(Locators.IFRAME))
-            driver.switch_to.frame(driver.find_element(*Locators.IFRAME))
-
-            wait.until(EC.presence_of_element_located(Locators.EXERCICIO_INPUT)).send_keys(str(year))
-            wait.until(EC.presence_of_element_located(Locators.NUMERO_INPUT)).send_keys(str(number))
-            wait.until(EC.presence_of_element_located(Locators.VOLUME_INPUT)).send_keys(str(1))
-            Select(wait.until(EC.presence_of_element_located(Locators.TIPO_PROTOCOLO_DROPDOWN))).select_by_index(10)
-            
-            wait.until(EC.invisibility_of_element_located(Locators.OVERLAY_CARREGANDO))
-            wait.until(EC.element_to_be_clickable(Locators.BOTAO_LOCALIZAR)).click()
+        with self.pool.lease() as driver:
+            wait = WebDriverWait(driver, 10)
+            try:
+                self._submit_form(driver, wait, year, number)
 
-            wait.until(EC.text_to_be_present_in_element(Locators.RESULTADO_FIELDSET, f"{year}/{number}"))
-            content = driver.find_element(*Locators.RESULTADO_FIELDSET).text
+                wait.until(EC.text_to_be_present_in_element(Locators.RESULTADO_FIELDSET, f"{year}/{number}"))
+                content = driver.find_element(*Locators.RESULTADO_FIELDSET).text
 
-            # Normalize content for robust matching
-            normalized_content = content.lower().replace(',', '').replace('.', '')
-            if "conforme andamento arquiva-se o protocolo" in normalized_content:
-                arquivado = "yes"
-            
-            last_update = find_and_format_dates(content)
+                arquivado, last_update = classify_content(content)
 
-        except TimeoutException:
-            try:
-                content = driver.find_element(*Locators.RESULTADO_FIELDSET_ERRO).text
-            except NoSuchElementException:
-                content = "Timeout: Protocol not found or page did not load."
-        except Exception as e:
-            content = f"An unexpected error occurred: {e}"
-        finally:
-            driver.quit()
+            except TimeoutException:
+                try:
+                    content = driver.find_element(*Locators.RESULTADO_FIELDSET_ERRO).text
+                except NoSuchElementException:
+                    content = "Timeout: Protocol not found or page did not load."
+            except Exception as e:
+                # The session may be in an unknown state; don't hand it to the next worker.
+                self.pool.discard(driver)
+                content = f"An unexpected error occurred: {e}"
         return content, arquivado, last_update
 
+    async def check_protocol_exists(self, year, number):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._probe_protocol, year, number)
+
+    def _probe_protocol(self, year, number):
+        # Lease per probe so a crashed session is replaced before the next one.
+        with self.pool.lease() as driver:
+            # Use a longer wait for general navigation, but the check method uses a shorter one.
+            return self._check_protocol_exists(driver, WebDriverWait(driver, 10), year, number)
+
     def _check_protocol_exists(self, driver, wait, year, number):
         """A dedicated method for the binary search to check if a protocol exists."""
         try:
-            # This is slow, but safer than trying to navigate 'back' on a complex JS page
-            driver.get(self.base_url)
-            
-            wait.until(EC.presence_of_element_located(Locators.IFRAME))
-            driver.switch_to.frame(driver.find_element(*Locators.IFRAME))
-
-            wait.until(EC.presence_of_element_located(Locators.EXERCICIO_INPUT)).send_keys(str(year))
-            wait.until(EC.presence_of_element_located(Locators.NUMERO_INPUT)).send_keys(str(number))
-            wait.until(EC.presence_of_element_located(Locators.VOLUME_INPUT)).send_keys(str(1))
-            Select(wait.until(EC.presence_of_element_located(Locators.TIPO_PROTOCOLO_DROPDOWN))).select_by_index(10)
-            
-            wait.until(EC.invisibility_of_element_located(Locators.OVERLAY_CARREGANDO))
-            wait.until(EC.element_to_be_clickable(Locators.BOTAO_LOCALIZAR)).click()
+            self._submit_form(driver, wait, year, number)
 
             # A short wait for the result. A successful result should contain the protocol number.
             # If it times out, we'll check for the error message.
@@ -265,46 +863,241 @@ class ProtocolScraper:
             return False
         except Exception as e:
             logging.warning(f"An error occurred in _check_protocol_exists for {year}/{number}: {e}")
+            self.pool.discard(driver)
             # Any other exception means we can't be sure, so assume it doesn't exist.
             return False
 
-    def find_latest_protocol_number(self, year):
-        logging.info(f"Starting binary search for the latest protocol in {year}.")
-        driver = self._init_driver()
-        # Use a longer wait for general navigation, but the check method uses a shorter one.
-        wait = WebDriverWait(driver, 10) 
-        low, high = 1, 30000
-        latest_found = 0
+class _PortalPageParser(HTMLParser):
+    """
+    Extracts what the HTTP engine needs from a portal page: the iframe that hosts
+    the form, the form's fields (including the JSF ViewState) and the text of the
+    result span, laid out the way the browser renders it.
+    """
+    VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr'}
+    BLOCK_TAGS = {
+        'br', 'div', 'p', 'tr', 'li', 'ul', 'ol', 'table', 'tbody', 'fieldset', 'legend',
+        'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'form', 'hr',
+    }
+    RESULT_ID = 'form:resultadoSituacaoNumero'
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.iframe_src = None
+        self.form_action = None
+        self.hidden_fields = {}
+        self.names_by_id = {}
+        self.values_by_id = {}
+        self.options_by_id = defaultdict(list)
+        self.result_found = False
+        self.result_has_fieldset = False
+        self._in_form = False
+        self._select_id = None
+        self._skip_depth = 0
+        self._result_depth = 0
+        self._fieldset_depth = 0
+        self._result_parts = []
+        self._fieldset_parts = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        element_id = attrs.get('id')
+
+        if tag == 'iframe' and self.iframe_src is None:
+            self.iframe_src = attrs.get('src')
+        elif tag == 'form' and element_id == 'form':
+            self._in_form = True
+            self.form_action = attrs.get('action')
+        elif tag in ('input', 'button') and self._in_form:
+            name = attrs.get('name')
+            if element_id:
+                self.names_by_id[element_id] = name
+                self.values_by_id[element_id] = attrs.get('value', '')
+            if tag == 'input' and attrs.get('type') == 'hidden' and name:
+                self.hidden_fields[name] = attrs.get('value', '')
+        elif tag == 'select' and self._in_form:
+            self._select_id = element_id
+            if element_id:
+                self.names_by_id[element_id] = attrs.get('name')
+        elif tag == 'option' and self._select_id:
+            self.options_by_id[self._select_id].append(attrs.get('value', ''))
+        elif tag in ('script', 'style'):
+            self._skip_depth += 1
+
+        if tag == 'span' and element_id == self.RESULT_ID:
+            self.result_found = True
+            self._result_depth = 1
+        elif self._result_depth and tag not in self.VOID_TAGS:
+            self._result_depth += 1
+            if tag == 'fieldset' and not self._fieldset_depth:
+                self.result_has_fieldset = True
+                self._fieldset_depth = 1
+            elif self._fieldset_depth:
+                self._fieldset_depth += 1
+
+        if tag in self.BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self._append('\n')
+        if tag == 'form':
+            self._in_form = False
+        elif tag == 'select':
+            self._select_id = None
+        elif tag in ('script', 'style') and self._skip_depth:
+            self._skip_depth -= 1
+
+        if self._result_depth and tag not in self.VOID_TAGS:
+            self._result_depth -= 1
+            if self._fieldset_depth:
+                self._fieldset_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._append(re.sub(r'\s+', ' ', data))
+
+    def _append(self, text):
+        if self._result_depth:
+            self._result_parts.append(text)
+        if self._fieldset_depth:
+            self._fieldset_parts.append(text)
+
+    @staticmethod
+    def _render(parts):
+        lines = [line.strip() for line in ''.join(parts).split('\n')]
+        return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+    @property
+    def result_text(self):
+        return self._render(self._result_parts)
+
+    @property
+    def fieldset_text(self):
+        return self._render(self._fieldset_parts)
+
+
+class HttpProtocolScraper(BaseProtocolScraper):
+    """
+    Browserless engine. Fetches the JSF form once, keeps its ViewState and cookies,
+    and replays the form post for each protocol over a pooled aiohttp session.
+    """
+    def __init__(self, base_url, pool_size=10, timeout=20):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._form = None
+        self._form_lock = asyncio.Lock()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                # unsafe=True keeps cookies for IP hosts, e.g. the local portal stub.
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+        return self._session
+
+    async def _fetch_page(self, session, url):
+        async with session.get(url) as response:
+            response.raise_for_status()
+            page = _PortalPageParser()
+            page.feed(await response.text())
+            return page, str(response.url)
+
+    async def _load_form(self, session, stale_form=None):
+        """Loads the form (following the iframe) once and shares it between all requests."""
+        async with self._form_lock:
+            if self._form is not None and self._form is not stale_form:
+                return self._form
 
+            page, url = await self._fetch_page(session, self.base_url)
+            if page.form_action is None and page.iframe_src:
+                page, url = await self._fetch_page(session, urljoin(url, page.iframe_src))
+            if page.form_action is None:
+                raise RuntimeError("Search form not found on the portal page.")
+
+            field_ids = {
+                'exercicio': Locators.EXERCICIO_INPUT[1],
+                'numero': Locators.NUMERO_INPUT[1],
+                'volume': Locators.VOLUME_INPUT[1],
+                'tipo': Locators.TIPO_PROTOCOLO_DROPDOWN[1],
+                'botao': Locators.BOTAO_LOCALIZAR[1],
+            }
+            names = {key: page.names_by_id.get(element_id) or element_id for key, element_id in field_ids.items()}
+            tipo_options = page.options_by_id.get(field_ids['tipo'], [])
+            if len(tipo_options) <= 10:
+                raise RuntimeError("Unexpected protocol type options on the portal form.")
+
+            self._form = {
+                'action': urljoin(url, page.form_action),
+                'hidden': dict(page.hidden_fields),
+                'names': names,
+                # Same choice as the Selenium engine's select_by_index(10).
+                'tipo': tipo_options[10],
+                'botao_value': page.values_by_id.get(field_ids['botao'], ''),
+            }
+            return self._form
+
+    async def _query(self, session, year, number):
+        """Posts the form for year/number and returns the parsed response page."""
+        session = session or await self._get_session()
+        form = await self._load_form(session)
+
+        for attempt in range(2):
+            names = form['names']
+            data = dict(form['hidden'])
+            data.update({
+                names['exercicio']: str(year),
+                names['numero']: str(number),
+                names['volume']: '1',
+                names['tipo']: form['tipo'],
+                names['botao']: form['botao_value'],
+            })
+            async with session.post(form['action'], data=data) as response:
+                response.raise_for_status()
+                page = _PortalPageParser()
+                page.feed(await response.text())
+
+            if page.result_found:
+                return page
+            # No result container usually means the ViewState expired; reload the form once.
+            form = await self._load_form(session, stale_form=form)
+        return page
+
+    async def scrape_protocol(self, session, year, number):
         try:
-            with tqdm(total=high, desc=f"Binary searching in {year}") as pbar:
-                # Adjust the range to avoid testing 0 and to have a more realistic start
-                if low == 0: low = 1
-
-                while low <= high:
-                    mid = (low + high) // 2
-                    if mid == 0: # Skip protocol 0
-                        low = 1
-                        continue
+            page = await self._query(session, year, number)
+            if page.result_has_fieldset and f"{year}/{number}" in page.fieldset_text:
+                content = page.fieldset_text
+                arquivado, last_update = classify_content(content)
+            elif page.result_found:
+                content, arquivado, last_update = page.result_text, "no", None
+            else:
+                content, arquivado, last_update = "Timeout: Protocol not found or page did not load.", "no", None
+            return year, number, content, arquivado, last_update
+        except Exception as e:
+            logging.error(f"Error scraping {year}/{number}: {e}")
+            return year, number, f"SCRAPE_ERROR: {e}", "no", None
 
-                    pbar.set_description(f"Testing {mid}")
-                    
-                    if self._check_protocol_exists(driver, wait, year, mid):
-                        # Found one, it could be the latest. Try for a higher number.
-                        latest_found = mid
-                        low = mid + 1
-                    else:
-                        # Not found, the latest must be in the lower half.
-                        high = mid - 1
-                    
-                    # Update progress bar
-                    pbar.n = latest_found
-                    pbar.refresh()
-        finally:
-            driver.quit()
-        
-        logging.info(f"Found latest protocol for {year}: {latest_found}")
-        return latest_found
+    async def check_protocol_exists(self, year, number):
+        try:
+            page = await self._query(None, year, number)
+            return page.result_has_fieldset and f"{year}/{number}" in page.fieldset_text
+        except Exception as e:
+            logging.warning(f"An error occurred in check_protocol_exists for {year}/{number}: {e}")
+            return False
 
 # --- Main Application Logic ---
 
@@ -313,129 +1106,230 @@ async def main():
     setup_logging(config.log_file)
 
     parser = argparse.ArgumentParser(description="Protocol Scraper and Analyzer.")
-    parser.add_argument('action', choices=['init_db', 'scrape', 'analyze'], help='Action to perform.')
+    parser.add_argument('action', choices=['init_db', 'scrape', 'retry', 'analyze'],
+                        help="Action to perform. 'retry' only re-scrapes sequence gaps and stored error rows.")
     parser.add_argument('--year', type=int, help='Year to process.')
     parser.add_argument('--force-update', action='store_true', help='Force update of all protocols for the year.')
     parser.add_argument('--no-headless', action='store_true', help='Run browser in non-headless mode.')
+    parser.add_argument('--engine', choices=['selenium', 'http'], default=config.engine or 'selenium',
+                        help='Scraping engine: a headless Chrome pool or direct JSF form posts.')
+    parser.add_argument('--base-url', default=config.base_url, help='Portal URL (e.g. a local portal_stub.py).')
+    parser.add_argument('--time-budget', type=float,
+                        help='Stop leasing work after this many seconds; the rest stays queued for the next run.')
     args = parser.parse_args()
 
     # Load keyword filters from config
     lista_original = config.settings.get('lista_original', [])
     familias = config.settings.get('familias', {})
     LISTA_NORMALIZADA = get_lista_normalizada(lista_original, familias)
+    indexed_keywords = get_indexed_keywords(lista_original, familias)
+
+    deadline = time.monotonic() + args.time_budget if args.time_budget else None
+    max_attempts = config.max_scrape_attempts or 3
 
-    with DatabaseManager(config.database_name) as db:
+    with DatabaseManager(
+        config.database_name,
+        keywords=indexed_keywords,
+        retry_backoff=config.retry_backoff_seconds or 60,
+        retry_backoff_max=config.retry_backoff_max_seconds or 86400,
+    ) as db:
         if args.action == 'init_db':
             db.init_db()
 
-        elif args.action == 'scrape':
-            scraper = ProtocolScraper(config.base_url, headless=not args.no_headless)
+        elif args.action in ('scrape', 'retry'):
+            retry_only = args.action == 'retry'
+            min_priority = PRIORITY_GAP if retry_only else PRIORITY_NORMAL
+            # Bring the keyword index in line with config.json before new rows are indexed at ingest.
+            added, removed = sync_keyword_index(db.conn, indexed_keywords)
+            if added or removed:
+                logging.info(f"Keyword index updated: {len(added)} keywords added, {len(removed)} removed.")
+            init_protocol_fields(db.conn)
+            init_change_log(db.conn)
+            # Backfill of the structured fields for rows stored before the parser existed (or
+            # before PARSER_VERSION changed); after the first run only new rows are left.
+            parsed = sync_protocol_fields(db.conn)
+            if parsed:
+                logging.info(f"Structured fields extracted for {parsed} stored protocols.")
+
+            limiter = AdaptiveConcurrency(
+                initial=config.max_concurrent_tasks,
+                minimum=config.concurrency_min or 1,
+                maximum=config.concurrency_max or config.max_concurrent_tasks,
+                window=config.concurrency_window or 20,
+                max_error_rate=config.concurrency_max_error_rate or 0.1,
+                latency_tolerance=config.concurrency_latency_tolerance or 2.0,
+            )
+            # Size the driver / connection pools for the controller's upper bound.
+            if args.engine == 'http':
+                scraper = HttpProtocolScraper(args.base_url, pool_size=limiter.maximum)
+            else:
+                scraper = ProtocolScraper(
+                    args.base_url,
+                    headless=not args.no_headless,
+                    pool_size=limiter.maximum,
+                    driver_max_uses=config.driver_max_uses or 200,
+                )
             years_to_process = [args.year] if args.year else config.hardcoded_years.keys()
             
-            all_newly_scraped = defaultdict(list)
-
-            for year in years_to_process:
-                year = int(year)
-                logging.info(f"--- Processing year: {year} ---")
-                
-                if str(year) == str(config.current_year):
-                    max_num = scraper.find_latest_protocol_number(year)
-                else:
-                    max_num = config.hardcoded_years.get(str(year))
+            # Keyword hits among the protocols whose content changed, reported in Update.txt.
+            summary = UpdateSummaryWriter('Update.txt', LISTA_NORMALIZADA)
+            writer = ProtocolWriter(
+                db,
+                batch_size=config.write_batch_size or 200,
+                flush_interval=config.write_flush_seconds or 5,
+                summary=summary,
+            )
+            db.init_queue()
+            db.release_stale_leases()
+            # Work finished within this window belongs to the current cycle and is not redone.
+            requeue_before = datetime.now() - timedelta(hours=config.requeue_after_hours or 20)
 
-                if not max_num:
-                    logging.error(f"Could not determine max protocol number for {year}.")
-                    continue
+            def out_of_time():
+                return deadline is not None and time.monotonic() >= deadline
 
-                all_protocols = set(range(1, max_num + 1))
+            try:
+                for year in years_to_process:
+                    if out_of_time():
+                        break
+                    year = int(year)
+                    logging.info(f"--- Processing year: {year} ---")
                 
-                if args.force_update:
-                    protocols_to_scrape = sorted(list(all_protocols))
-                else:
-                    existing_protocols = db.get_existing_protocols(year)
-                    new_protocols = all_protocols - existing_protocols
-                    protocols_to_update = db.get_protocols_to_update(year,60)
-                    protocols_to_scrape = sorted(list(new_protocols.union(protocols_to_update)))
+                    if retry_only:
+                        # No search for new protocols: only what the stored data says is missing or broken.
+                        max_num = None if str(year) == str(config.current_year) else config.hardcoded_years.get(str(year))
+                    elif str(year) == str(config.current_year):
+                        max_num = await scraper.find_latest_protocol_number(
+                            year,
+                            start=db.get_latest_protocol_number(year),
+                            parallel_probes=config.max_concurrent_tasks,
+                            hole_tolerance=config.latest_search_hole_tolerance or 3,
+                        )
+                    else:
+                        max_num = config.hardcoded_years.get(str(year))
 
+                    if not retry_only:
+                        if not max_num:
+                            logging.error(f"Could not determine max protocol number for {year}.")
+                            continue
 
-                if not protocols_to_scrape:
-                    logging.info(f"No new or unarchived protocols to scrape for {year}.")
-                    continue
+                        all_protocols = set(range(1, max_num + 1))
+                    
+                        if args.force_update:
+                            protocols_to_scrape = sorted(list(all_protocols))
+                        else:
+                            existing_protocols = db.get_existing_protocols(year)
+                            new_protocols = all_protocols - existing_protocols
+                            protocols_to_update = db.get_protocols_to_update(year,60)
+                            protocols_to_scrape = sorted(list(new_protocols.union(protocols_to_update)))
 
-                logging.info(f"Found {len(protocols_to_scrape)} protocols to scrape for {year}.")
-                all_newly_scraped[year] = protocols_to_scrape
+                        db.enqueue_protocols(year, protocols_to_scrape, requeue_before)
 
-                chunk_size = 1000
-                protocol_chunks = [protocols_to_scrape[i:i + chunk_size] for i in range(0, len(protocols_to_scrape), chunk_size)]
+                    # Holes in the stored sequence and rows holding error text go to the front of the queue.
+                    # A normal scrape already queued the numbers above the stored maximum as new
+                    # protocols; only 'retry', which queues nothing else, treats them as missing.
+                    upto = max_num if retry_only else None
+                    gaps = [n for first, last in db.find_sequence_gaps(year, upto=upto) for n in range(first, last + 1)]
+                    error_rows = db.find_error_rows(year)
+                    db.enqueue_retries(year, gaps, PRIORITY_GAP, requeue_before)
+                    db.enqueue_retries(year, error_rows, PRIORITY_ERROR_ROW, requeue_before)
+                    if gaps or error_rows:
+                        logging.info(f"Year {year}: {len(gaps)} missing numbers and {len(error_rows)} error rows queued for retry.")
 
-                for i, chunk in enumerate(protocol_chunks):
-                    logging.info(f"--- Processing chunk {i+1}/{len(protocol_chunks)} for year {year} ({len(chunk)} protocols) ---")
-                    
-                    tasks = []
-                    sem = asyncio.Semaphore(config.max_concurrent_tasks)
-                    async def scrape_with_sem(protocol_number):
-                        async with sem:
-                            return await scraper.scrape_protocol(None, year, protocol_number)
-
-                    for number in chunk:
-                        tasks.append(scrape_with_sem(number))
-
-                    for future in asyncio_tqdm.as_completed(tasks, total=len(tasks), desc=f"Scraping {year} (chunk {i+1}/{len(protocol_chunks)})"):
-                        res_year, res_number, res_content, res_arquivado, res_last_update = await future
-                        if not res_last_update:
-                            res_last_update = datetime.now().strftime('%Y-%m-%d')
-                        db.insert_protocol(res_year, res_number, res_content, res_arquivado, res_last_update)
-            
-            # --- Analyze newly scraped protocols and generate Update.txt ---
-            logging.info("Analyzing newly scraped protocols for keyword matches...")
-            new_matching_protocols = []
-            
-            for year, numbers in all_newly_scraped.items():
-                for number in numbers:
-                    cursor = db.execute("SELECT content FROM protocols WHERE year = ? AND number = ?", (year, number))
-                    row = cursor.fetchone()
-                    if not row or not row[0]:
+                    queued = db.count_queued(year, max_attempts, min_priority)
+
+                    if not queued:
+                        logging.info(f"No new or unarchived protocols to scrape for {year}.")
                         continue
-                    
-                    content = row[0]
-                    if contains_any_keyword(content, LISTA_NORMALIZADA):
-                        protocol_id = f"{year}/{str(number).zfill(5)}"
-                        new_matching_protocols.append({'id': protocol_id, 'content': content})
-
-            if new_matching_protocols:
-                logging.info(f"Found {len(new_matching_protocols)} new matching protocols. Generating Update.txt.")
-                with open('Update.txt', 'w', encoding='utf-8') as f:
-                    f.write(f"Update de {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}\n\n")
-                    f.write(f"Foram encontrados {len(new_matching_protocols)} novos protocolos de interesse:\n\n")
-                    for proto in new_matching_protocols:
-                        f.write(f"--- {proto['id']} ---\n")
-                        f.write(f"{proto['content']}\n\n")
+
+                    logging.info(f"Found {queued} protocols to scrape for {year}.")
+
+                    chunk_size = 1000
+                    async def scrape_with_limit(protocol_number):
+                        async with limiter:
+                            started = time.monotonic()
+                            result = await scraper.scrape_protocol(None, year, protocol_number)
+                            limiter.record(time.monotonic() - started, result[2])
+                            return result
+
+                    chunk_number = 0
+                    while not out_of_time():
+                        chunk = db.lease_protocols(year, chunk_size, max_attempts, min_priority)
+                        if not chunk:
+                            break
+                        chunk_number += 1
+                        logging.info(f"--- Processing chunk {chunk_number} for year {year} ({len(chunk)} protocols) ---")
+
+                        tasks = [asyncio.ensure_future(scrape_with_limit(number)) for number in chunk]
+                        try:
+                            for future in asyncio_tqdm.as_completed(tasks, total=len(tasks), desc=f"Scraping {year} (chunk {chunk_number})"):
+                                res_year, res_number, res_content, res_arquivado, res_last_update = await future
+                                if not res_last_update:
+                                    res_last_update = datetime.now().strftime('%Y-%m-%d')
+                                writer.add(res_year, res_number, res_content, res_arquivado, res_last_update)
+                                if out_of_time():
+                                    break
+                        finally:
+                            # Unfinished lookups stay leased and are picked up again by the next run.
+                            for task in tasks:
+                                task.cancel()
+
+                if out_of_time():
+                    logging.warning("Time budget exhausted; the remaining protocols stay queued for the next run.")
+            finally:
+                # Write what is still buffered and release pooled Chrome sessions /
+                # HTTP connections, even if the run is interrupted.
+                writer.flush()
+                await scraper.close()
+                logging.info(f"Stored {writer.written} protocols ({writer.changed} new or changed); "
+                             f"{writer.failed} lookups failed and stay queued for retry.")
+
+            # --- Update.txt: keyword hits collected while the rows were written ---
+            summary.close()
+            if summary.count:
+                logging.info(f"Found {summary.count} changed protocols matching the keywords. Update.txt generated.")
             else:
-                logging.info("No new matching protocols found. Generating empty Update.txt.")
-                with open('Update.txt', 'w', encoding='utf-8') as f:
-                    f.write(f"Sem update. {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}")
-            
-            logging.info("Update.txt generated.")
+                logging.info("No changed protocols matching the keywords. Generated empty Update.txt.")
 
         elif args.action == 'analyze':
             logging.info("--- Analyzing Protocol Gaps ---")
-            years = [args.year] if args.year else list(config.hardcoded_years.keys()) + [config.current_year]
+            years = [args.year] if args.year else sorted({int(y) for y in config.hardcoded_years} | {int(config.current_year)})
+            db.init_queue()
             for year in years:
                 year = int(year)
-                rows = db.fetchall('SELECT number FROM protocols WHERE year = ? ORDER BY number', (year,))
-                if not rows:
+                count, first, last = db.fetchall(
+                    'SELECT COUNT(*), MIN(number), MAX(number) FROM protocols WHERE year = ?', (year,)
+                )[0]
+                if not count:
                     logging.warning(f"No data for year {year} to analyze.")
                     continue
-                
-                numbers = {row[0] for row in rows}
-                first, last = min(numbers), max(numbers)
-                missing = set(range(first, last + 1)) - numbers
 
-                logging.info(f"Year {year}: Found {len(numbers)} protocols (from {first} to {last}).")
-                if missing:
-                    logging.warning(f"  - Missing {len(missing)} protocols. Examples: {sorted(list(missing))[:10]}")
+                logging.info(f"Year {year}: Found {count} protocols (from {first} to {last}).")
+                gaps = db.find_sequence_gaps(year)
+                if gaps:
+                    missing = sum(gap_last - gap_first + 1 for gap_first, gap_last in gaps)
+                    examples = [n for gap_first, gap_last in gaps[:10] for n in range(gap_first, min(gap_last, gap_first + 9) + 1)][:10]
+                    logging.warning(f"  - Missing {missing} protocols in {len(gaps)} gaps. Examples: {examples}")
                 else:
                     logging.info("  - No protocols missing in the sequence.")
 
+                error_rows = db.find_error_rows(year)
+                if error_rows:
+                    logging.warning(f"  - {len(error_rows)} stored rows hold scrape errors. Examples: {error_rows[:10]}")
+
+                queue_summary = db.get_queue_summary(year)
+                if queue_summary:
+                    logging.info(f"  - Work queue: {queue_summary}")
+                exhausted = db.count_exhausted(year, max_attempts)
+                if exhausted:
+                    logging.warning(f"  - {exhausted} protocols gave up after {max_attempts} attempts.")
+                if gaps or error_rows:
+                    logging.info("  - Run the 'retry' action (or a normal scrape) to re-scrape them first.")
+
+def _handle_sigterm(signum, frame):
+    # Treat SIGTERM like Ctrl+C: asyncio.run() then cancels main(), whose
+    # cleanup flushes the buffered results before the process exits.
+    raise KeyboardInterrupt
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     asyncio.run(main())
\ No newline at end of file
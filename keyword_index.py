@@ -0,0 +1,208 @@
+import functools
+import json
+import re
+import sqlite3
+import unicodedata
+
+from db_meta import ensure_meta, table_exists
+
+# --- Configuração ---
+CONFIG_FILE = 'config.json'
+AMABRE_KEYWORD = 'amabre'
+META_KEY = 'keyword_index.keywords'
+HIGHLIGHTS_META_KEY = 'keyword_index.highlights'
+BATCH_SIZE = 1000
+
+
+def remover_acentos(txt):
+    if not txt:
+        return ""
+    return ''.join(c for c in unicodedata.normalize('NFD', txt) if unicodedata.category(c) != 'Mn')
+
+def get_lista_normalizada(lista_original, familias):
+    mapa_familias = {}
+    for key, variantes in familias.items():
+        for v in variantes:
+            mapa_familias[remover_acentos(v).lower()] = set(remover_acentos(va).lower() for va in variantes)
+
+    lista_normalizada = set()
+    for nome in lista_original:
+        nome_sem_acento = remover_acentos(nome).lower()
+        if nome_sem_acento in mapa_familias:
+            lista_normalizada.update(mapa_familias[nome_sem_acento])
+        else:
+            lista_normalizada.add(nome_sem_acento)
+    return list(lista_normalizada)
+
+def get_indexed_keywords(lista_original, familias):
+    """Palavras-chave mantidas no índice: a lista normalizada mais 'amabre', usada pelo filtro AMABRE."""
+    return sorted(set(get_lista_normalizada(lista_original, familias)) | {AMABRE_KEYWORD})
+
+def match_keywords(content, keywords):
+    """Retorna as palavras-chave contidas no texto, com a mesma normalização do app (sem acentos, minúsculas)."""
+    if not content:
+        return set()
+    content_norm = remover_acentos(content).lower()
+    return {kw for kw in keywords if kw in content_norm}
+
+def normalize_with_positions(text):
+    """
+    Normaliza como remover_acentos(text).lower() e devolve também, para cada
+    caractere do texto normalizado, sua posição no texto original. Para texto
+    ASCII as posições são as mesmas e o segundo valor é None.
+    """
+    if text.isascii():
+        return text.lower(), None
+    chars, positions = [], []
+    for i, ch in enumerate(text):
+        if ch.isascii():
+            chars.append(ch.lower())
+            positions.append(i)
+            continue
+        for c in unicodedata.normalize('NFD', ch):
+            if unicodedata.category(c) != 'Mn':
+                for lc in c.lower():
+                    chars.append(lc)
+                    positions.append(i)
+    return ''.join(chars), positions
+
+@functools.lru_cache(maxsize=64)
+def compile_keywords(keywords):
+    """
+    Compila uma única expressão para a tupla de termos já normalizados. Termos com
+    várias palavras ("bom retiro") aceitam qualquer espaço entre elas; um '*' no fim
+    vira busca por prefixo. Só casam palavras inteiras.
+    """
+    parts = []
+    for kw in sorted(keywords, key=len, reverse=True):
+        words = kw.rstrip('*').split()
+        if words:
+            parts.append(r'\s+'.join(re.escape(w) for w in words) + (r'\w*' if kw.endswith('*') else ''))
+    if not parts:
+        return None
+    return re.compile(r'(?<!\w)(?:' + '|'.join(parts) + r')(?!\w)')
+
+def find_keyword_spans(content, keywords):
+    """Retorna [(termo, início, fim)] com as posições no texto original de cada ocorrência."""
+    pattern = compile_keywords(tuple(sorted(set(keywords))))
+    if pattern is None or not content:
+        return []
+    normalized, positions = normalize_with_positions(content)
+    spans = []
+    for m in pattern.finditer(normalized):
+        start, end = m.span()
+        if positions is not None:
+            start, end = positions[start], positions[end - 1] + 1
+        spans.append((' '.join(m.group().split()), start, end))
+    return spans
+
+def _highlights_json(content, keywords):
+    spans = {}
+    for kw, start, end in find_keyword_spans(content, keywords):
+        spans.setdefault(kw, []).append([start, end])
+    return json.dumps(spans, separators=(',', ':'))
+
+
+def init_keyword_index(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS protocol_keywords (
+            keyword TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            PRIMARY KEY (keyword, year, number)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_protocol_keywords_protocol ON protocol_keywords (year, number);
+        -- Posições das palavras-chave no texto ({termo: [[início, fim], ...]}), usadas no destaque.
+        CREATE TABLE IF NOT EXISTS protocol_highlights (
+            year INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            spans TEXT NOT NULL,
+            PRIMARY KEY (year, number)
+        ) WITHOUT ROWID;
+    """)
+    ensure_meta(conn)
+
+def index_protocols(conn, rows, keywords, matches=None):
+    """
+    Atualiza o índice para as linhas (year, number, content) dadas.
+    Não faz commit: quem chama decide a transação (o scraper grava junto com os protocolos).
+    Quem já calculou match_keywords de cada linha passa o resultado em matches
+    (na mesma ordem de rows) para o texto não ser normalizado de novo.
+    """
+    rows = list(rows)
+    if matches is None:
+        matches = [match_keywords(content, keywords) for _, _, content in rows]
+    conn.executemany("DELETE FROM protocol_keywords WHERE year = ? AND number = ?",
+                     [(year, number) for year, number, _ in rows])
+    conn.executemany(
+        "INSERT OR IGNORE INTO protocol_keywords (keyword, year, number) VALUES (?, ?, ?)",
+        [(kw, year, number) for (year, number, _), found in zip(rows, matches) for kw in found]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO protocol_highlights (year, number, spans) VALUES (?, ?, ?)",
+        [(year, number, _highlights_json(content, keywords)) for year, number, content in rows]
+    )
+
+def _indexed_keywords(conn, key=META_KEY):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return set(json.loads(row[0])) if row else set()
+
+def sync_keyword_index(conn, keywords, full=False):
+    """
+    Deixa o índice de acordo com a lista de palavras-chave atual. Só as palavras
+    que entraram na configuração desde a última sincronização são procuradas nos
+    textos; as que saíram são apenas apagadas do índice. As posições de destaque
+    são recalculadas (numa única passada pelos textos) sempre que a lista muda.
+    Retorna (adicionadas, removidas).
+    """
+    init_keyword_index(conn)
+    keywords = set(keywords)
+    indexed = set() if full else _indexed_keywords(conn)
+    added, removed = keywords - indexed, indexed - keywords
+    rebuild_highlights = full or _indexed_keywords(conn, HIGHLIGHTS_META_KEY) != keywords
+
+    with conn:
+        if full:
+            conn.execute("DELETE FROM protocol_keywords")
+        if removed:
+            conn.executemany("DELETE FROM protocol_keywords WHERE keyword = ?", [(kw,) for kw in removed])
+        if added or rebuild_highlights:
+            batch, highlights = [], []
+            for year, number, content in conn.execute("SELECT year, number, content FROM protocols"):
+                batch.extend((kw, year, number) for kw in match_keywords(content, added))
+                if rebuild_highlights:
+                    highlights.append((year, number, _highlights_json(content, keywords)))
+                if len(batch) >= BATCH_SIZE or len(highlights) >= BATCH_SIZE:
+                    conn.executemany("INSERT OR IGNORE INTO protocol_keywords (keyword, year, number) VALUES (?, ?, ?)", batch)
+                    conn.executemany("INSERT OR REPLACE INTO protocol_highlights (year, number, spans) VALUES (?, ?, ?)", highlights)
+                    batch, highlights = [], []
+            conn.executemany("INSERT OR IGNORE INTO protocol_keywords (keyword, year, number) VALUES (?, ?, ?)", batch)
+            conn.executemany("INSERT OR REPLACE INTO protocol_highlights (year, number, spans) VALUES (?, ?, ?)", highlights)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (META_KEY, json.dumps(sorted(keywords))))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (HIGHLIGHTS_META_KEY, json.dumps(sorted(keywords))))
+    return added, removed
+
+def keyword_index_available(conn):
+    return table_exists(conn, 'protocol_keywords')
+
+def highlights_available(conn):
+    return table_exists(conn, 'protocol_highlights')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sincroniza o índice de palavras-chave com o config.json.")
+    parser.add_argument('--full', action='store_true', help='Reconstrói o índice inteiro.')
+    args = parser.parse_args()
+
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    keywords = get_indexed_keywords(config.get('lista_original', []), config.get('familias', {}))
+    conn = sqlite3.connect(config.get('database_name', 'protocols.db'))
+    try:
+        added, removed = sync_keyword_index(conn, keywords, full=args.full)
+        print(f"Índice de palavras-chave sincronizado: {len(added)} adicionadas, {len(removed)} removidas.")
+    finally:
+        conn.close()
@@ -0,0 +1,177 @@
+"""
+Local stand-in for the prefeitura portal, used to exercise the scraper engines
+without hitting the real site:
+
+    python portal_stub.py --port 8765 --latest 2025=1200 --missing 2025/17
+    python enhanced_protocol_scraper.py scrape --year 2025 --engine http --base-url http://127.0.0.1:8765/
+
+It mimics the parts of the real page the scrapers rely on: an outer page with an
+iframe, a JSF form with a ViewState and session cookie, and the
+`form:resultadoSituacaoNumero` result span. Protocol text is synthetic unless
+`--db` points at an existing protocols.db.
+"""
+import argparse
+import html
+import secrets
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+FORM_PATH = '/grp/acessoexterno/situacao.faces'
+TIPOS = ['', 'Alvará', 'Certidão', 'Denúncia', 'Fiscalização', 'Licença', 'Obras',
+         'Processo', 'Requerimento', 'Tributos', 'Ouvidoria', 'Outros']
+
+OUTER_PAGE = """<html><body><iframe src="{form_path}"></iframe></body></html>"""
+
+FORM_PAGE = """<html><body>
+<form id="form" name="form" method="post" action="{form_path}">
+<input type="hidden" name="form" value="form"/>
+<input id="form:exercicioSituacaoNumero:field" name="form:exercicioSituacaoNumero:field" type="text" value=""/>
+<input id="form:numeroSituacaoNumero:field" name="form:numeroSituacaoNumero:field" type="text" value=""/>
+<input id="form:volumeSituacaoNumero:field" name="form:volumeSituacaoNumero:field" type="text" value=""/>
+<select id="form:tipoProtocoloSituacaoNumero:select" name="form:tipoProtocoloSituacaoNumero:select">
+{options}
+</select>
+<input id="form:j_id_42:0:j_id_46" name="form:j_id_42:0:j_id_46" type="submit" value="Localizar"/>
+<span id="form:resultadoSituacaoNumero">{result}</span>
+<input type="hidden" name="javax.faces.ViewState" id="javax.faces.ViewState" value="{view_state}"/>
+</form>
+</body></html>"""
+
+SYNTHETIC_CONTENT = """Processo: Ouvidoria {year}/{number} Vol. 1
+
+Situação Em andamento, recebido em 02/03/{year} por Departamento Ouvidoria
+Assunto: Manutenção de via
+Síntese: Solicita reparo na Rua Bom Retiro, {number}.
+
+Encaminhamentos
+1 SEMOB - Diretoria Geral em 02/03/{year};"""
+
+
+class PortalState:
+    def __init__(self, latest, missing, db_path=None):
+        self.latest = latest
+        self.missing = missing
+        self.db_path = db_path
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        session_id, view_state = secrets.token_hex(8), secrets.token_hex(16)
+        with self.lock:
+            self.sessions[session_id] = view_state
+        return session_id, view_state
+
+    def valid(self, session_id, view_state):
+        with self.lock:
+            return session_id is not None and self.sessions.get(session_id) == view_state
+
+    def lookup(self, year, number):
+        if (year, number) in self.missing or not 1 <= number <= self.latest.get(year, 0):
+            return None
+        if self.db_path:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute("SELECT content FROM protocols WHERE year = ? AND number = ?", (year, number)).fetchone()
+            if row and row[0]:
+                return row[0]
+        return SYNTHETIC_CONTENT.format(year=year, number=number)
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _session_id(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'JSESSIONID':
+                return value
+        return None
+
+    def _send(self, body, session_id=None):
+        payload = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        if session_id:
+            self.send_header('Set-Cookie', f'JSESSIONID={session_id}; Path=/')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _form_page(self, view_state, result=''):
+        options = '\n'.join(f'<option value="{i}">{html.escape(t)}</option>' for i, t in enumerate(TIPOS))
+        return FORM_PAGE.format(form_path=FORM_PATH, options=options, result=result, view_state=view_state)
+
+    def do_GET(self):
+        if self.path.split('?')[0] == FORM_PATH:
+            session_id, view_state = self.state.new_session()
+            self._send(self._form_page(view_state), session_id)
+        else:
+            self._send(OUTER_PAGE.format(form_path=FORM_PATH))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        session_id, view_state = self._session_id(), data.get('javax.faces.ViewState')
+
+        if not self.state.valid(session_id, view_state):
+            # Behaves like an expired view: back to a blank page without the result span.
+            self._send('<html><body>Sessão expirada.</body></html>')
+            return
+
+        try:
+            year = int(data.get('form:exercicioSituacaoNumero:field', ''))
+            number = int(data.get('form:numeroSituacaoNumero:field', ''))
+        except ValueError:
+            year = number = 0
+
+        content = self.state.lookup(year, number)
+        if content is None:
+            result = 'Protocolo não localizado.'
+        else:
+            lines = '<br/>'.join(html.escape(line) for line in content.split('\n'))
+            result = f'<fieldset>{lines}</fieldset>'
+        self._send(self._form_page(view_state, result))
+
+
+def parse_latest(values):
+    latest = {}
+    for value in values:
+        year, _, number = value.partition('=')
+        latest[int(year)] = int(number)
+    return latest
+
+
+def parse_missing(values):
+    missing = set()
+    for value in values:
+        year, _, number = value.partition('/')
+        missing.add((int(year), int(number)))
+    return missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stub of the protocol portal.")
+    parser.add_argument('--port', type=int, default=8765, help='0 picks a free port (printed at startup).')
+    parser.add_argument('--latest', action='append', default=[], help='YEAR=N: protocols 1..N exist for YEAR.')
+    parser.add_argument('--missing', action='append', default=[], help='YEAR/N: answer "não localizado" for this number.')
+    parser.add_argument('--db', help='Serve content from an existing protocols.db instead of synthetic text.')
+    args = parser.parse_args()
+
+    PortalHandler.state = PortalState(parse_latest(args.latest), parse_missing(args.missing), args.db)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), PortalHandler)
+    # The bound port, so --port 0 (any free port) can be used by tests.
+    print(f"Portal stub listening on http://127.0.0.1:{server.server_address[1]}/ (Ctrl+C to stop)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
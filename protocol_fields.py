@@ -0,0 +1,227 @@
+import json
+import re
+import sqlite3
+from datetime import datetime
+
+from db_meta import ensure_meta, table_exists
+
+# --- Configuração ---
+CONFIG_FILE = 'config.json'
+# Suba a versão quando o parser mudar: a próxima sincronização reprocessa tudo.
+PARSER_VERSION = 2
+META_KEY = 'protocol_fields.version'
+BATCH_SIZE = 1000
+
+# "Situação Arquivo em 21/11/2025, recebido em ..." ou, sem data, "Situação Em andamento, recebido em ...".
+SITUACAO_RE = re.compile(r'^Situação\s+(.+?)(?:\s+em\s+(\d{2}/\d{2}/\d{4}))?(?:,|$)')
+SITUACAO_RECEBIDO_RE = re.compile(r'\brecebido em\s+(\d{2}/\d{2}/\d{4})')
+SITUACAO_DEPARTAMENTO_RE = re.compile(r'\bpor\s+(.+?)(?=,\s*recebido em|$)')
+# "3 SEMMAS - Bem Estar Animal em 21/11/2025; Despacho: ..."
+STEP_RE = re.compile(r'^(\d+)\s+(.+?)\s+em\s+(\d{2}/\d{2}/\d{4});?\s*(?:Despacho:\s*(.*))?$')
+FIELD_PREFIXES = (('Processo:', 'processo'), ('Assunto:', 'assunto'), ('Síntese:', 'sintese'), ('Despacho:', 'despacho'))
+
+
+def to_iso(date_str):
+    """dd/mm/aaaa -> aaaa-mm-dd (None se a data não existir)."""
+    try:
+        return datetime.strptime(date_str, '%d/%m/%Y').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def parse_protocol(content):
+    """
+    Separa o texto de um protocolo nas partes que o portal sempre mostra:
+    Processo, Situação (status, data e departamento atual), Assunto, Síntese,
+    Despacho e os Encaminhamentos numerados (departamento, data e despacho).
+    Linhas que continuam um campo (síntese ou despacho em várias linhas) são
+    juntadas a ele. Campos ausentes ficam None; datas saem em aaaa-mm-dd.
+    """
+    fields = {
+        'processo': None, 'situacao': None, 'situacao_data': None, 'departamento_atual': None,
+        'assunto': None, 'sintese': None, 'despacho': None, 'despacho_data': None,
+        'steps': [],
+    }
+    if not content:
+        return fields
+
+    section, current = 'header', None
+    for raw_line in content.splitlines():
+        line = raw_line.strip()
+        if not line:
+            current = None
+            continue
+        if line == 'Encaminhamentos':
+            section, current = 'steps', None
+            continue
+        if line.startswith('Anexos do protocolo'):
+            section, current = 'anexos', None
+            continue
+
+        if section == 'steps':
+            match = STEP_RE.match(line)
+            if match:
+                seq, departamento, data, despacho = match.groups()
+                fields['steps'].append({
+                    'seq': int(seq), 'departamento': departamento.strip(), 'data': to_iso(data), 'despacho': despacho,
+                })
+            elif fields['steps']:
+                last = fields['steps'][-1]
+                last['despacho'] = f"{last['despacho']}\n{line}" if last['despacho'] else line
+            continue
+        if section == 'anexos':
+            continue
+
+        if line.startswith('Situação'):
+            match = SITUACAO_RE.match(line)
+            if match:
+                fields['situacao'], fields['situacao_data'] = match.group(1).strip(), to_iso(match.group(2))
+            if fields['situacao_data'] is None:
+                # Sem data logo após o status, vale a do último recebimento (o do departamento atual).
+                recebidos = SITUACAO_RECEBIDO_RE.findall(line)
+                if recebidos:
+                    fields['situacao_data'] = to_iso(recebidos[-1])
+            departamentos = SITUACAO_DEPARTAMENTO_RE.findall(line)
+            if departamentos:
+                # "por Departamento Ouvidoria": sem o prefixo, para bater com os nomes dos encaminhamentos.
+                departamento = departamentos[-1].strip()
+                fields['departamento_atual'] = departamento[len('Departamento '):] if departamento.startswith('Departamento ') else departamento
+            current = None
+            continue
+        if line.startswith('Despacho em '):
+            fields['despacho_data'] = to_iso(line[len('Despacho em '):].strip())
+            current = None
+            continue
+        for prefix, name in FIELD_PREFIXES:
+            if line.startswith(prefix):
+                fields[name] = line[len(prefix):].strip()
+                current = name
+                break
+        else:
+            if current:
+                fields[current] = f"{fields[current]}\n{line}"
+    return fields
+
+def latest_date(fields):
+    """Data mais recente entre a situação, o despacho e os encaminhamentos (None se não houver)."""
+    dates = [fields['situacao_data'], fields['despacho_data']] + [step['data'] for step in fields['steps']]
+    dates = [d for d in dates if d]
+    return max(dates) if dates else None
+
+
+def init_protocol_fields(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS protocol_fields (
+            year INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            processo TEXT,
+            situacao TEXT,
+            situacao_data TEXT,
+            departamento_atual TEXT,
+            assunto TEXT,
+            PRIMARY KEY (year, number)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_protocol_fields_assunto ON protocol_fields (assunto);
+        CREATE INDEX IF NOT EXISTS idx_protocol_fields_situacao ON protocol_fields (situacao);
+        CREATE INDEX IF NOT EXISTS idx_protocol_fields_departamento ON protocol_fields (departamento_atual);
+        -- Um registro por encaminhamento ("3 SEMMAS - Bem Estar Animal em 21/11/2025").
+        CREATE TABLE IF NOT EXISTS protocol_steps (
+            year INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            departamento TEXT NOT NULL,
+            data TEXT,
+            PRIMARY KEY (year, number, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_protocol_steps_departamento ON protocol_steps (departamento, data);
+        CREATE INDEX IF NOT EXISTS idx_protocol_steps_data ON protocol_steps (data);
+        -- Ordenação por data no app (mesma expressão usada no ORDER BY).
+        CREATE INDEX IF NOT EXISTS idx_protocols_last_update ON protocols (IFNULL(Last_update, ''), year, number);
+    """)
+    ensure_meta(conn)
+
+def index_fields(conn, rows, parsed=None):
+    """
+    Grava os campos e encaminhamentos das linhas (year, number, content) dadas.
+    Não faz commit: quem chama decide a transação (o scraper grava junto com os protocolos).
+    Quem já rodou parse_protocol passa o resultado em parsed, na mesma ordem de rows.
+    """
+    rows = list(rows)
+    if parsed is None:
+        parsed = [parse_protocol(content) for _, _, content in rows]
+    keys = [(year, number) for year, number, _ in rows]
+    conn.executemany("DELETE FROM protocol_steps WHERE year = ? AND number = ?", keys)
+    conn.executemany(
+        """INSERT OR REPLACE INTO protocol_fields
+           (year, number, processo, situacao, situacao_data, departamento_atual, assunto)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        [(year, number, f['processo'], f['situacao'], f['situacao_data'], f['departamento_atual'], f['assunto'])
+         for (year, number), f in zip(keys, parsed)]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO protocol_steps (year, number, seq, departamento, data) VALUES (?, ?, ?, ?, ?)",
+        [(year, number, step['seq'], step['departamento'], step['data'])
+         for (year, number), f in zip(keys, parsed) for step in f['steps']]
+    )
+
+def sync_protocol_fields(conn, full=False, update_last_update=False):
+    """
+    Preenche as tabelas para os protocolos que ainda não têm campos (backfill),
+    em lotes com commit a cada um, então pode ser interrompido e retomado. Com
+    full=True, ou quando PARSER_VERSION mudou, reprocessa todos. Com
+    update_last_update=True corrige também o Last_update dos protocolos pela
+    data mais recente dos campos. Retorna o número de protocolos processados.
+    """
+    init_protocol_fields(conn)
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (META_KEY,)).fetchone()
+    if full or row is None or int(row[0]) != PARSER_VERSION:
+        with conn:
+            conn.execute("DELETE FROM protocol_steps")
+            conn.execute("DELETE FROM protocol_fields")
+
+    processed, last_key = 0, (0, 0)
+    while True:
+        batch = conn.execute("""
+            SELECT p.year, p.number, p.content, p.Last_update FROM protocols p
+            WHERE (p.year, p.number) > (?, ?)
+              AND NOT EXISTS (SELECT 1 FROM protocol_fields f WHERE f.year = p.year AND f.number = p.number)
+            ORDER BY p.year, p.number
+            LIMIT ?
+        """, last_key + (BATCH_SIZE,)).fetchall()
+        if not batch:
+            break
+        parsed = [parse_protocol(content) for _, _, content, _ in batch]
+        with conn:
+            index_fields(conn, [(year, number, content) for year, number, content, _ in batch], parsed)
+            if update_last_update:
+                updates = [(latest_date(f), year, number) for (year, number, _, last_update), f in zip(batch, parsed)
+                           if latest_date(f) and latest_date(f) != last_update]
+                conn.executemany("UPDATE protocols SET Last_update = ? WHERE year = ? AND number = ?", updates)
+        processed += len(batch)
+        last_key = (batch[-1][0], batch[-1][1])
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (META_KEY, str(PARSER_VERSION)))
+    return processed
+
+def fields_available(conn):
+    return table_exists(conn, 'protocol_fields')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extrai os campos estruturados dos protocolos (backfill).")
+    parser.add_argument('--full', action='store_true', help='Reprocessa todos os protocolos.')
+    parser.add_argument('--last-update', action='store_true',
+                        help='Corrige o Last_update pela data mais recente dos campos.')
+    args = parser.parse_args()
+
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    conn = sqlite3.connect(config.get('database_name', 'protocols.db'))
+    try:
+        count = sync_protocol_fields(conn, full=args.full, update_last_update=args.last_update)
+        print(f"Campos estruturados atualizados: {count} protocolos processados.")
+    finally:
+        conn.close()
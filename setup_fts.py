@@ -1,61 +1,242 @@
 import sqlite3
 import json
+import time
+from datetime import datetime, timedelta
+
+from db_meta import ensure_meta
 
 # --- Configuração ---
 with open('config.json', 'r', encoding='utf-8') as f:
     config = json.load(f)
 
 DB_NAME = config.get('database_name', 'protocols.db')
+# A verificação completa (integrity-check contra a tabela protocols) relê o corpus
+# inteiro; roda só a cada tantos dias. Nos outros dias bastam as contagens.
+CHECK_INTERVAL_DAYS = config.get('fts_check_interval_days', 7)
+# Trabalho máximo (em páginas) do 'merge' diário; 'optimize' só com --optimize.
+MERGE_PAGES = config.get('fts_merge_pages', 500)
+
+ROWS_KEY = 'fts.rows'
+MAX_ROWID_KEY = 'fts.max_rowid'
+VERIFIED_AT_KEY = 'fts.verified_at'
+TRIGGERS = ('protocols_ai', 'protocols_ad', 'protocols_au')
+
+# unicode61 com remove_diacritics 2 ignora acentos e maiúsculas, como o remover_acentos()
+# do app e do scraper: "carijos" encontra "Carijós". O índice de prefixos acelera
+# buscas parciais como "hering*" ou "emmend*".
+FTS_TOKENIZE = "unicode61 remove_diacritics 2"
+FTS_PREFIX = "2 3"
+
+TRIGGERS_SQL = """
+    CREATE TRIGGER IF NOT EXISTS protocols_ai AFTER INSERT ON protocols BEGIN
+        INSERT INTO protocols_fts(rowid, content) VALUES (new.rowid, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS protocols_ad AFTER DELETE ON protocols BEGIN
+        INSERT INTO protocols_fts(protocols_fts, rowid, content) VALUES('delete', old.rowid, old.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS protocols_au AFTER UPDATE ON protocols BEGIN
+        INSERT INTO protocols_fts(protocols_fts, rowid, content) VALUES('delete', old.rowid, old.content);
+        INSERT INTO protocols_fts(rowid, content) VALUES (new.rowid, new.content);
+    END;
+"""
+
+def create_fts_sql(table_name):
+    # content='protocols' faz com que a FTS table seja um índice sobre a tabela protocols
+    return f"""
+        CREATE VIRTUAL TABLE {table_name} USING fts5(
+            content,
+            content='protocols',
+            content_rowid='rowid',
+            tokenize='{FTS_TOKENIZE}',
+            prefix='{FTS_PREFIX}'
+        );
+    """
+
+def fts_schema_is_current(table_sql):
+    return f"tokenize='{FTS_TOKENIZE}'" in table_sql and f"prefix='{FTS_PREFIX}'" in table_sql
+
+def migrate_fts(conn):
+    """
+    Troca uma 'protocols_fts' antiga (ex.: tokenize='porter') pela configuração atual.
+    O índice novo é construído ao lado do antigo e a troca acontece na mesma
+    transação, então as buscas continuam usando a tabela antiga até o commit.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DROP TABLE IF EXISTS protocols_fts_new")
+        cursor.execute(create_fts_sql('protocols_fts_new'))
+        print("Construindo o novo índice FTS ao lado do atual...")
+        cursor.execute("INSERT INTO protocols_fts_new(protocols_fts_new) VALUES('rebuild');")
+
+        print("Trocando o índice antigo pelo novo...")
+        # Os triggers referenciam protocols_fts e precisam sair antes do rename.
+        for trigger in ('protocols_ai', 'protocols_ad', 'protocols_au'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE protocols_fts")
+        cursor.execute("ALTER TABLE protocols_fts_new RENAME TO protocols_fts")
+        for statement in TRIGGERS_SQL.split('END;')[:-1]:
+            cursor.execute(statement + 'END;')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def rebuild_fts(cursor):
+    """Reconstrói o índice a partir da tabela protocols (relê e re-tokeniza tudo)."""
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("INSERT INTO protocols_fts(protocols_fts) VALUES('rebuild');")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+
+def missing_triggers(conn):
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    return [trigger for trigger in TRIGGERS if trigger not in existing]
+
+def fts_counts(conn):
+    """
+    Linhas e maior rowid da tabela protocols e do índice. protocols_fts_docsize
+    tem uma linha por documento indexado; MAX(rowid) sai direto da B-tree.
+    """
+    rows, max_rowid = conn.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM protocols").fetchone()
+    fts_rows, fts_max_rowid = conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM protocols_fts_docsize").fetchone()
+    return rows, max_rowid, fts_rows, fts_max_rowid
+
+def get_meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def save_watermark(conn, verified=False):
+    """Guarda as contagens atuais (e, após uma verificação completa ou rebuild, a data dela)."""
+    rows, max_rowid, _, _ = fts_counts(conn)
+    values = [(ROWS_KEY, str(rows)), (MAX_ROWID_KEY, str(max_rowid))]
+    if verified:
+        values.append((VERIFIED_AT_KEY, datetime.now().isoformat(timespec='seconds')))
+    conn.execute("BEGIN")
+    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", values)
+    conn.execute("COMMIT")
 
-def setup_fts():
+def full_check_due(conn):
+    verified_at = get_meta(conn, VERIFIED_AT_KEY)
+    if verified_at is None:
+        return True
+    return datetime.fromisoformat(verified_at) < datetime.now() - timedelta(days=CHECK_INTERVAL_DAYS)
+
+def check_fts(conn, full=False):
+    """
+    Retorna None se o índice está consistente ou o motivo da divergência.
+    A verificação rápida compara contagens e o maior rowid do índice e da tabela
+    e mostra o que mudou desde a marca d'água guardada; com full=True roda também
+    o integrity-check do FTS5 contra a tabela protocols.
+    """
+    missing = missing_triggers(conn)
+    if missing:
+        return f"triggers ausentes ({', '.join(missing)}); alterações podem ter ficado fora do índice"
+
+    rows, max_rowid, fts_rows, fts_max_rowid = fts_counts(conn)
+    previous_rows = get_meta(conn, ROWS_KEY)
+    previous_max = get_meta(conn, MAX_ROWID_KEY)
+    if previous_rows is not None:
+        print(f"{rows} protocolos ({rows - int(previous_rows):+d}) e maior rowid {max_rowid} "
+              f"(antes {previous_max}) desde a última verificação.")
+    if rows != fts_rows:
+        return f"o índice tem {fts_rows} documentos e a tabela {rows} linhas"
+    if max_rowid != fts_max_rowid:
+        return f"maior rowid do índice ({fts_max_rowid}) difere do da tabela ({max_rowid})"
+
+    if full:
+        print("Executando o integrity-check completo do índice...")
+        started = time.monotonic()
+        try:
+            # rank=1 compara o índice com o conteúdo atual da tabela protocols.
+            conn.execute("INSERT INTO protocols_fts(protocols_fts, rank) VALUES('integrity-check', 1)")
+        except sqlite3.DatabaseError as e:
+            return f"integrity-check falhou: {e}"
+        print(f"Integrity-check concluído em {time.monotonic() - started:.1f}s.")
+    return None
+
+def merge_fts(conn, pages):
+    """Funde segmentos do índice fazendo no máximo cerca de 'pages' páginas de trabalho."""
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("INSERT INTO protocols_fts(protocols_fts, rank) VALUES('merge', ?)", (pages,))
+    conn.execute("COMMIT")
+
+def setup_fts(force_rebuild=False, force_check=False, optimize=False):
     """
     Configura a tabela virtual FTS5 para busca de texto completo.
+
+    Com o índice já no formato atual, os triggers o mantêm em dia: em vez de
+    reconstruí-lo, confere se está consistente e só o reconstrói se houver
+    divergência (ou com force_rebuild). Depois faz um 'merge' limitado, ou o
+    'optimize' completo com optimize=True.
     """
     conn = sqlite3.connect(DB_NAME)
+    # Sem isso o módulo sqlite3 abriria transações implícitas por conta própria.
+    conn.isolation_level = None
     cursor = conn.cursor()
+    # A marca d'água vai para 'meta', que um banco recém-criado ainda não tem.
+    ensure_meta(conn)
 
     print("Verificando a existência da tabela FTS 'protocols_fts'...")
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='protocols_fts'")
-    if cursor.fetchone():
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='protocols_fts'")
+    row = cursor.fetchone()
+    if row and fts_schema_is_current(row[0]):
         print("A tabela 'protocols_fts' já existe. Pulando a criação.")
+        if force_rebuild:
+            reason = "reconstrução pedida"
+        else:
+            full = force_check or full_check_due(conn)
+            reason = check_fts(conn, full=full)
+        if reason:
+            print(f"Reconstruindo o índice FTS: {reason}.")
+            cursor.executescript(TRIGGERS_SQL)
+            rebuild_fts(cursor)
+            print("Índice reconstruído.")
+            save_watermark(conn, verified=True)
+        else:
+            print("Índice FTS consistente.")
+            save_watermark(conn, verified=full)
+            if optimize:
+                print("Otimizando o índice (optimize)...")
+                cursor.execute("INSERT INTO protocols_fts(protocols_fts) VALUES('optimize');")
+            else:
+                print(f"Fundindo segmentos do índice (merge, até {MERGE_PAGES} páginas)...")
+                merge_fts(conn, MERGE_PAGES)
+            print("Manutenção do índice concluída.")
+    elif row:
+        print(f"A tabela 'protocols_fts' usa uma configuração antiga; migrando para tokenize='{FTS_TOKENIZE}'...")
+        migrate_fts(conn)
+        print("Migração concluída.")
+        save_watermark(conn, verified=True)
     else:
         print("Criando a tabela virtual FTS 'protocols_fts'...")
-        # content='protocols' faz com que a FTS table seja uma cópia da tabela protocols
-        # tokenize='porter' habilita o stemming para o idioma inglês e similares
-        cursor.execute("""
-            CREATE VIRTUAL TABLE protocols_fts USING fts5(
-                content, 
-                content='protocols',
-                content_rowid='rowid',
-                tokenize='porter'
-            );
-        """)
+        cursor.execute("BEGIN")
+        cursor.execute(create_fts_sql('protocols_fts'))
         print("Tabela FTS criada.")
-
-    print("\nPopulando a tabela FTS com dados existentes...")
-    # A query 'rebuild' reconstrói o índice FTS a partir da tabela de conteúdo
-    cursor.execute("INSERT INTO protocols_fts(protocols_fts) VALUES('rebuild');")
-    print("Tabela FTS populada e índice reconstruído.")
+        print("\nPopulando a tabela FTS com dados existentes...")
+        cursor.execute("INSERT INTO protocols_fts(protocols_fts) VALUES('rebuild');")
+        cursor.execute("COMMIT")
+        print("Tabela FTS populada e índice reconstruído.")
+        save_watermark(conn, verified=True)
 
     print("\nCriando triggers para manter a sincronização...")
     # Triggers para manter a tabela FTS sincronizada com a tabela 'protocols'
-    cursor.executescript("""
-        CREATE TRIGGER IF NOT EXISTS protocols_ai AFTER INSERT ON protocols BEGIN
-            INSERT INTO protocols_fts(rowid, content) VALUES (new.rowid, new.content);
-        END;
-        CREATE TRIGGER IF NOT EXISTS protocols_ad AFTER DELETE ON protocols BEGIN
-            INSERT INTO protocols_fts(protocols_fts, rowid, content) VALUES('delete', old.rowid, old.content);
-        END;
-        CREATE TRIGGER IF NOT EXISTS protocols_au AFTER UPDATE ON protocols BEGIN
-            INSERT INTO protocols_fts(protocols_fts, rowid, content) VALUES('delete', old.rowid, old.content);
-            INSERT INTO protocols_fts(rowid, content) VALUES (new.rowid, new.content);
-        END;
-    """)
+    cursor.executescript(TRIGGERS_SQL)
     print("Triggers criados com sucesso.")
 
-    conn.commit()
     conn.close()
     print("\nConfiguração do FTS5 concluída!")
 
 if __name__ == '__main__':
-    setup_fts()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cria e mantém o índice FTS5 da tabela protocols.")
+    parser.add_argument('--rebuild', action='store_true', help="Reconstrói o índice mesmo que esteja consistente.")
+    parser.add_argument('--check', action='store_true', help="Roda o integrity-check completo agora.")
+    parser.add_argument('--optimize', action='store_true', help="Faz o 'optimize' completo em vez do 'merge' limitado.")
+    args = parser.parse_args()
+
+    setup_fts(force_rebuild=args.rebuild, force_check=args.check, optimize=args.optimize)
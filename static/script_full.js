@@ -1,13 +1,17 @@
 let keywordFilterActive = false;
 let sortOrder = 'asc'; // 'asc' or 'desc'
 
+// Pages carry page_size rows (config.json): no limit is sent, so the server default applies.
+let nextCursor = null; // Keyset cursor ("YYYY/NNNNN", or "YYYY-MM-DD|YYYY/NNNNN" by date) of the next page, null when there is none
+let loadingPage = false;
+let viewGeneration = 0; // Bumped on every filter change so stale page responses are dropped
+
 // --- Data Fetching and State Management ---
 
 /**
- * Main function to update the view.
- * Gathers all filter criteria, fetches data from the server, and updates the UI.
+ * Builds the query string for the current filters (without pagination).
  */
-function updateView() {
+function buildFilterParams() {
     const searchText = document.getElementById('input-busca').value.trim();
     
     // Determine status from the selected button
@@ -32,26 +36,103 @@ function updateView() {
         params.push('filter_keywords=true');
     }
 
+    // Department, subject and date range (answered from the parsed protocol fields)
+    const fieldFilters = {
+        departamento: document.getElementById('select-departamento').value,
+        assunto: document.getElementById('select-assunto').value,
+        date_from: document.getElementById('input-date-from').value,
+        date_to: document.getElementById('input-date-to').value,
+    };
+    for (const [name, value] of Object.entries(fieldFilters)) {
+        if (value) {
+            params.push(`${name}=${encodeURIComponent(value)}`);
+        }
+    }
+
     // Always add sort order
     params.push(`sort_order=${sortOrder}`);
+    params.push(`sort_by=${document.getElementById('select-sort-by').value}`);
+
+    return params;
+}
 
-    const queryString = params.length > 0 ? `?${params.join('&')}`: '';
+/**
+ * Main function to update the view.
+ * Gathers all filter criteria, fetches the first page from the server, and updates the UI.
+ */
+function updateView() {
+    const params = buildFilterParams();
+    const generation = ++viewGeneration;
+    nextCursor = null;
+    loadingPage = true;
 
     // Show loading indicator
     document.getElementById('protocol-list').innerHTML = '<em>Buscando protocolos...</em>';
 
-    fetch(`/api/protocols${queryString}`)
+    fetch(`/api/protocols?${params.join('&')}`)
         .then(response => response.json())
         .then(data => {
+            if (generation !== viewGeneration) return;
+            nextCursor = data.next_cursor;
             updateTotals(data.totals);
-            renderProtocolList(data.protocols);
+            renderProtocolList(data.protocols, false);
         })
         .catch(error => {
             console.error('Error fetching protocols:', error);
             document.getElementById('protocol-list').innerHTML = '<em>Erro ao carregar protocolos.</em>';
+        })
+        .finally(() => {
+            if (generation === viewGeneration) loadingPage = false;
         });
 }
 
+/**
+ * Appends the next page of the current view, if there is one.
+ * @returns {Promise} Resolves once the page has been rendered.
+ */
+function loadMore() {
+    if (!nextCursor || loadingPage) return Promise.resolve();
+    const params = buildFilterParams();
+    params.push(`after=${encodeURIComponent(nextCursor)}`);
+    const generation = viewGeneration;
+    loadingPage = true;
+
+    return fetch(`/api/protocols?${params.join('&')}`)
+        .then(response => response.json())
+        .then(data => {
+            if (generation !== viewGeneration) return;
+            nextCursor = data.next_cursor;
+            renderProtocolList(data.protocols, true);
+        })
+        .catch(error => console.error('Error fetching more protocols:', error))
+        .finally(() => {
+            if (generation === viewGeneration) loadingPage = false;
+        });
+}
+
+/**
+ * Streams the ids of every protocol matching the current filters (NDJSON).
+ * @returns {Promise<Array<string>>}
+ */
+async function fetchAllIds() {
+    const response = await fetch(`/api/protocols?${buildFilterParams().join('&')}&format=ndjson`);
+    if (!response.ok) throw new Error('Erro ao listar protocolos');
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const ids = [];
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.filter(line => line).forEach(line => ids.push(JSON.parse(line).id));
+    }
+    if (buffer.trim()) ids.push(JSON.parse(buffer).id);
+    return ids;
+}
+
 // --- UI Rendering ---
 
 /**
@@ -59,6 +140,7 @@ function updateView() {
  * @param {object} totals - An object with counts for each category.
  */
 function updateTotals(totals) {
+    if (!totals) return;
     document.getElementById('btn-all').textContent = `Todos (${totals.todos})`;
     document.getElementById('btn-arch').textContent = `Arquivados (+) (${totals.arch})`;
     document.getElementById('btn-notarch').textContent = `Não arquivados (${totals.notarch})`;
@@ -66,19 +148,21 @@ function updateTotals(totals) {
 }
 
 /**
- * Clears and rebuilds the list of protocols on the left pane.
+ * Rebuilds (or extends) the list of protocols on the left pane.
  * @param {Array} protocols - The list of protocol objects from the server.
+ * @param {boolean} append - Add to the current list instead of replacing it.
  */
-function renderProtocolList(protocols) {
+function renderProtocolList(protocols, append) {
     const listDiv = document.getElementById('protocol-list');
-    listDiv.innerHTML = ''; // Clear existing list
+    if (!append) listDiv.innerHTML = ''; // Clear existing list
 
-    if (protocols.length === 0) {
+    if (!append && protocols.length === 0) {
         listDiv.innerHTML = '<em>Nenhum protocolo encontrado.</em>';
         document.getElementById('detail').innerHTML = '<em>Selecione um protocolo à esquerda...</em>';
         return;
     }
 
+    const fragment = document.createDocumentFragment();
     protocols.forEach(p => {
         const item = document.createElement('div');
         item.className = 'proto-item';
@@ -91,11 +175,12 @@ function renderProtocolList(protocols) {
             text += ' <span title="Arquivado">+</span>';
         }
         item.innerHTML = text;
-        listDiv.appendChild(item);
+        fragment.appendChild(item);
     });
+    listDiv.appendChild(fragment);
 
     // Auto-select the first protocol in the new list
-    if (listDiv.firstChild) {
+    if (!append && listDiv.firstChild) {
         listDiv.firstChild.click();
     }
 }
@@ -145,10 +230,15 @@ function filterProtos(type) {
     updateView();
 }
 
-function exportarProtocolos() {
-    const ids = Array.from(document.querySelectorAll('.proto-item'))
-        .filter(e => e.style.display !== 'none') // Only visible ones
-        .map(e => e.id.replace('item-', '').replace(/-/g, '/'));
+async function exportarProtocolos() {
+    // The list only holds the pages loaded so far; export everything the filters match.
+    let ids;
+    try {
+        ids = await fetchAllIds();
+    } catch (e) {
+        alert('Erro ao exportar: ' + e.message);
+        return;
+    }
 
     if (ids.length === 0) {
         alert('Nenhum protocolo para exportar!');
@@ -278,6 +368,28 @@ window.onload = function () {
         btn.addEventListener('click', () => filterProtos(btn.dataset.filter));
     });
 
+    // Department and subject lists come from /api/facets ("name (count)").
+    fetch('/api/facets')
+        .then(response => response.json())
+        .then(data => {
+            const fill = (id, items) => {
+                const select = document.getElementById(id);
+                for (const [name, total] of items) {
+                    const option = document.createElement('option');
+                    option.value = name;
+                    option.textContent = `${name} (${total})`;
+                    select.appendChild(option);
+                }
+            };
+            fill('select-departamento', data.departamentos);
+            fill('select-assunto', data.assuntos);
+        })
+        .catch(error => console.error('Error fetching facets:', error));
+
+    ['select-departamento', 'select-assunto', 'input-date-from', 'input-date-to', 'select-sort-by'].forEach(id => {
+        document.getElementById(id).addEventListener('change', updateView);
+    });
+
     const keywordFilterBtn = document.getElementById('btn-keyword-filter');
     keywordFilterBtn.addEventListener('click', () => {
         keywordFilterActive = !keywordFilterActive;
@@ -285,13 +397,25 @@ window.onload = function () {
         updateView();
     });
 
-    document.addEventListener('keydown', function (e) {
+    // Infinite scroll: fetch the next page when the list panel nears its end.
+    const listPanel = document.querySelector('.left');
+    listPanel.addEventListener('scroll', () => {
+        if (listPanel.scrollTop + listPanel.clientHeight >= listPanel.scrollHeight - 200) {
+            loadMore();
+        }
+    });
+
+    document.addEventListener('keydown', async function (e) {
         if (e.key === 'Delete') removerProtocoloSelecionado();
         if (['ArrowUp', 'ArrowDown'].includes(e.key)) {
             e.preventDefault();
-            const items = Array.from(document.querySelectorAll('.proto-item'));
+            let items = Array.from(document.querySelectorAll('.proto-item'));
             if (items.length === 0) return;
             const selIndex = items.findIndex(x => x.classList.contains('selected'));
+            if (e.key === 'ArrowDown' && selIndex === items.length - 1 && nextCursor) {
+                await loadMore();
+                items = Array.from(document.querySelectorAll('.proto-item'));
+            }
             let nextIndex = selIndex;
             if (e.key === 'ArrowDown') nextIndex = selIndex < items.length - 1 ? selIndex + 1 : 0;
             if (e.key === 'ArrowUp') nextIndex = selIndex > 0 ? selIndex - 1 : items.length - 1;
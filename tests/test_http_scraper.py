@@ -0,0 +1,99 @@
+"""
+Drives the HTTP engine against portal_stub.py on a free local port.
+
+    python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from enhanced_protocol_scraper import BaseProtocolScraper, HttpProtocolScraper  # noqa: E402
+
+YEAR = 2025
+LATEST = 40
+MISSING = 17
+
+
+class HttpScraperAgainstStubTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, 'portal_stub.py'), '--port', '0',
+             '--latest', f'{YEAR}={LATEST}', '--missing', f'{YEAR}/{MISSING}'],
+            stdout=subprocess.PIPE, text=True, encoding='utf-8',
+        )
+        banner = cls.stub.stdout.readline()
+        match = re.search(r'http://127\.0\.0\.1:(\d+)/', banner)
+        if not match:
+            cls.stub.kill()
+            raise RuntimeError(f"portal_stub.py did not start: {banner!r}")
+        cls.base_url = f"http://127.0.0.1:{match.group(1)}/"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.terminate()
+        cls.stub.wait(timeout=10)
+        cls.stub.stdout.close()
+
+    def run_with_scraper(self, coro_factory):
+        async def run():
+            scraper = HttpProtocolScraper(self.base_url, pool_size=4, timeout=10)
+            try:
+                return await coro_factory(scraper)
+            finally:
+                await scraper.close()
+        return asyncio.run(run())
+
+    def test_scrapes_protocol_content(self):
+        year, number, content, arquivado, last_update = self.run_with_scraper(
+            lambda scraper: scraper.scrape_protocol(None, YEAR, 5)
+        )
+        self.assertEqual((year, number), (YEAR, 5))
+        self.assertIn(f"Processo: Ouvidoria {YEAR}/5 Vol. 1", content)
+        self.assertIn("Assunto: Manutenção de via", content)
+        self.assertEqual(arquivado, "no")
+        self.assertEqual(last_update, f"{YEAR}-03-02")
+
+    def test_missing_protocol_is_not_localizado(self):
+        async def lookups(scraper):
+            return (await scraper.scrape_protocol(None, YEAR, MISSING),
+                    await scraper.check_protocol_exists(YEAR, MISSING),
+                    await scraper.check_protocol_exists(YEAR, LATEST),
+                    await scraper.check_protocol_exists(YEAR, LATEST + 1))
+
+        scraped, missing_exists, latest_exists, beyond_exists = self.run_with_scraper(lookups)
+        self.assertTrue(scraped[2].startswith("Protocolo não localizado"), scraped[2])
+        self.assertEqual(scraped[3:], ("no", None))
+        self.assertFalse(missing_exists)
+        self.assertTrue(latest_exists)
+        self.assertFalse(beyond_exists)
+
+    def test_find_latest_protocol_number(self):
+        for start in (0, MISSING - 1, LATEST):
+            with self.subTest(start=start):
+                latest = self.run_with_scraper(
+                    lambda scraper: scraper.find_latest_protocol_number(
+                        YEAR, start=start, parallel_probes=4, hole_tolerance=3, upper_bound=1000
+                    )
+                )
+                self.assertEqual(latest, LATEST)
+
+
+class BaseProtocolScraperTest(unittest.TestCase):
+    def test_engine_must_implement_lookups(self):
+        class Incomplete(BaseProtocolScraper):
+            async def scrape_protocol(self, session, year, number):
+                return year, number, "", "no", None
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Parses protocol texts in the formats the portal (Update.txt) and portal_stub.py produce.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from portal_stub import SYNTHETIC_CONTENT  # noqa: E402
+from protocol_fields import latest_date, parse_protocol  # noqa: E402
+
+# Trimmed from Update.txt, with a despacho continued on the following lines.
+PORTAL_CONTENT = """Processo: Ouvidoria 2021/11848 Vol. 1
+
+Situação Arquivo em 21/11/2025, recebido em 21/11/2025 por Departamento Ouvidoria, recebido em 21/11/2025 por Departamento Ouvidoria
+Despacho em 21/11/2025
+conforme andamento arquiva-se o protocolo
+Assunto: Atendimento urgência e emergência
+Síntese: Atendimento urgência e emergência na rua FRANCISCO KNOCH, 385 [BOM RETIRO].
+Pede urgência.
+Despacho: conforme andamento arquiva-se o protocolo
+
+Encaminhamentos
+1 SEMMAS - Diretoria Geral em 13/08/2021;
+2 SEMMAS - Bem Estar Animal em 13/08/2021; Despacho: demanda nao atendida
+em função da paralisação do setor
+devido superlotação
+3 Ouvidoria em 21/11/2025; Despacho: conforme andamento arquiva-se o protocolo
+Anexos do protocolo
+ID: 3166415 Título: Mapa Arquivo: PRO__Mapa_20220602051230.pdf Data do Anexo: 02/06/2022 17:12:34
+"""
+
+
+class ParseProtocolTest(unittest.TestCase):
+    def test_portal_format(self):
+        fields = parse_protocol(PORTAL_CONTENT)
+        self.assertEqual(fields['processo'], "Ouvidoria 2021/11848 Vol. 1")
+        self.assertEqual(fields['situacao'], "Arquivo")
+        self.assertEqual(fields['situacao_data'], "2025-11-21")
+        self.assertEqual(fields['departamento_atual'], "Ouvidoria")
+        self.assertEqual(fields['assunto'], "Atendimento urgência e emergência")
+        self.assertEqual(fields['sintese'],
+                         "Atendimento urgência e emergência na rua FRANCISCO KNOCH, 385 [BOM RETIRO].\nPede urgência.")
+        self.assertEqual(fields['despacho'], "conforme andamento arquiva-se o protocolo")
+        self.assertEqual(fields['despacho_data'], "2025-11-21")
+        self.assertEqual(latest_date(fields), "2025-11-21")
+
+    def test_steps_with_multiline_despacho(self):
+        steps = parse_protocol(PORTAL_CONTENT)['steps']
+        self.assertEqual([(s['seq'], s['departamento'], s['data']) for s in steps], [
+            (1, "SEMMAS - Diretoria Geral", "2021-08-13"),
+            (2, "SEMMAS - Bem Estar Animal", "2021-08-13"),
+            (3, "Ouvidoria", "2025-11-21"),
+        ])
+        self.assertIsNone(steps[0]['despacho'])
+        self.assertEqual(steps[1]['despacho'],
+                         "demanda nao atendida\nem função da paralisação do setor\ndevido superlotação")
+        # The attachments section is not part of the last despacho.
+        self.assertEqual(steps[2]['despacho'], "conforme andamento arquiva-se o protocolo")
+
+    def test_stub_format_takes_date_from_recebido(self):
+        fields = parse_protocol(SYNTHETIC_CONTENT.format(year=2025, number=7))
+        self.assertEqual(fields['processo'], "Ouvidoria 2025/7 Vol. 1")
+        self.assertEqual(fields['situacao'], "Em andamento")
+        self.assertEqual(fields['situacao_data'], "2025-03-02")
+        self.assertEqual(fields['departamento_atual'], "Ouvidoria")
+        self.assertEqual(fields['assunto'], "Manutenção de via")
+        self.assertEqual(fields['steps'], [
+            {'seq': 1, 'departamento': "SEMOB - Diretoria Geral", 'data': "2025-03-02", 'despacho': None},
+        ])
+        self.assertEqual(latest_date(fields), "2025-03-02")
+
+    def test_empty_content(self):
+        fields = parse_protocol(None)
+        self.assertIsNone(fields['situacao'])
+        self.assertEqual(fields['steps'], [])
+        self.assertIsNone(latest_date(fields))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Runs setup_fts() on databases that have never been indexed by the current version.
+
+    python -m unittest discover -s tests
+"""
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# setup_fts reads config.json from the working directory at import time.
+_cwd = os.getcwd()
+os.chdir(REPO_DIR)
+try:
+    import setup_fts  # noqa: E402
+finally:
+    os.chdir(_cwd)
+
+PROTOCOLS_SQL = """
+    CREATE TABLE protocols (
+        year INTEGER,
+        number INTEGER,
+        content TEXT,
+        Arquivado TEXT,
+        Last_update TEXT,
+        retrieved_at TEXT,
+        PRIMARY KEY (year, number)
+    );
+"""
+# protocols_fts as created by the first version of setup_fts.py.
+BASELINE_FTS_SQL = """
+    CREATE VIRTUAL TABLE protocols_fts USING fts5(
+        content,
+        content='protocols',
+        content_rowid='rowid',
+        tokenize='porter'
+    );
+    INSERT INTO protocols_fts(protocols_fts) VALUES('rebuild');
+"""
+ROWS = [
+    (2025, 1, "Assunto: Manutenção de via\nRua dos Carijós", "no", "2025-03-02", None),
+    (2025, 2, "Assunto: Poda de árvore\nRua Hermann Hering", "no", "2025-03-03", None),
+]
+
+
+class SetupFtsOnFreshDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, 'protocols.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(PROTOCOLS_SQL)
+        conn.executemany("INSERT INTO protocols VALUES (?, ?, ?, ?, ?, ?)", ROWS)
+        conn.commit()
+        conn.close()
+
+        original = setup_fts.DB_NAME
+        setup_fts.DB_NAME = self.db_path
+        self.addCleanup(setattr, setup_fts, 'DB_NAME', original)
+
+    def run_setup(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            setup_fts.setup_fts()
+        conn = sqlite3.connect(self.db_path)
+        self.addCleanup(conn.close)
+        return conn
+
+    def assert_index_ready(self, conn):
+        table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'protocols_fts'").fetchone()[0]
+        self.assertTrue(setup_fts.fts_schema_is_current(table_sql), table_sql)
+        self.assertEqual(setup_fts.missing_triggers(conn), [])
+        self.assertEqual(setup_fts.get_meta(conn, setup_fts.ROWS_KEY), str(len(ROWS)))
+        self.assertIsNotNone(setup_fts.get_meta(conn, setup_fts.VERIFIED_AT_KEY))
+
+        search = "SELECT rowid FROM protocols_fts WHERE protocols_fts MATCH ?"
+        self.assertEqual(len(conn.execute(search, ('carijos',)).fetchall()), 1)
+        conn.execute("INSERT INTO protocols VALUES (2025, 3, 'Assunto: Iluminação pública', 'no', NULL, NULL)")
+        conn.commit()
+        self.assertEqual(len(conn.execute(search, ('iluminacao',)).fetchall()), 1)
+
+    def test_creates_index_on_bare_protocols_table(self):
+        self.assert_index_ready(self.run_setup())
+
+    def test_migrates_baseline_index(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(BASELINE_FTS_SQL)
+        conn.close()
+        self.assert_index_ready(self.run_setup())
+
+    def test_second_run_checks_instead_of_creating(self):
+        self.run_setup().close()
+        self.assert_index_ready(self.run_setup())
+
+
+if __name__ == '__main__':
+    unittest.main()
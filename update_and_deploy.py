@@ -1,83 +1,238 @@
+import json
+import os
+import re
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 
-def run_script(script_path, *args, timeout=None):
-    """Executa um script Python e retorna True em sucesso, False em erro."""
-    command = [sys.executable, script_path] + list(args)
-    print(f"\n--- Executando: {' '.join(command)} ---")
-    
+# --- Configuracao ---
+CONFIG_FILE = 'config.json'
+
+# Cada etapa so comeca quando as etapas de "after" terminaram com sucesso; etapas
+# sem dependencia entre si rodam ao mesmo tempo. O arquivamento espera o scraper:
+# a leitura longa dele seguraria o lock do banco e o scraper, que grava em lotes e
+# troca o journal_mode, falharia com "database is locked". "rows" extrai da saida
+# o numero de linhas processadas.
+STAGES = [
+    # O scraper para sozinho ao fim do orcamento de tempo; o que faltar fica na fila
+    # (scrape_queue) e e retomado na proxima execucao. O timeout e so uma rede de seguranca.
+    {"name": "scrape", "path": "enhanced_protocol_scraper.py", "args": ["scrape", "--time-budget", "300"],
+     "timeout": 360, "after": [], "rows": r"Stored (\d+) protocols"},
+    {"name": "archive", "path": "archive_protocols.py", "args": [],
+     "timeout": None, "after": ["scrape"], "rows": r"(\d+) protocolos verificados em"},
+    {"name": "fts", "path": "setup_fts.py", "args": [],
+     "timeout": None, "after": ["scrape", "archive"], "rows": r"^(\d+) protocolos \("},
+    {"name": "deploy", "path": "deploy_db.py", "args": [],
+     "timeout": None, "after": ["fts"], "rows": r"changeset: (\d+) protocolos"},
+]
+
+HISTORY_SQL = """
+    CREATE TABLE IF NOT EXISTS stage_runs (
+        id INTEGER PRIMARY KEY,
+        run_started_at TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        started_at TEXT,
+        wall_seconds REAL,
+        rows INTEGER,
+        exit_code INTEGER,
+        status TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_stage_runs_run ON stage_runs (run_started_at);
+"""
+
+# Depois do timeout a etapa recebe SIGTERM e tem esse tempo para terminar sozinha
+# (o scraper grava as linhas em buffer) antes do SIGKILL.
+TERMINATE_GRACE_SECONDS = 30
+
+_print_lock = threading.Lock()
+
+
+def load_config():
     try:
-        # O `check=True` faz com que uma exceção seja levantada se o script retornar um erro.
-        subprocess.run(command, check=True, capture_output=True, text=True, timeout=timeout)
-        print(f"--- Script '{script_path}' concluido com sucesso. ---")
-        return True
-    except subprocess.TimeoutExpired:
-        print(f"!!! TIMEOUT ao executar o script '{script_path}' apos {timeout} segundos. !!!")
-        print("O processo foi finalizado. A proxima execucao ocorrera apos o periodo de espera.")
-        return False
-    except subprocess.CalledProcessError as e:
-        print(f"!!! ERRO ao executar o script '{script_path}'. !!!")
-        print(f"Saida de erro:\n{e.stderr}")
-        return False
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def log(message):
+    with _print_lock:
+        print(message, flush=True)
+
+def open_history(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(HISTORY_SQL)
+    return conn
+
+def record_stage(conn, run_started_at, result):
+    with conn:
+        conn.execute(
+            """INSERT INTO stage_runs (run_started_at, stage, started_at, wall_seconds, rows, exit_code, status)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (run_started_at, result['stage'], result['started_at'], result['wall_seconds'],
+             result['rows'], result['exit_code'], result['status'])
+        )
+
+def run_stage(stage):
+    """
+    Executa o script da etapa repassando a saida linha a linha (com o nome da
+    etapa como prefixo) e retorna status ('ok', 'error', 'timeout'), codigo de
+    saida, tempo de parede e linhas processadas.
+    """
+    command = [sys.executable, stage["path"]] + list(stage["args"])
+    log(f"\n--- [{stage['name']}] Executando: {' '.join(command)} ---")
+    # Saida sem buffer para as linhas chegarem na hora; sem as barras do tqdm,
+    # que viram uma linha nova a cada atualizacao quando a saida nao e um terminal.
+    env = dict(os.environ, PYTHONUNBUFFERED='1', TQDM_DISABLE='1')
+    rows_pattern = re.compile(stage["rows"]) if stage.get("rows") else None
+    result = {'stage': stage['name'], 'started_at': datetime.now().isoformat(timespec='seconds'),
+              'wall_seconds': None, 'rows': None, 'exit_code': None, 'status': 'error'}
+    start = time.monotonic()
+
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, encoding='utf-8', errors='replace', env=env)
     except FileNotFoundError:
-        print(f"!!! ERRO: O script '{script_path}' nao foi encontrado. !!!")
-        return False
-
-def main():
-    """Funcao principal que orquestra a execucao dos scripts."""
-    scripts_to_run = [
-        {"path": "enhanced_protocol_scraper.py", "args": ["scrape"], "timeout": 360},  # 10 min
-        {"path": "setup_fts.py", "args": [], "timeout": None},
-        {"path": "deploy_db.py", "args": [], "timeout": None}
-    ]
-
-    print("Iniciando sequencia de atualizacao e deploy...")
-
-    all_success = True
-    for i, script_details in enumerate(scripts_to_run):
-        print(f"\n[Passo {i+1}/{len(scripts_to_run)}]")
-        
-        path = script_details["path"]
-        args = script_details["args"]
-        timeout = script_details["timeout"]
-        
-        if not run_script(path, *args, timeout=timeout):
-            print("\n!!! A sequencia foi interrompida devido a um erro ou timeout. !!!")
-            all_success = False
-            break
-    
+        log(f"!!! ERRO: O script '{stage['path']}' nao foi encontrado. !!!")
+        return result
+
+    def pump():
+        for line in process.stdout:
+            line = line.rstrip('\n')
+            log(f"[{stage['name']}] {line}")
+            if rows_pattern:
+                match = rows_pattern.search(line)
+                if match:
+                    result['rows'] = int(match.group(1))
+
+    reader = threading.Thread(target=pump, daemon=True)
+    reader.start()
+    try:
+        result['exit_code'] = process.wait(timeout=stage["timeout"])
+        result['status'] = 'ok' if result['exit_code'] == 0 else 'error'
+    except subprocess.TimeoutExpired:
+        process.terminate()
+        try:
+            result['exit_code'] = process.wait(timeout=TERMINATE_GRACE_SECONDS)
+        except subprocess.TimeoutExpired:
+            log(f"!!! A etapa '{stage['name']}' nao terminou em {TERMINATE_GRACE_SECONDS}s apos o SIGTERM; encerrando a forca. !!!")
+            process.kill()
+            result['exit_code'] = process.wait()
+        result['status'] = 'timeout'
+    reader.join()
+    result['wall_seconds'] = round(time.monotonic() - start, 3)
+
+    if result['status'] == 'ok':
+        rows = '' if result['rows'] is None else f" ({result['rows']} linhas)"
+        log(f"--- [{stage['name']}] concluido em {result['wall_seconds']:.1f}s{rows}. ---")
+    elif result['status'] == 'timeout':
+        log(f"!!! TIMEOUT na etapa '{stage['name']}' apos {stage['timeout']} segundos. !!!")
+    else:
+        log(f"!!! ERRO na etapa '{stage['name']}' (codigo de saida {result['exit_code']}). !!!")
+    return result
+
+def run_pipeline(stages, history):
+    """
+    Executa as etapas respeitando as dependencias, com as independentes em
+    paralelo. Uma etapa cuja dependencia falhou e registrada como 'skipped'.
+    Retorna True se todas terminaram com sucesso.
+    """
+    run_started_at = datetime.now().isoformat(timespec='seconds')
+    status = {}
+    pending = list(stages)
+    running = {}
+    log(f"Iniciando sequencia de atualizacao e deploy ({run_started_at})...")
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while pending or running:
+            for stage in list(pending):
+                deps = [status.get(dep) for dep in stage["after"]]
+                if any(dep not in (None, 'ok') for dep in deps):
+                    pending.remove(stage)
+                    status[stage['name']] = 'skipped'
+                    log(f"--- [{stage['name']}] pulada: uma etapa anterior falhou. ---")
+                    record_stage(history, run_started_at, {'stage': stage['name'], 'started_at': None,
+                                                           'wall_seconds': None, 'rows': None,
+                                                           'exit_code': None, 'status': 'skipped'})
+                elif all(dep == 'ok' for dep in deps):
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, stage)] = stage
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                result = future.result()
+                status[stage['name']] = result['status']
+                record_stage(history, run_started_at, result)
+
+    all_success = all(value == 'ok' for value in status.values())
     if all_success:
-        print("\n*** Todos os scripts foram executados com sucesso! ***")
-        
-def countdown_progress_bar(duration_seconds):
-    """Exibe uma barra de progresso e contagem regressiva."""
-    print(f"\nAguardando 24 horas para a proxima execucao...")
-    total_steps = duration_seconds
-    
-    for i in range(total_steps, -1, -1):
-        hours, remainder = divmod(i, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        time_left = f"{hours:02}:{minutes:02}:{seconds:02}"
-        
-        progress = (total_steps - i) / total_steps
-        bar_length = 50
-        filled_length = int(bar_length * progress)
-        bar = '█' * filled_length + '-' * (bar_length - filled_length)
-        
-        sys.stdout.write(f'\rTempo restante: {time_left} |{bar}| {progress*100:.2f}%')
-        sys.stdout.flush()
-        
-        time.sleep(1)
-
-    print() # Nova linha no final da barra de progresso
+        log("\n*** Todas as etapas foram executadas com sucesso! ***")
+    else:
+        log("\n!!! A sequencia terminou com etapas falhas ou puladas. !!!")
+    return all_success
 
-if __name__ == "__main__":
+def next_run_time(last_start, config):
+    """
+    Proximo horario de execucao: todo dia em pipeline_daily_at ("HH:MM"), se
+    configurado, ou pipeline_interval_hours depois do inicio da execucao anterior.
+    """
+    daily_at = config.get('pipeline_daily_at')
+    if daily_at:
+        hour, minute = (int(part) for part in daily_at.split(':'))
+        candidate = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return candidate if candidate > datetime.now() else candidate + timedelta(days=1)
+    return last_start + timedelta(hours=config.get('pipeline_interval_hours', 24))
+
+def sleep_until(when):
+    """Dorme ate 'when' (em trechos de no maximo uma hora, para acompanhar ajustes do relogio)."""
+    log(f"\nProxima execucao em {when.strftime('%d-%m-%Y %H:%M:%S')}.")
     while True:
-        main()
-        try:
-            # 24 horas = 86400 segundos
-            countdown_progress_bar(86400)
-        except KeyboardInterrupt:
-            print("\nContagem regressiva interrompida pelo usuario. Saindo...")
-            break
+        remaining = (when - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 3600))
+
+def print_history(history, limit):
+    runs = history.execute(
+        "SELECT DISTINCT run_started_at FROM stage_runs ORDER BY run_started_at DESC LIMIT ?", (limit,)
+    ).fetchall()
+    for (run_started_at,) in reversed(runs):
+        print(f"Execucao de {run_started_at}:")
+        for stage, wall_seconds, rows, exit_code, status in history.execute(
+            "SELECT stage, wall_seconds, rows, exit_code, status FROM stage_runs WHERE run_started_at = ? ORDER BY id",
+            (run_started_at,)
+        ):
+            wall = '-' if wall_seconds is None else f"{wall_seconds:.1f}s"
+            print(f"  {stage:<10} {status:<8} {wall:>9}  linhas={'-' if rows is None else rows}  saida={'-' if exit_code is None else exit_code}")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Executa scraper, arquivamento, indice FTS e deploy periodicamente.")
+    parser.add_argument('--once', action='store_true', help='Executa uma vez e sai (codigo 1 se alguma etapa falhar).')
+    parser.add_argument('--history', type=int, metavar='N', help='Mostra as ultimas N execucoes e sai.')
+    args = parser.parse_args()
+
+    config = load_config()
+    history = open_history(config.get('pipeline_history_database', 'pipeline_history.db'))
+    try:
+        if args.history:
+            print_history(history, args.history)
+        elif args.once:
+            sys.exit(0 if run_pipeline(STAGES, history) else 1)
+        else:
+            while True:
+                started = datetime.now()
+                run_pipeline(STAGES, history)
+                try:
+                    sleep_until(next_run_time(started, config))
+                except KeyboardInterrupt:
+                    print("\nEspera interrompida pelo usuario. Saindo...")
+                    break
+    finally:
+        history.close()